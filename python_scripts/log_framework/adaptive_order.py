@@ -0,0 +1,208 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Adaptive ordering of filters for the log framework.
+
+By default, log_frame applies the filters in the order they are listed,
+and stops at the first one that returns False. With an AdaptiveOrder,
+the log framework keeps track of how often each filter lets events
+through and how long it takes, and periodically reorders the filters so
+the cheapest filters rejecting the most events run first:
+
+    filter_order = AdaptiveOrder(reorder_every=1000)
+    log_frame(events, SAMPLE_FILTERS, filter_order=filter_order)
+
+    # From anywhere, e.g. an on_event or on_exit function
+    print(filter_order.order())
+    print(filter_order.statistics())
+
+Filters with side effects must not be moved. Either mark the filter
+function with the side_effects decorator, or list the position of the
+filter in pinned. Pinned filters stay in place, and no other filter is
+moved past them.
+
+NOTE, the statistics of a filter only cover the events it was applied
+to. These depend on the filters that run before it.
+"""
+
+from timeit import default_timer
+
+from field_index import release_field_index
+from log_exception import LogException
+
+
+def side_effects(filter_fun):
+    """
+    Decorator marking a filter function as having side effects.
+    Adaptive ordering keeps such filters in place.
+    """
+    filter_fun.side_effects = True
+    return filter_fun
+
+
+class FilterStats(object):
+    """
+    Runtime statistics of one filter.
+    """
+
+    def __init__(self, position, name, pinned):
+        """
+        Position is the index of the filter in the filter list.
+        """
+        self.position = position
+        self.name = name
+        self.pinned = pinned
+        self.calls = 0
+        self.passes = 0
+        self.timed_calls = 0
+        self.seconds = 0.0
+
+    def pass_rate(self):
+        """
+        Ratio of applied events that got through the filter.
+        Filters not yet applied are assumed to let everything through.
+        """
+        if not self.calls:
+            return 1.0
+        return float(self.passes) / self.calls
+
+    def cost(self):
+        """
+        Mean time the filter takes on an event, in seconds.
+        """
+        if not self.timed_calls:
+            return 0.0
+        return self.seconds / self.timed_calls
+
+    def rank(self):
+        """
+        Filters with a lower rank run first. The rank is the cost of
+        the filter per rejected event: cost / (1 - pass rate).
+        """
+        reject_rate = 1.0 - self.pass_rate()
+        if reject_rate <= 0.0:
+            return float('inf')
+        return self.cost() / reject_rate
+
+    def as_dict(self):
+        """
+        Returns the statistics as a dict.
+        """
+        return {
+            'position': self.position,
+            'name': self.name,
+            'pinned': self.pinned,
+            'calls': self.calls,
+            'passes': self.passes,
+            'pass_rate': self.pass_rate(),
+            'cost': self.cost()}
+
+
+class AdaptiveOrder(object):
+    """
+    Applies the filters of the log framework in an order
+    adapted to their observed pass rate and cost.
+        - reorder_every:
+            The number of events between two reorderings
+        - time_every:
+            Only every time_every-th event is timed, the
+            pass rate is counted on all events
+        - pinned:
+            Positions of filters (in the filter list) to keep in place
+    """
+
+    def __init__(self, reorder_every=1000, time_every=16, pinned=()):
+        """
+        The filters are bound by the log framework. See bind.
+        """
+        if reorder_every < 1 or time_every < 1:
+            raise LogException('reorder_every and time_every must be >= 1!')
+
+        self.reorder_every = reorder_every
+        self.time_every = time_every
+        self.pinned = set(pinned)
+        self.events = 0
+        self.stats = []
+        self._plans = []
+
+    def bind(self, filter_funs, filter_plans):
+        """
+        Binds the filters, as a list of (fun, args, kwargs) tuples
+        and their compiled plans. Resets all statistics.
+        """
+        self.events = 0
+        self.stats = []
+
+        for position, (fun, _args, _kwargs) in enumerate(filter_funs):
+            pinned = (position in self.pinned or
+                      getattr(fun, 'side_effects', False))
+            self.stats.append(
+                FilterStats(position, fun.__name__, pinned))
+
+        self._plans = list(zip(filter_plans, self.stats))
+
+    def apply(self, event):
+        """
+        Same as apply_filter_plans, but also collects statistics
+        and reorders the filters when due.
+        """
+        self.events += 1
+        timed = self.events % self.time_every == 0
+
+        try:
+            for filter_plan, stats in self._plans:
+                if timed:
+                    start = default_timer()
+                    result = filter_plan(event)
+                    stats.seconds += default_timer() - start
+                    stats.timed_calls += 1
+                else:
+                    result = filter_plan(event)
+
+                stats.calls += 1
+                if not result:
+                    return False
+                stats.passes += 1
+
+        finally:
+            release_field_index()
+
+            if self.events % self.reorder_every == 0:
+                self.reorder()
+
+        return event
+
+    def reorder(self):
+        """
+        Sorts the filters by rank. Pinned filters split the filter
+        list into segments, each of them sorted separately.
+        """
+        plans = []
+        segment = []
+
+        for plan in self._plans:
+            if plan[1].pinned:
+                plans.extend(sorted(segment, key=lambda x: x[1].rank()))
+                plans.append(plan)
+                segment = []
+            else:
+                segment.append(plan)
+
+        plans.extend(sorted(segment, key=lambda x: x[1].rank()))
+
+        # Swap the whole list, so apply never sees a half-sorted one.
+        self._plans = plans
+
+    def order(self):
+        """
+        Returns the current order of the filters, as
+        a list of (position, name) tuples.
+        """
+        return [(stats.position, stats.name) for _plan, stats in self._plans]
+
+    def statistics(self):
+        """
+        Returns the statistics of each filter, in the current order.
+        """
+        return [stats.as_dict() for _plan, stats in self._plans]
@@ -0,0 +1,391 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Micro-batched filtering for the log framework. Needs NumPy.
+
+In batch mode, the log framework collects the events in batches of up
+to size events, or up to interval seconds' worth of events. The fields
+used by the filters - e.g. the tag, the name and field values - are
+projected into NumPy columns, and the filters run as vectorized masks
+over the whole batch:
+
+    log_frame(events, SAMPLE_FILTERS, on_event=on_event,
+              batch=BatchMode(size=1000, interval=0.05))
+
+The sample filters have vectorized versions registered in this module.
+Register your own with the vectorizes decorator:
+
+    @vectorizes(filter_big_n)
+    def batch_filter_big_n(columns, default=True):
+        values, valid = columns.field_values('n')
+        return numpy.where(valid, values > 1000, default)
+
+Each column is built in one pass over the events, with integer codes
+for the tags and names, and only for the events of the batch not yet
+filtered out. Filters without a vectorized version are still called per
+event, on these events too. The surviving events are passed on in their
+original order.
+
+The events are read on a separate thread, see BatchReader in
+listen_reader.py, which hands them over a whole batch at a time. A batch
+that is not full is passed on interval seconds after its first event,
+even if the events generator blocks waiting for the next event.
+
+NOTE:
+    - As the events generator runs on the reader thread, on_event cannot
+      close it. Wrap it in a ListenReader and close that instead, see
+      listen_reader.py
+    - If on_event stops the events, the other surviving events of the
+      same batch are still passed to on_event
+"""
+
+from operator import itemgetter
+from numbers import Real
+
+from field_index import FieldIndex, release_field_index
+from listen_reader import BatchReader
+from log_exception import LogException
+from sample_filters import (DEFAULT, print_warning, filter_tag, filter_name,
+                            filter_field, filter_field_values)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Filter functions and their vectorized versions.
+VECTORIZED = {}
+
+
+def vectorizes(filter_fun):
+    """
+    Decorator registering the decorated function as the vectorized
+    version of filter_fun.
+
+    The vectorized function gets an EventColumns instance instead of an
+    event, and the same arguments as filter_fun. It must return a boolean
+    NumPy array, with one item for each event of the batch.
+    """
+    def register(batch_fun):
+        """
+        Registers batch_fun and returns it unchanged.
+        """
+        VECTORIZED[filter_fun] = batch_fun
+        return batch_fun
+
+    return register
+
+
+def event_name(event):
+    """
+    Returns the name of an event.
+    """
+    return event['attr']['name']
+
+
+def field_value(attrs, field_name):
+    """
+    Returns the numeric value of the named field, given the field
+    attributes of an event, or None.
+    """
+    value = attrs.get(field_name, {}).get('value') if attrs else None
+    return value if isinstance(value, Real) else None
+
+
+class EventColumns(object):
+    """
+    Projects the events of a batch into NumPy columns. Each column is
+    built on first use, in one pass over the events, and shared by all
+    filters applied to the batch.
+
+    Each column comes with a boolean valid column. It is False for the
+    events on which the per-event filter would fail with an exception,
+    e.g. events without a name or without the requested field.
+    """
+
+    def __init__(self, events, columns=None, codes=None, field_attrs=None):
+        """
+        Keeps the events of the batch, and the columns already
+        built for them, if any. See take.
+        """
+        self.events = events
+        self._columns = columns or {}
+        self._codes = codes if codes is not None else {}
+        self._field_attrs = field_attrs
+
+    def __len__(self):
+        """
+        Number of events in the batch.
+        """
+        return len(self.events)
+
+    def take(self, rows):
+        """
+        Returns the columns of the events at rows, an array of
+        indices, keeping the columns already built.
+        """
+        field_attrs = None
+        if self._field_attrs is not None:
+            all_attrs, valid = self._field_attrs
+            field_attrs = ([all_attrs[row] for row in rows], valid[rows])
+
+        return EventColumns(
+            [self.events[row] for row in rows],
+            {key: (values[rows], valid[rows])
+             for key, (values, valid) in self._columns.items()},
+            self._codes, field_attrs)
+
+    def _values(self, getter):
+        """
+        Returns the list of values returned by getter for each event,
+        with None for the events on which it fails, and the valid column.
+        """
+        try:
+            values = [getter(event) for event in self.events]
+            return values, numpy.ones(len(values), dtype=bool)
+
+        # Only look for the failing events if there are any.
+        except Exception:
+            values = []
+            valid = numpy.ones(len(self), dtype=bool)
+
+            for row, event in enumerate(self.events):
+                try:
+                    values.append(getter(event))
+                except Exception:
+                    values.append(None)
+                    valid[row] = False
+
+            return values, valid
+
+    def _encoded(self, key, getter):
+        """
+        Returns the values returned by getter as integer codes, the
+        valid column and the dict of value -> code, unless cached.
+        Unhashable values get the code -1, matching no value.
+        """
+        if key not in self._columns:
+            values, valid = self._values(getter)
+            codes = self._codes.setdefault(key, {})
+
+            try:
+                encoded = [codes.setdefault(value, len(codes))
+                           for value in values]
+            except TypeError:
+                encoded = []
+                for value in values:
+                    try:
+                        encoded.append(codes.setdefault(value, len(codes)))
+                    except TypeError:
+                        encoded.append(-1)
+
+            self._columns[key] = (
+                numpy.fromiter(encoded, dtype=numpy.intp, count=len(values)),
+                valid)
+
+        values, valid = self._columns[key]
+        return values, valid, self._codes[key]
+
+    def matches(self, key, getter, value):
+        """
+        True for each event on which getter returns value,
+        comparing the integer codes of the values.
+        """
+        codes, valid, code_of = self._encoded(key, getter)
+
+        try:
+            code = code_of.get(value, -2)
+        except TypeError:
+            code = -2
+
+        return codes == code, valid
+
+    def field_attrs(self):
+        """
+        Returns the field name -> field attributes dict of each event,
+        or None for events with malformed content, and the valid column.
+        """
+        if self._field_attrs is None:
+            self._field_attrs = self._values(
+                lambda event: FieldIndex(event).attrs())
+
+        return self._field_attrs
+
+    def has_tag(self, tag):
+        """
+        True for each event with the given tag.
+        """
+        return self.matches('tag', itemgetter('tag'), tag)
+
+    def has_name(self, name):
+        """
+        True for each event with the given name.
+        """
+        return self.matches('name', event_name, name)
+
+    def field_present(self, field_name):
+        """
+        True for each event carrying the named field.
+        """
+        all_attrs, valid = self.field_attrs()
+        present = numpy.fromiter(
+            [attrs is not None and field_name in attrs
+             for attrs in all_attrs], dtype=bool, count=len(all_attrs))
+        return present, valid
+
+    def field_values(self, field_name):
+        """
+        The value of the named field in each event, as floats. Not valid
+        for events without the field, or with a non-numeric value.
+        """
+        key = ('field', field_name)
+
+        if key not in self._columns:
+            raw = [field_value(attrs, field_name)
+                   for attrs in self.field_attrs()[0]]
+            valid = numpy.fromiter([value is not None for value in raw],
+                                   dtype=bool, count=len(raw))
+            values = numpy.fromiter(
+                [numpy.nan if value is None else value for value in raw],
+                dtype=float, count=len(raw))
+            self._columns[key] = (values, valid)
+
+        return self._columns[key]
+
+
+def with_default(matched, valid, default, fun_name):
+    """
+    Returns matched where valid, the default value elsewhere.
+    Prints a warning with the number of failed events, like
+    the per-event filters print one for each.
+    """
+    failed = len(valid) - numpy.count_nonzero(valid)
+    if failed:
+        print_warning('{} of {} events failed'.format(failed, len(valid)),
+                      fun_name)
+
+    return numpy.where(valid, matched, bool(default))
+
+
+@vectorizes(filter_tag)
+def batch_filter_tag(columns, tag, default=DEFAULT):
+    """
+    Vectorized filter_tag.
+    """
+    matched, valid = columns.has_tag(tag)
+    return with_default(matched, valid, default, 'filter_tag')
+
+
+@vectorizes(filter_name)
+def batch_filter_name(columns, name, default=DEFAULT):
+    """
+    Vectorized filter_name.
+    """
+    matched, valid = columns.has_name(name)
+    return with_default(matched, valid, default, 'filter_name')
+
+
+@vectorizes(filter_field)
+def batch_filter_field(columns, field_name, default=DEFAULT):
+    """
+    Vectorized filter_field.
+    """
+    present, valid = columns.field_present(field_name)
+    return with_default(present, valid, default, 'filter_field')
+
+
+@vectorizes(filter_field_values)
+def batch_filter_field_values(columns, field_name,
+                              min_val=0, max_val=100, default=DEFAULT):
+    """
+    Vectorized filter_field_values.
+    """
+    values, valid = columns.field_values(field_name)
+    with numpy.errstate(invalid='ignore'):
+        matched = (min_val < values) & (values < max_val)
+    return with_default(matched, valid, default, 'filter_field_values')
+
+
+class BatchMode(object):
+    """
+    Filters the events in batches.
+        - size:
+            The maximum number of events in a batch
+        - interval:
+            The maximum time, in seconds, between the first and the
+            last event of a batch
+    """
+
+    def __init__(self, size=1000, interval=0.05):
+        """
+        The filters are bound by the log framework. See bind.
+        """
+        if numpy is None:
+            raise LogException('Batch mode needs NumPy!')
+
+        if size < 1:
+            raise LogException('Batch size must be >= 1!')
+
+        self.size = size
+        self.interval = interval
+        self._stages = []
+
+    def bind(self, filter_funs, filter_plans):
+        """
+        Binds the filters, as a list of (fun, args, kwargs) tuples
+        and their compiled plans.
+        """
+        self._stages = []
+
+        for (fun, args, kwargs), plan in zip(filter_funs, filter_plans):
+            batch_fun = VECTORIZED.get(fun)
+            self._stages.append((batch_fun, args, kwargs, plan))
+
+    def batches(self, events):
+        """
+        Yields the events in lists of up to size events. The events are
+        read on a separate thread, see BatchReader, so a batch is yielded
+        once interval seconds passed since its first event, even if no
+        event arrives.
+
+        Raises the error of the events generator, if any, after the
+        events read before it.
+        """
+        return iter(BatchReader(events, self.size, self.interval))
+
+    def apply(self, batch):
+        """
+        Applies the filters on a list of events. Returns
+        the events not filtered out, in their original order.
+
+        Once a filter drops events, the next filters only
+        get the columns of the events still matching.
+        """
+        columns = EventColumns(batch)
+
+        for batch_fun, args, kwargs, plan in self._stages:
+            if batch_fun:
+                matched = batch_fun(columns, *args, **kwargs)
+
+            else:
+                matched = numpy.fromiter(
+                    [bool(plan(event)) for event in columns.events],
+                    dtype=bool, count=len(columns))
+                release_field_index()
+
+            if not matched.all():
+                kept = numpy.flatnonzero(matched)
+                if not kept.size:
+                    return []
+                columns = columns.take(kept)
+
+        return columns.events
+
+    def filtered_events(self, events):
+        """
+        Yields the events not filtered out, batch by batch.
+        """
+        for batch in self.batches(events):
+            for event in self.apply(batch):
+                yield event
@@ -0,0 +1,234 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Benchmark suite for the log framework.
+
+Runs log_frame with several filter sets on synthetic events, and measures
+the events handled per second and the latency of each event, i.e. the
+time log_frame spends on it. The results are printed, and saved as JSON
+for comparing across commits:
+
+    $ python bench_log_frame.py --events 50000 --output before.json
+    ... change the framework ...
+    $ python bench_log_frame.py --events 50000 --compare before.json
+
+By default, the results are saved as bench_<commit>.json.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+from timeit import default_timer
+
+from adaptive_order import AdaptiveOrder
+from filter_expr import compile_filter
+from log_framework import log_frame
+from sample_filters import (filter_tag, filter_name, filter_field,
+                            filter_field_values)
+from synthetic_events import synthetic_events, normal
+
+# The filters of main.py.
+SAMPLE_FILTERS = [
+    (filter_tag, ('solicit',), {}),
+    (filter_name, ('CheckPrime',), {}),
+    (filter_field, ('n',), {}),
+    (filter_field_values, ('n',), {'min_val': 1, 'max_val': 14})]
+
+# The same filters, as a filter expression.
+SAMPLE_EXPR = [
+    compile_filter('tag == "solicit" and name == "CheckPrime" and '
+                   'has_field("n") and 1 < field("n") < 14')]
+
+# The same filters, with the most selective one listed last.
+TAG_LAST_FILTERS = SAMPLE_FILTERS[1:] + SAMPLE_FILTERS[:1]
+
+# Filter sets: name -> (filters, extra log_frame kwargs factory).
+FILTER_SETS = {
+    'no_filters': ([], dict),
+    'sample': (SAMPLE_FILTERS, dict),
+    'sample_expr': (SAMPLE_EXPR, dict),
+    'tag_last': (TAG_LAST_FILTERS, dict),
+    'tag_last_adaptive': (
+        TAG_LAST_FILTERS, lambda: {'filter_order': AdaptiveOrder()})}
+
+# Event mixes: name -> synthetic_events kwargs.
+SCENARIOS = {
+    'default_mix': {},
+    'solicit_heavy': {'tag_mix': {'solicit': 1, 'notify': 1}},
+    'wide_events': {'field_names': ('div', 'n'), 'field_count': 20,
+                    'values': normal(10, 5)}}
+
+
+def batch_filter_set():
+    """
+    Adds the batch mode filter set, if NumPy is available.
+    """
+    try:
+        from batch_filters import BatchMode
+        BatchMode()
+    except Exception:
+        return
+
+    FILTER_SETS['sample_batch'] = (
+        SAMPLE_FILTERS, lambda: {'batch': BatchMode(size=512)})
+
+
+def count_event(event, counter):
+    """
+    on_event function counting the matched events.
+    """
+    counter[0] += 1
+
+
+def timed_events(events, latencies):
+    """
+    Yields the events, recording the time between handing out
+    an event and being asked for the next one.
+    """
+    for event in events:
+        start = default_timer()
+        yield event
+        latencies.append(default_timer() - start)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the given percentile of a sorted list.
+    """
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_once(events, filters, kwargs):
+    """
+    Runs log_frame once. Returns the elapsed time, the
+    number of matched events and the event latencies.
+    """
+    counter = [0]
+    latencies = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = default_timer()
+        log_frame(timed_events(events, latencies), filters,
+                  on_event=(count_event, (counter,), {}), **kwargs)
+        elapsed = default_timer() - start
+
+    return elapsed, counter[0], latencies
+
+
+def run_benchmark(events, filters, make_kwargs, repeat):
+    """
+    Runs log_frame repeat times, and returns the results of the fastest run.
+    """
+    best = None
+
+    for _ in range(repeat):
+        run = run_once(events, filters, make_kwargs())
+        if best is None or run[0] < best[0]:
+            best = run
+
+    elapsed, matched, latencies = best
+    latencies.sort()
+    return {
+        'events_per_sec': len(events) / elapsed,
+        'matched': matched,
+        'latency_mean': sum(latencies) / len(latencies),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99)}
+
+
+def git_commit():
+    """
+    Returns the short hash of the current commit, or 'unknown'.
+    """
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT)
+        return output.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path):
+    """
+    Prints the events/sec of each run relative to a saved baseline.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    old_rates = {(x['scenario'], x['filter_set']): x['events_per_sec']
+                 for x in baseline['results']}
+
+    print('\nCompared with {} ({}):'.format(baseline_path, baseline['commit']))
+    for result in results:
+        old_rate = old_rates.get((result['scenario'], result['filter_set']))
+        change = '{:+.1%}'.format(result['events_per_sec'] / old_rate - 1) \
+            if old_rate else 'new'
+        print('{:<16} {:<20} {:>10}'.format(
+            result['scenario'], result['filter_set'], change))
+
+
+def main():
+    """
+    Runs all filter sets on all scenarios, prints and saves the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--filter-sets', nargs='*')
+    parser.add_argument('--scenarios', nargs='*')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    batch_filter_set()
+    commit = git_commit()
+    results = []
+
+    print('{:<16} {:<20} {:>12} {:>8} {:>10} {:>10}'.format(
+        'scenario', 'filter_set', 'events/sec', 'matched', 'p50 us',
+        'p99 us'))
+
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        events = list(synthetic_events(args.events, seed=args.seed,
+                                       **SCENARIOS[scenario]))
+
+        for filter_set in args.filter_sets or sorted(FILTER_SETS):
+            filters, make_kwargs = FILTER_SETS[filter_set]
+            result = run_benchmark(events, filters, make_kwargs, args.repeat)
+            result.update({'scenario': scenario, 'filter_set': filter_set})
+            results.append(result)
+
+            print('{:<16} {:<20} {:>12.0f} {:>8} {:>10.2f} {:>10.2f}'.format(
+                scenario, filter_set, result['events_per_sec'],
+                result['matched'], result['latency_p50'] * 1e6,
+                result['latency_p99'] * 1e6))
+
+    output = args.output or 'bench_{}.json'.format(commit)
+    with open(output, 'w') as output_file:
+        json.dump({
+            'commit': commit,
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'events': args.events,
+            'seed': args.seed,
+            'results': results}, output_file, indent=2)
+    print('\nResults saved as {}'.format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Benchmarks the scaling of log_frame_sharded across CPU cores.
+
+Runs a CPU-heavy filter set on synthetic events, first with log_frame,
+then with log_frame_sharded with 1 to max_workers worker processes:
+
+    $ python bench_sharding.py --events 20000 --max-workers 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+from timeit import default_timer
+
+from log_framework import log_frame
+from sample_filters import generic_filter_fun, filter_field
+from sharding import log_frame_sharded
+from synthetic_events import synthetic_events
+
+
+@generic_filter_fun
+def filter_busy(event, rounds=200, default=True):
+    """
+    Filter burning CPU time, standing in for a costly filter.
+    Always returns True.
+    """
+    total = 0
+    for index in range(rounds):
+        total += hash((event['attr']['name'], index)) & 0xff
+    return total >= 0
+
+
+def discard(event):
+    """
+    on_event function doing nothing.
+    """
+
+
+def time_run(run, events):
+    """
+    Runs a log frame on a list of events, hiding its output.
+    Returns the events handled per second.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = default_timer()
+        run(iter(events))
+        elapsed = default_timer() - start
+
+    return len(events) / elapsed
+
+
+def main():
+    """
+    Runs the benchmark and prints the events/sec of each run.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[2])
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--max-workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--rounds', type=int, default=200,
+                        help='CPU cost of the filter per event')
+    args = parser.parse_args()
+
+    events = list(synthetic_events(args.events, seed=1))
+    filters = [(filter_busy, (), {'rounds': args.rounds}),
+               (filter_field, ('n',), {})]
+    on_event = (discard, (), {})
+
+    baseline = time_run(
+        lambda x: log_frame(x, filters, on_event=on_event), events)
+    print('{:<12} {:>12} {:>8}'.format('run', 'events/sec', 'speedup'))
+    print('{:<12} {:>12.0f} {:>8.2f}'.format('log_frame', baseline, 1.0))
+
+    for workers in range(1, args.max_workers + 1):
+        rate = time_run(
+            lambda x, workers=workers: log_frame_sharded(
+                x, filters, on_event=on_event, workers=workers),
+            events)
+        print('{:<12} {:>12.0f} {:>8.2f}'.format(
+            'workers={}'.format(workers), rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
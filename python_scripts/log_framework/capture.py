@@ -0,0 +1,241 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Record and replay SPARKL event streams.
+
+Wrap the generator returned by sparkl('listen') with record_events to
+write every event to a capture file, along with the time it was received:
+
+    events = record_events(sparkl('listen', alias=alias), 'prod.cap')
+    log_frame(events, my_filters, on_event=on_event)
+
+Later, without a SPARKL instance, replay the capture into the log
+framework, at the original speed, at a scaled speed or as fast as
+possible:
+
+    log_frame(replay_events('prod.cap', speed=None), my_filters)
+
+The capture file is append-only. It starts with a header, followed by one
+record per event:
+    - The receive timestamp, as a big-endian double (seconds since epoch)
+    - The length of the event, as a big-endian unsigned int
+    - The event, as compact UTF-8 JSON
+
+Compressed captures are gzip files holding the same stream. Appending to
+a compressed capture adds a new gzip member, which readers handle
+transparently.
+
+A crash of the recording process may leave a truncated last record. When
+an uncompressed capture is opened again, the truncated record is dropped
+before appending. In a compressed capture, the truncated gzip member is
+kept: readers stop there, so the records appended after it are not read.
+"""
+
+import gzip
+import json
+import os
+import struct
+import time
+import zlib
+
+from event import json_default
+from log_exception import LogException
+
+# Header starting every capture.
+MAGIC = b'SPKLCAP1'
+
+# Timestamp and length preceding each event.
+RECORD_HEAD = struct.Struct('>dI')
+
+# First bytes of gzip files.
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Errors reading a truncated or corrupt gzip member.
+GZIP_ERRORS = (EOFError, zlib.error, getattr(gzip, 'BadGzipFile', OSError))
+
+
+class CaptureWriter(object):
+    """
+    Appends events to a capture file.
+        - compress:
+            If True, the capture is gzip compressed
+        - flush_every:
+            Records are flushed to disk every flush_every events
+    """
+
+    def __init__(self, path, compress=False, flush_every=100):
+        """
+        Opens the capture file, writing the header if the file is new.
+        """
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+
+        if not is_new and is_compressed(path) != compress:
+            raise LogException('Cannot mix compressed and uncompressed '
+                               'records in {}!'.format(path))
+
+        # Drop a truncated last record, so the records appended next
+        # can be read.
+        if not is_new and not compress:
+            is_new = truncate_capture(path) == 0
+
+        self.file = gzip.open(path, 'ab') if compress else open(path, 'ab')
+        self.flush_every = flush_every
+        self.unflushed = 0
+
+        if is_new:
+            self.file.write(MAGIC)
+
+    def write(self, event, timestamp=None):
+        """
+        Appends an event, received at timestamp. By default, now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        data = json.dumps(event, separators=(',', ':'),
+                          default=json_default).encode('utf-8')
+        self.file.write(RECORD_HEAD.pack(timestamp, len(data)))
+        self.file.write(data)
+
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Flushes the records written so far.
+        """
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        """
+        Flushes the records and closes the file.
+        """
+        self.file.close()
+
+
+def is_compressed(path):
+    """
+    Returns True if the file at path is gzip compressed.
+    """
+    with open(path, 'rb') as capture:
+        return capture.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def complete_size(path):
+    """
+    Returns the size of the uncompressed capture at path, up to the
+    end of its last complete record. Returns 0 if even the header is
+    truncated.
+    """
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as capture:
+        magic = capture.read(len(MAGIC))
+        if magic != MAGIC:
+            if MAGIC.startswith(magic):
+                return 0
+            raise LogException('{} is not a capture file!'.format(path))
+
+        end = len(MAGIC)
+        while True:
+            head = capture.read(RECORD_HEAD.size)
+            if len(head) < RECORD_HEAD.size:
+                return end
+
+            _timestamp, length = RECORD_HEAD.unpack(head)
+            record_end = end + RECORD_HEAD.size + length
+            if record_end > size:
+                return end
+
+            capture.seek(record_end)
+            end = record_end
+
+
+def truncate_capture(path):
+    """
+    Truncates the uncompressed capture at path after its
+    last complete record. Returns the new size.
+    """
+    size = complete_size(path)
+
+    if size < os.path.getsize(path):
+        with open(path, 'r+b') as capture:
+            capture.truncate(size)
+
+    return size
+
+
+def record_events(events, path, compress=False, flush_every=100):
+    """
+    Yields the events, after appending each to the capture at path.
+    The capture is closed when the events stop.
+    """
+    writer = CaptureWriter(path, compress=compress, flush_every=flush_every)
+
+    try:
+        for event in events:
+            writer.write(event)
+            yield event
+
+    finally:
+        writer.close()
+
+
+def read_capture(path):
+    """
+    Yields the (timestamp, event) records of a capture.
+
+    A truncated last record, e.g. after a crash of the
+    recording process, is ignored. In compressed captures,
+    reading stops at a truncated or corrupt gzip member.
+    """
+    opener = gzip.open if is_compressed(path) else open
+
+    with opener(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise LogException('{} is not a capture file!'.format(path))
+
+        while True:
+            try:
+                head = capture.read(RECORD_HEAD.size)
+                if len(head) < RECORD_HEAD.size:
+                    return
+
+                timestamp, length = RECORD_HEAD.unpack(head)
+                data = capture.read(length)
+                if len(data) < length:
+                    return
+
+            except GZIP_ERRORS:
+                return
+
+            yield timestamp, json.loads(data.decode('utf-8'))
+
+
+def replay_events(path, speed=1.0):
+    """
+    Yields the events of a capture, like sparkl('listen') would.
+        - speed:
+            1.0 replays at the original speed, 2.0 twice as fast, etc.
+            None replays as fast as possible
+    """
+    if speed is not None and speed <= 0:
+        raise LogException('Speed must be positive, or None!')
+
+    started = None
+    first = None
+
+    for timestamp, event in read_capture(path):
+        if speed is not None:
+            if started is None:
+                started = time.time()
+                first = timestamp
+
+            delay = (timestamp - first) / speed - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        yield event
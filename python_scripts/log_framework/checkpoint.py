@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Checkpoint and resume of the log framework state.
+
+A Checkpointer saves the state of stages, e.g. window aggregates and
+dedup sets, to a snapshot file every interval seconds, and restores it
+when log_frame starts. A restarted listener so carries on where the
+previous one stopped, without replaying the events:
+
+    dedup = Deduplicator(ttl=3600)
+    per_name = WindowAggregator(on_window=(print_window, (), {}))
+    checkpoint = Checkpointer('pipeline.ckpt',
+                              {'dedup': dedup, 'per_name': per_name},
+                              interval=30)
+
+    log_frame(events, my_filters, pre_stages=[dedup], stages=[per_name],
+              checkpoint=checkpoint)
+
+Each component is an object with:
+    - get_state() - Returning its state, as picklable data
+    - set_state(state) - Restoring the state returned by get_state
+
+The snapshot also holds the number of events processed, and the marker
+of the last one, e.g. its timestamp. See marker and resume_marker.
+
+When the events stop, log_frame saves a last snapshot before closing
+the stages, so it holds e.g. the windows still open. Checkpoints cannot
+be used with batch mode, whose reader thread would save the snapshots
+while the stages change their state.
+
+Snapshots are written to a temporary file, then renamed over the
+previous snapshot, so a crash never leaves a partial snapshot behind.
+They are pickled and zlib compressed, so only restore snapshots
+written by trusted processes.
+"""
+
+import os
+import pickle
+import time
+import zlib
+
+from log_exception import LogException
+
+# Version of the snapshot format.
+VERSION = 1
+
+
+class Checkpointer(object):
+    """
+    Saves and restores the state of components.
+        - path:
+            The snapshot file
+        - components:
+            Dict of name -> component with get_state and set_state methods
+        - interval:
+            The time, in seconds, between two snapshots
+        - marker:
+            Optional function returning the marker of an event, e.g. its
+            timestamp, saved for the last event processed
+    """
+
+    def __init__(self, path, components, interval=60.0, marker=None):
+        """
+        Validates the components.
+        """
+        if not isinstance(components, dict):
+            raise LogException('Add checkpoint components as a dict!')
+
+        for name, component in components.items():
+            if not callable(getattr(component, 'get_state', None)) or \
+                    not callable(getattr(component, 'set_state', None)):
+                raise LogException('Component {} must have get_state and '
+                                   'set_state methods!'.format(name))
+
+        if interval <= 0:
+            raise LogException('Interval must be positive!')
+
+        self.path = path
+        self.components = components
+        self.interval = interval
+        self.marker = marker
+
+        self.processed = 0
+        self.resume_marker = None
+        self.restored = False
+        self.saved = None
+        self.snapshots = 0
+
+    def restore(self):
+        """
+        Restores the state of the components from the snapshot, if
+        there is one. Returns True if a snapshot was restored.
+
+        Called by log_frame on start. Only restores once, so it can
+        also be called earlier, e.g. to read resume_marker.
+        """
+        if self.restored:
+            return False
+
+        self.restored = True
+        self.saved = time.time()
+
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as snapshot_file:
+            snapshot = pickle.loads(zlib.decompress(snapshot_file.read()))
+
+        if snapshot.get('version') != VERSION:
+            raise LogException('Unknown snapshot version in {}!'.format(
+                self.path))
+
+        states = snapshot['components']
+        for name, component in self.components.items():
+            if name in states:
+                component.set_state(states[name])
+
+        self.processed = snapshot['processed']
+        self.resume_marker = snapshot['marker']
+        return True
+
+    def save(self):
+        """
+        Writes a snapshot of the components, atomically.
+        """
+        snapshot = {
+            'version': VERSION,
+            'time': time.time(),
+            'processed': self.processed,
+            'marker': self.resume_marker,
+            'components': {name: component.get_state()
+                           for name, component in self.components.items()}}
+
+        data = zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        temp_path = '{}.tmp'.format(self.path)
+
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        os.replace(temp_path, self.path)
+        self.saved = time.time()
+        self.snapshots += 1
+
+    def track(self, events):
+        """
+        Yields the events. Once an event is processed, i.e. the next one
+        is asked for, counts it and saves a snapshot if one is due.
+        """
+        for event in events:
+            yield event
+
+            self.processed += 1
+            if self.marker:
+                self.resume_marker = self.marker(event)
+
+            if time.time() - self.saved >= self.interval:
+                self.save()
@@ -0,0 +1,251 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Duplicate suppression stage for the log framework.
+
+Reconnecting, or listening on overlapping targets, can deliver the same
+event more than once. A Deduplicator drops the events whose fingerprint
+was last seen within ttl seconds. Use it as a pre-stage, so the
+duplicates never reach the filters and on_event:
+
+    dedup = Deduplicator(maxsize=100000, ttl=300)
+    log_frame(events, my_filters, on_event=on_event, pre_stages=[dedup])
+    print(dedup.stats())
+
+By default, the fingerprint is a hash of the whole event. Pass your own
+fingerprint function to e.g. use a transaction and event id.
+
+The fingerprints are kept either:
+    - In a bounded LRU set, by default. It holds at most maxsize
+      fingerprints, each for at most ttl seconds since it was last
+      seen. When full, the least recently seen one is evicted
+    - In Bloom filters, with bloom=True. For very large key spaces, the
+      memory used is fixed by capacity and error_rate. Two filters are
+      rotated every ttl seconds, or when the current one is full, so a
+      fingerprint is remembered for between one and two periods. Unlike
+      the LRU set, a Bloom filter may take a new event for a duplicate,
+      with a probability of about error_rate
+"""
+
+import hashlib
+import json
+import math
+import time
+from collections import OrderedDict
+
+from log_exception import LogException
+
+
+def event_fingerprint(event):
+    """
+    Returns a hash of the whole event.
+    """
+    data = json.dumps(event, sort_keys=True, separators=(',', ':'),
+                      default=str)
+    return hashlib.md5(data.encode('utf-8')).digest()
+
+
+class BloomFilter(object):
+    """
+    Bloom filter for capacity items, with a false positive
+    rate of about error_rate when full.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        Sizes the bit array and the number of hashes.
+        """
+        bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+        self.bits = max(bits, 8)
+        self.hashes = max(int(round(self.bits / float(capacity) *
+                                    math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, fingerprint):
+        """
+        Returns the bit positions of a fingerprint, using double hashing.
+        """
+        digest = hashlib.md5(fingerprint).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + index * second) % self.bits
+                for index in range(self.hashes)]
+
+    def __contains__(self, fingerprint):
+        """
+        True if the fingerprint was (probably) added.
+        """
+        return all(self.array[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(fingerprint))
+
+    def add(self, fingerprint):
+        """
+        Adds a fingerprint.
+        """
+        for position in self.positions(fingerprint):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+def as_bytes(fingerprint):
+    """
+    Returns the fingerprint as bytes, for the Bloom filters.
+    """
+    if isinstance(fingerprint, bytes):
+        return fingerprint
+    return repr(fingerprint).encode('utf-8')
+
+
+class Deduplicator(object):
+    """
+    Stage dropping the events already seen.
+        - fingerprint:
+            Function returning the fingerprint of an event, a hashable
+            value. By default, event_fingerprint
+        - maxsize:
+            The maximum number of fingerprints in the LRU set
+        - ttl:
+            The time, in seconds, for which a fingerprint is kept
+        - bloom:
+            If True, keep the fingerprints in Bloom filters
+        - capacity, error_rate:
+            The size of each Bloom filter
+    """
+
+    def __init__(self, fingerprint=event_fingerprint, maxsize=100000,
+                 ttl=300.0, bloom=False, capacity=1000000, error_rate=0.001,
+                 clock=time.time):
+        """
+        Creates an empty set of fingerprints.
+        """
+        if maxsize < 1 or ttl <= 0 or capacity < 1:
+            raise LogException('Maxsize, ttl and capacity must be positive!')
+
+        if not 0 < error_rate < 1:
+            raise LogException('Error rate must be between 0 and 1!')
+
+        self.fingerprint = fingerprint
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.bloom = bloom
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # LRU set: fingerprint -> time last seen, least recent first.
+        self.seen = OrderedDict()
+
+        # Bloom filters: the current one and the previous one.
+        self.current = None
+        self.previous = None
+        self.rotated = None
+        if bloom:
+            self.current = BloomFilter(capacity, error_rate)
+            self.previous = BloomFilter(capacity, error_rate)
+
+    def process(self, event):
+        """
+        Returns None if the event is a duplicate, the event otherwise.
+        """
+        fingerprint = self.fingerprint(event)
+        now = self.clock()
+
+        if self.bloom:
+            duplicate = self.check_bloom(as_bytes(fingerprint), now)
+        else:
+            duplicate = self.check_lru(fingerprint, now)
+
+        if duplicate:
+            self.hits += 1
+            return None
+
+        self.misses += 1
+        return event
+
+    def check_lru(self, fingerprint, now):
+        """
+        Returns True if the fingerprint is in the LRU set, making
+        it the most recent one. Otherwise, adds it and returns False.
+        """
+        # Drop the expired fingerprints, the least recent come first.
+        seen = self.seen
+        while seen:
+            oldest = next(iter(seen))
+            if now - seen[oldest] < self.ttl:
+                break
+            del seen[oldest]
+            self.evictions += 1
+
+        if fingerprint in seen:
+            seen[fingerprint] = now
+            seen.move_to_end(fingerprint)
+            return True
+
+        seen[fingerprint] = now
+        if len(seen) > self.maxsize:
+            seen.popitem(last=False)
+            self.evictions += 1
+
+        return False
+
+    def check_bloom(self, fingerprint, now):
+        """
+        Returns True if the fingerprint is in either Bloom filter.
+        Otherwise, adds it to the current one and returns False.
+        """
+        if self.rotated is None:
+            self.rotated = now
+
+        if now - self.rotated >= self.ttl or \
+                self.current.count >= self.capacity:
+            # The previous filter is dropped, forgetting its fingerprints.
+            self.evictions += self.previous.count
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotated = now
+
+        if fingerprint in self.current or fingerprint in self.previous:
+            return True
+
+        self.current.add(fingerprint)
+        return False
+
+    def get_state(self):
+        """
+        Returns the fingerprints and counters, for
+        checkpointing. See checkpoint.py.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'seen': self.seen,
+            'current': self.current,
+            'previous': self.previous,
+            'rotated': self.rotated}
+
+    def set_state(self, state):
+        """
+        Restores the fingerprints and counters returned by get_state.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def stats(self):
+        """
+        Returns the hit (duplicates dropped), miss
+        and eviction counters, and the set size.
+        """
+        size = self.current.count if self.bloom else len(self.seen)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': size}
@@ -0,0 +1,250 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Worker pool dispatching matched events to the on_event function.
+
+By default, log_frame calls on_event inline, so a slow on_event function
+stalls reading the events. With a WorkerPool, the log framework puts the
+matched events in a bounded queue, and on_event is called by a pool of
+worker threads:
+
+    pool = WorkerPool(workers=4, maxsize=1000, policy=DROP_OLDEST,
+                      key=lambda event: event['attr']['svc'])
+    log_frame(events, my_filters, on_event=on_event, dispatcher=pool)
+
+When the queue is full, the policy decides what happens:
+    - BLOCK - Reading the events waits until there is room in the queue
+    - DROP_OLDEST - The oldest queued event is dropped
+    - DROP_NEWEST - The new event is dropped
+
+If key is specified, events with the same key are always handled by the
+same worker, in the order they were matched. Each worker then has its
+own queue of maxsize events. Otherwise, all workers share one queue.
+
+When the events stop, the queued events are handled before on_exit
+is called. Use stats() for the queue depth and the number of drops.
+
+NOTE, on_event is called from a worker thread. It must not close the
+events generator while log_frame is reading it. E.g. stop_services in
+main.py is only safe to use without a dispatcher.
+"""
+
+import threading
+from collections import deque
+
+from log_exception import LogException
+
+# Policies applied when the queue is full.
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+# Returned by BoundedQueue.get once the queue is closed and empty.
+END = object()
+
+
+class BoundedQueue(object):
+    """
+    Thread-safe FIFO queue of at most maxsize items. The
+    policy decides what put does when the queue is full.
+    """
+
+    def __init__(self, maxsize, policy):
+        """
+        Creates an empty, open queue.
+        """
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        """
+        Adds an item to the queue. Returns the dropped item, the new one
+        or the oldest one, if the queue was full. Otherwise, returns END.
+        """
+        with self.condition:
+            dropped = END
+
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    return item
+
+                if self.policy == DROP_OLDEST:
+                    dropped = self.items.popleft()
+
+                else:
+                    # Stop waiting once closed, e.g. by a ListenReader.
+                    while len(self.items) >= self.maxsize and \
+                            not self.closed:
+                        self.condition.wait()
+
+            self.items.append(item)
+            self.condition.notify_all()
+            return dropped
+
+    def get(self):
+        """
+        Removes and returns the oldest item, waiting for one if the queue
+        is empty. Returns END once the queue is closed and empty.
+        """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+
+            if not self.items:
+                return END
+
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        """
+        Closes the queue. The items already queued can still be got.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        """
+        Number of queued items.
+        """
+        return len(self.items)
+
+
+class WorkerPool(object):
+    """
+    Calls on_event from a pool of worker threads.
+        - workers:
+            The number of worker threads
+        - maxsize:
+            The maximum number of queued events, per queue
+        - policy:
+            BLOCK, DROP_OLDEST or DROP_NEWEST. See above
+        - key:
+            Optional function returning the key of an event.
+            Events with the same key are handled in order
+    """
+
+    def __init__(self, workers=4, maxsize=1000, policy=BLOCK, key=None):
+        """
+        The on_event function is bound by the log framework. See start.
+        """
+        if workers < 1 or maxsize < 1:
+            raise LogException('Workers and maxsize must be >= 1!')
+
+        if policy not in POLICIES:
+            raise LogException('Policy must be one of {}!'.format(POLICIES))
+
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        self.queues = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counters = {}
+        self._on_event_plan = None
+
+    def start(self, on_event_plan):
+        """
+        Starts the workers calling the compiled on_event function.
+        """
+        if self.threads:
+            raise LogException('Worker pool already started!')
+
+        self._on_event_plan = on_event_plan
+        self.counters = {
+            'submitted': 0,
+            'handled': 0,
+            'errors': 0,
+            'dropped_oldest': 0,
+            'dropped_newest': 0,
+            'max_depth': 0}
+
+        queue_count = self.workers if self.key else 1
+        self.queues = [BoundedQueue(self.maxsize, self.policy)
+                       for _ in range(queue_count)]
+
+        for index in range(self.workers):
+            event_queue = self.queues[index % queue_count]
+            thread = threading.Thread(target=self._work, args=(event_queue,),
+                                      name='log_frame_worker_{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _count(self, counter, increment=1):
+        """
+        Increments a counter.
+        """
+        with self.lock:
+            self.counters[counter] += increment
+
+    def _work(self, event_queue):
+        """
+        Worker thread calling on_event on the queued events.
+        """
+        while True:
+            event = event_queue.get()
+            if event is END:
+                return
+
+            try:
+                self._on_event_plan(event)
+                self._count('handled')
+
+            except Exception as error:
+                print('Warning, on_event function error: {}'.format(error))
+                self._count('errors')
+
+    def submit(self, event):
+        """
+        Queues the event for the workers.
+        """
+        if self.key:
+            index = hash(self.key(event)) % len(self.queues)
+        else:
+            index = 0
+
+        event_queue = self.queues[index]
+        dropped = event_queue.put(event)
+
+        with self.lock:
+            self.counters['submitted'] += 1
+            if dropped is event:
+                self.counters['dropped_newest'] += 1
+            elif dropped is not END:
+                self.counters['dropped_oldest'] += 1
+
+            depth = len(event_queue)
+            if depth > self.counters['max_depth']:
+                self.counters['max_depth'] = depth
+
+    def shutdown(self):
+        """
+        Handles the queued events and stops the workers.
+        """
+        for event_queue in self.queues:
+            event_queue.close()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def stats(self):
+        """
+        Returns the counters of the pool, and the current
+        number of queued events as depth.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats['depth'] = sum(len(event_queue) for event_queue in self.queues)
+        return stats
@@ -0,0 +1,192 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Compact SPARKL events.
+
+The events sent by sparkl('listen') are nested dicts, see
+sample_filters.py. Collectors keeping many events in memory can wrap
+them in Event objects instead, which:
+    - Use __slots__ instead of a dict per event
+    - Intern the tag, the attribute names and the name and svc values,
+      so events of the same operation share these strings
+    - Can pack their content into compact JSON, decoded again on the
+      first access to it
+    - Look up fields by name, through the shared field index of the
+      event, see field_index.py
+
+An Event is a read-only mapping with the tag, attr and content keys, so
+filters reading event['attr']['name'] or scanning event['content'] work
+unchanged:
+
+    log_frame(wrap_events(sparkl('listen')), my_filters,
+              on_event=(collect, (), {}))
+
+    def collect(event):
+        event.pack()
+        collected.append(event)
+
+Use to_dict to get the event as nested dicts again. The JSON written by
+the sinks, captures and spill queues holds Events as nested dicts.
+"""
+
+import json
+
+from field_index import field_attr
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2, where intern is a builtin.
+    pass
+
+# The keys of events.
+KEYS = ('tag', 'attr', 'content')
+
+# Attributes whose values are interned, being shared by many events.
+INTERNED = ('name', 'svc')
+
+
+def intern_attr(attr):
+    """
+    Returns the attributes, with the names and
+    the INTERNED values interned.
+    """
+    interned = {}
+    for name, value in attr.items():
+        if name in INTERNED and isinstance(value, str):
+            value = intern(value)
+        interned[intern(name)] = value
+    return interned
+
+
+def intern_content(content):
+    """
+    Returns a copy of the content, with the names of the fields
+    interned. The fields of the content are left unchanged.
+    """
+    interned = []
+    for field in content:
+        attr = field.get('attr')
+        if attr and isinstance(attr.get('name'), str):
+            field = dict(field, attr=dict(attr, name=intern(attr['name'])))
+        interned.append(field)
+    return interned
+
+
+class Event(Mapping):
+    """
+    Compact, read-only view of a SPARKL event.
+    """
+    __slots__ = ('tag', 'attr', '_content', '_packed')
+
+    def __init__(self, tag, attr, content):
+        """
+        Creates the event. See from_dict.
+        """
+        self.tag = intern(tag) if isinstance(tag, str) else tag
+        self.attr = intern_attr(attr or {})
+        self._content = intern_content(content or [])
+        self._packed = None
+
+    @classmethod
+    def from_dict(cls, event):
+        """
+        Returns the Event of an event as nested dicts.
+        """
+        return cls(event.get('tag'), event.get('attr'), event.get('content'))
+
+    @property
+    def content(self):
+        """
+        The fields of the event, decoded if packed.
+        """
+        if self._content is None:
+            self._content = intern_content(
+                json.loads(self._packed.decode('utf-8')))
+            self._packed = None
+        return self._content
+
+    def pack(self):
+        """
+        Packs the content into compact JSON, freeing the
+        field dicts until the content is used again.
+        """
+        if self._content is not None:
+            self._packed = json.dumps(
+                self._content, separators=(',', ':')).encode('utf-8')
+            self._content = None
+        return self
+
+    @property
+    def packed(self):
+        """
+        True if the content is packed.
+        """
+        return self._content is None
+
+    def field(self, field_name, default=None):
+        """
+        Returns the attributes of the named field, or default.
+        """
+        attr = field_attr(self, field_name)
+        return default if attr is None else attr
+
+    def __getitem__(self, key):
+        """
+        Returns the tag, attr or content of the event.
+        """
+        if key == 'tag':
+            return self.tag
+        if key == 'attr':
+            return self.attr
+        if key == 'content':
+            return self.content
+        raise KeyError(key)
+
+    def __iter__(self):
+        """
+        Iterates the keys of the event.
+        """
+        return iter(KEYS)
+
+    def __len__(self):
+        """
+        Returns the number of keys.
+        """
+        return len(KEYS)
+
+    def to_dict(self):
+        """
+        Returns the event as nested dicts.
+        """
+        return {'tag': self.tag, 'attr': dict(self.attr),
+                'content': self.content}
+
+    def __repr__(self):
+        """
+        Shows the event like the nested dicts would.
+        """
+        return repr(self.to_dict())
+
+
+def json_default(value):
+    """
+    Default function of json.dumps, encoding Events as nested dicts.
+    """
+    if isinstance(value, Event):
+        return value.to_dict()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def wrap_events(events):
+    """
+    Yields the events as Event objects.
+    """
+    for event in events:
+        yield Event.from_dict(event)
@@ -0,0 +1,105 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Lazy per-event index of the fields carried by SPARKL events.
+
+Filters looking up fields by name can share a single index, instead
+of each filter scanning event['content'] again:
+
+    def filter_big_n(event, default=True):
+        return get_field_index(event).value('n') > 1000
+
+The index is built on the first lookup and kept until the log framework
+moves on to the next event. Any filter asking for the index of the same
+event gets the already built one.
+"""
+
+import threading
+
+# The index of the event currently being filtered, one per thread.
+CURRENT = threading.local()
+
+
+class FieldIndex(object):
+    """
+    Maps the field names of an event to their attributes. The
+    content of the event is scanned once, on the first lookup.
+
+    If a field name appears more than once, the first field wins.
+    """
+
+    def __init__(self, event):
+        """
+        Keeps the event. The index itself is built on first use.
+        """
+        self.event = event
+        self._attrs = None
+
+    def attrs(self):
+        """
+        Returns the dict of field name -> field attributes.
+        """
+        if self._attrs is None:
+            attrs = {}
+            for field in self.event['content']:
+                attr = field['attr']
+                attrs.setdefault(attr['name'], attr)
+            self._attrs = attrs
+
+        return self._attrs
+
+    def attr(self, field_name):
+        """
+        Returns the attributes of the named field.
+        Raises KeyError if the event has no such field.
+        """
+        return self.attrs()[field_name]
+
+    def value(self, field_name):
+        """
+        Returns the value of the named field.
+        Raises KeyError if the event has no such field, or
+        if the field has no value (e.g. FLAG fields).
+        """
+        return self.attrs()[field_name]['value']
+
+    def __contains__(self, field_name):
+        """
+        True if the event carries the named field.
+        """
+        return field_name in self.attrs()
+
+
+def get_field_index(event):
+    """
+    Returns the field index of the event, creating
+    it if this is the first request for this event.
+    """
+    index = getattr(CURRENT, 'index', None)
+
+    if index is None or index.event is not event:
+        index = FieldIndex(event)
+        CURRENT.index = index
+
+    return index
+
+
+def field_attr(event, field_name):
+    """
+    Returns the attributes of the named field, looked up in the
+    field index of the event, or None if the event has no such
+    field or its content is malformed.
+    """
+    try:
+        return get_field_index(event).attrs().get(field_name)
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def release_field_index():
+    """
+    Drops the index of the current event. Called by the
+    log framework once an event has been filtered.
+    """
+    CURRENT.index = None
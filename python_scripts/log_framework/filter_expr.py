@@ -0,0 +1,241 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Compiles filter expressions into a single filter function.
+
+A filter expression is a boolean expression over the event, such as:
+
+    tag == "solicit" and name == "CheckPrime" and 1 < field("n") < 14
+
+The expression can use:
+    - tag - The tag of the event, e.g. solicit, notify
+    - name - The name of the event, i.e. event['attr']['name']
+    - svc - The service of the event, i.e. event['attr']['svc']
+    - field("n") - The value of the field named n
+    - has_field("n") - True if the event carries a field named n
+    - String and number literals, tuples and lists
+    - Comparisons (chained ones too), in, not in, and, or, not
+
+The expression is compiled once into a function, so the whole filter
+costs a single call per event. Use compile_filter to get a filter tuple
+that can be added to the filters of log_frame.
+
+Like the sample filters, the compiled filter returns the default value
+if evaluating the expression fails due to an exception. The default
+applies to each operand of and/or on its own, as it would to each filter
+of a list of sample filters. E.g. for
+    name == "CheckPrime" and tag == "solicit"
+an event without a name gets the default for the first operand, but is
+still filtered out if it is not a solicit.
+"""
+
+import ast
+
+from log_exception import LogException
+from field_index import get_field_index
+from sample_filters import DEFAULT, print_warning
+
+# Name of the compiled filter function, as printed by the log framework.
+FILTER_NAME = 'filter_expr'
+
+# Event properties available in expressions, and the code accessing them.
+EVENT_NAMES = {
+    'tag': "event['tag']",
+    'name': "event['attr']['name']",
+    'svc': "event['attr']['svc']"}
+
+# Functions available in expressions, and the code calling them.
+EVENT_FUNCTIONS = {
+    'field': '_field(event, {})',
+    'has_field': '_has_field(event, {})'}
+
+BOOL_OPS = {
+    ast.And: ' and ',
+    ast.Or: ' or '}
+
+COMPARE_OPS = {
+    ast.Eq: ' == ',
+    ast.NotEq: ' != ',
+    ast.Lt: ' < ',
+    ast.LtE: ' <= ',
+    ast.Gt: ' > ',
+    ast.GtE: ' >= ',
+    ast.In: ' in ',
+    ast.NotIn: ' not in '}
+
+UNARY_OPS = {
+    ast.Not: 'not ',
+    ast.USub: '-'}
+
+# Literal node types of older Pythons, and their value attribute.
+LEGACY_LITERALS = {
+    'Str': 's',
+    'Num': 'n',
+    'NameConstant': 'value'}
+
+# Template of a function evaluating an operand of and/or, or the whole
+# expression if it has no and/or, returning the default on errors.
+GUARDED_TEMPLATE = '''
+def {name}(event):
+    try:
+        return bool({code})
+    except Exception as error:
+        _print_warning(error, {label!r})
+        return _default
+'''
+
+# Template of the compiled filter function, combining the operands.
+FILTER_TEMPLATE = '''
+def {name}(event):
+    return bool({code})
+'''
+
+
+def _field(event, field_name):
+    """
+    Returns the value of the first field named field_name.
+    Raises KeyError if the event has no such field.
+    """
+    return get_field_index(event).value(field_name)
+
+
+def _has_field(event, field_name):
+    """
+    Returns True if the event carries a field named field_name.
+    """
+    return field_name in get_field_index(event)
+
+
+def constant_value(node):
+    """
+    Returns the value of a literal node. Raises LogException
+    if the node is not a string, number, boolean or None literal.
+    """
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        value = node.value
+
+    # Older Pythons have a node type for each kind of literal.
+    elif type(node).__name__ in LEGACY_LITERALS:
+        value = getattr(node, LEGACY_LITERALS[type(node).__name__])
+    elif isinstance(node, ast.Name) and node.id in ('True', 'False', 'None'):
+        value = {'True': True, 'False': False, 'None': None}[node.id]
+
+    else:
+        raise LogException('Unsupported expression: {}'.format(
+            type(node).__name__))
+
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise LogException('Unsupported literal: {!r}'.format(value))
+
+    return value
+
+
+def generate_code(node):
+    """
+    Generates the Python code of an expression node. Only the
+    nodes listed in the module documentation are accepted,
+    anything else raises a LogException.
+    """
+    if isinstance(node, ast.BoolOp):
+        code = BOOL_OPS[type(node.op)].join(
+            generate_code(value) for value in node.values)
+        return '({})'.format(code)
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPS:
+        return '({}{})'.format(UNARY_OPS[type(node.op)],
+                               generate_code(node.operand))
+
+    if isinstance(node, ast.Compare):
+        code = generate_code(node.left)
+        for operator, comparator in zip(node.ops, node.comparators):
+            if type(operator) not in COMPARE_OPS:
+                raise LogException('Unsupported comparison: {}'.format(
+                    type(operator).__name__))
+            code += COMPARE_OPS[type(operator)] + generate_code(comparator)
+        return '({})'.format(code)
+
+    if isinstance(node, ast.Name) and node.id in EVENT_NAMES:
+        return EVENT_NAMES[node.id]
+
+    if isinstance(node, ast.Call):
+        fun_name = getattr(node.func, 'id', None)
+        if fun_name not in EVENT_FUNCTIONS:
+            raise LogException('Unknown function: {}'.format(fun_name))
+
+        if node.keywords or len(node.args) != 1:
+            raise LogException('{} takes a single field name'.format(
+                fun_name))
+
+        field_name = constant_value(node.args[0])
+        return EVENT_FUNCTIONS[fun_name].format(repr(field_name))
+
+    if isinstance(node, (ast.Tuple, ast.List)):
+        items = [generate_code(item) for item in node.elts]
+        return '({},)'.format(', '.join(items)) if items else '()'
+
+    return repr(constant_value(node))
+
+
+def generate_guarded(node, operands):
+    """
+    Generates the code of the and/or operators of an expression node,
+    calling a guarded function for each of their operands. Adds the
+    code of the operands to the operands list.
+    """
+    if isinstance(node, ast.BoolOp):
+        code = BOOL_OPS[type(node.op)].join(
+            generate_guarded(value, operands) for value in node.values)
+        return '({})'.format(code)
+
+    operands.append(generate_code(node))
+    return '_operand_{}(event)'.format(len(operands) - 1)
+
+
+def generate_source(tree):
+    """
+    Generates the source of the filter function, and of the guarded
+    function of each operand of and/or, if any.
+    """
+    if not isinstance(tree.body, ast.BoolOp):
+        return GUARDED_TEMPLATE.format(name=FILTER_NAME, label=FILTER_NAME,
+                                       code=generate_code(tree.body))
+
+    operands = []
+    source = FILTER_TEMPLATE.format(name=FILTER_NAME,
+                                    code=generate_guarded(tree.body, operands))
+
+    for index, code in enumerate(operands):
+        source += GUARDED_TEMPLATE.format(name='_operand_{}'.format(index),
+                                          label=FILTER_NAME, code=code)
+    return source
+
+
+def compile_filter(expression, default=DEFAULT):
+    """
+    Compiles the filter expression into a filter tuple,
+    such as ( filter_expr, (), {} ).
+
+    The compiled function returns True if the event matches the
+    expression, False otherwise. On errors, it returns the default value.
+
+    Raises LogException if the expression is invalid.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as error:
+        raise LogException('Invalid filter expression: {}'.format(error))
+
+    source = generate_source(tree)
+
+    namespace = {
+        '_field': _field,
+        '_has_field': _has_field,
+        '_print_warning': print_warning,
+        '_default': default}
+    code = compile(source, '<filter: {}>'.format(expression), 'exec')
+    exec(code, namespace)  # pylint: disable=exec-used
+
+    filter_fun = namespace[FILTER_NAME]
+    filter_fun.expression = expression
+    return filter_fun, (), {}
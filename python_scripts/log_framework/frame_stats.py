@@ -0,0 +1,295 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Instrumentation of the log framework.
+
+With a FrameStats instance, the log framework counts for each filter
+and for the on_event function:
+    - The number of calls
+    - The number of events let through (passes) and filtered out (rejects)
+    - The number of errors, i.e. exceptions swallowed by the filters
+      (see generic_filter_fun) or raised by on_event
+    - The time spent in the function: cumulative, p50 and p99
+
+    stats = FrameStats()
+    serve_prometheus(stats, port=9464)
+    log_frame(events, my_filters, on_event=on_event, stats=stats)
+
+    # From anywhere, e.g. another thread
+    print(stats.snapshot())
+
+The statistics can also be exported as Prometheus text, over HTTP on a
+local port. See serve_prometheus.
+
+The latencies are kept in a histogram of fixed buckets, doubling from
+1 microsecond. The p50 and p99 values are the upper bounds of the buckets
+holding them.
+
+NOTE, in batch mode, the vectorized filters are not instrumented.
+"""
+
+import threading
+from timeit import default_timer
+
+from sample_filters import warning_count
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds of the latency buckets, in seconds: 1us, 2us, ... ~16s.
+BUCKETS = [1e-6 * 2 ** power for power in range(25)]
+
+# Name of the on_event entry.
+ON_EVENT = 'on_event'
+
+
+class FunctionStats(object):
+    """
+    Counters and latency histogram of one function.
+    """
+
+    def __init__(self, position, name):
+        """
+        Position is the index of the filter in the filter list,
+        or None for the on_event function.
+        """
+        self.position = position
+        self.name = name
+        self.is_filter = position is not None
+        self.calls = 0
+        self.passes = 0
+        self.rejects = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, result, errors):
+        """
+        Records a call taking elapsed seconds.
+        """
+        bucket = 0
+        while bucket < len(BUCKETS) and elapsed > BUCKETS[bucket]:
+            bucket += 1
+
+        with self.lock:
+            self.calls += 1
+            self.seconds += elapsed
+            self.buckets[bucket] += 1
+            self.errors += errors
+
+            # Only filters let events through or filter them out.
+            if self.is_filter and result:
+                self.passes += 1
+            elif self.is_filter:
+                self.rejects += 1
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given
+        fraction of calls, e.g. 0.99 for p99. None if never called.
+        """
+        with self.lock:
+            buckets = list(self.buckets)
+
+        target = fraction * sum(buckets)
+        cumulative = 0
+
+        for bucket, count in enumerate(buckets):
+            cumulative += count
+            if count and cumulative >= target:
+                return BUCKETS[bucket] if bucket < len(BUCKETS) \
+                    else float('inf')
+
+        return None
+
+    def snapshot(self):
+        """
+        Returns the statistics as a dict.
+        """
+        with self.lock:
+            stats = {
+                'position': self.position,
+                'name': self.name,
+                'calls': self.calls,
+                'passes': self.passes,
+                'rejects': self.rejects,
+                'errors': self.errors,
+                'seconds': self.seconds}
+
+        stats['p50'] = self.quantile(0.5)
+        stats['p99'] = self.quantile(0.99)
+        return stats
+
+
+def timed(plan, function_stats):
+    """
+    Wraps a compiled function, recording each call in function_stats.
+    """
+    def timed_plan(event):
+        """
+        Calls the function, recording its latency, result and errors.
+        """
+        warnings = warning_count()
+        start = default_timer()
+        result = None
+        raised = 1
+
+        try:
+            result = plan(event)
+            raised = 0
+            return result
+
+        finally:
+            errors = raised + warning_count() - warnings
+            function_stats.record(default_timer() - start, result, errors)
+
+    return timed_plan
+
+
+class FrameStats(object):
+    """
+    Statistics of a log_frame run. Readable at any time,
+    from any thread. See snapshot and prometheus.
+    """
+
+    def __init__(self):
+        """
+        The functions are bound by the log framework. See instrument.
+        """
+        self.events = 0
+        self.functions = []
+
+    def instrument(self, filter_funs, filter_plans, on_event, on_event_plan):
+        """
+        Wraps the compiled filter and on_event functions, and
+        returns the wrapped ones. Resets all statistics.
+        """
+        self.events = 0
+        self.functions = []
+        timed_filters = []
+
+        for position, (filter_fun, plan) in enumerate(
+                zip(filter_funs, filter_plans)):
+            function_stats = FunctionStats(position, filter_fun[0].__name__)
+            self.functions.append(function_stats)
+            timed_filters.append(timed(plan, function_stats))
+
+        timed_on_event = None
+        if on_event_plan:
+            function_stats = FunctionStats(None, ON_EVENT)
+            self.functions.append(function_stats)
+            timed_on_event = timed(on_event_plan, function_stats)
+
+        return timed_filters, timed_on_event
+
+    def count_events(self, events):
+        """
+        Yields the events, counting them.
+        """
+        for event in events:
+            self.events += 1
+            yield event
+
+    def snapshot(self):
+        """
+        Returns the number of events read and the statistics
+        of each filter and of on_event, as a dict.
+        """
+        return {
+            'events': self.events,
+            'functions': [function_stats.snapshot()
+                          for function_stats in self.functions]}
+
+    def prometheus(self):
+        """
+        Returns the statistics in the Prometheus text format.
+        """
+        lines = [
+            '# HELP log_frame_events_total Events read by the log framework.',
+            '# TYPE log_frame_events_total counter',
+            'log_frame_events_total {}'.format(self.events)]
+
+        counters = [
+            ('calls', 'Calls of the function.'),
+            ('passes', 'Events let through by the function.'),
+            ('rejects', 'Events filtered out by the function.'),
+            ('errors', 'Errors in the function.')]
+        snapshots = [(function_stats, function_stats.snapshot())
+                     for function_stats in self.functions]
+
+        for counter, description in counters:
+            metric = 'log_frame_{}_total'.format(counter)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+            for function_stats, snapshot in snapshots:
+                lines.append('{}{{{}}} {}'.format(
+                    metric, labels(function_stats), snapshot[counter]))
+
+        metric = 'log_frame_seconds'
+        lines.append('# HELP {} Time spent in the function.'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+
+        for function_stats, snapshot in snapshots:
+            with function_stats.lock:
+                buckets = list(function_stats.buckets)
+
+            cumulative = 0
+            bounds = ['{:g}'.format(bound) for bound in BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, buckets):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, labels(function_stats), bound, cumulative))
+
+            lines.append('{}_sum{{{}}} {}'.format(
+                metric, labels(function_stats), snapshot['seconds']))
+            lines.append('{}_count{{{}}} {}'.format(
+                metric, labels(function_stats), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+def labels(function_stats):
+    """
+    Returns the Prometheus labels of a function.
+    """
+    position = function_stats.position
+    return 'function="{}",position="{}"'.format(
+        function_stats.name, '' if position is None else position)
+
+
+def serve_prometheus(stats, port=9464, host='127.0.0.1'):
+    """
+    Serves the statistics in the Prometheus text format over HTTP,
+    from a daemon thread. Returns the server, stop it with shutdown().
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """
+        Answers all GET requests with the statistics.
+        """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            Sends the statistics.
+            """
+            body = stats.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            """
+            Keeps the requests out of the log framework output.
+            """
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='log_frame_metrics')
+    thread.daemon = True
+    thread.start()
+    return server
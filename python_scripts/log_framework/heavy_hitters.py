@@ -0,0 +1,248 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Heavy hitter detection stage for the log framework.
+
+A HeavyHitters stage finds the most frequent keys, e.g. operations,
+services or field values, in fixed memory, however many distinct keys
+there are. Counting each key in a dict grows with the number of keys,
+e.g. one per file path of FileSync Put events. Instead, the counts are
+estimated with a count-min sketch, and only the top keys are kept:
+
+    by_name = HeavyHitters(key=name_key, top=10)
+    by_path = HeavyHitters(key=field_key('path'), top=20, half_life=600)
+    log_frame(events, my_filters, stages=[by_name, by_path])
+
+    print(by_name.top_keys())
+
+The count-min sketch has depth rows of width counters. A key's count is
+never underestimated, and overestimated by at most e / width of all
+events, with a probability of 1 - e ** -depth. See error_bound.
+
+With half_life, old events fade: the weight of an event halves every
+half_life seconds, so the top keys follow the recent traffic.
+"""
+
+import hashlib
+import heapq
+import math
+import time
+from itertools import count
+
+from field_index import field_attr
+from log_exception import LogException
+from windows import name_key
+
+
+def field_key(field_name):
+    """
+    Returns a key function grouping events by the value of a field.
+    """
+    def key(event):
+        """
+        Returns the value of the field, or None.
+        """
+        attr = field_attr(event, field_name)
+        return attr.get('value') if attr else None
+
+    return key
+
+
+class CountMinSketch(object):
+    """
+    Estimates the counts of keys, in depth rows of width counters.
+    """
+
+    def __init__(self, width, depth):
+        """
+        Creates the counters.
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [[0.0] * width for _ in range(depth)]
+
+    def positions(self, key):
+        """
+        Returns the counter of the key in each row.
+        """
+        digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, weight):
+        """
+        Adds weight to the key, and returns its estimated count.
+        """
+        estimate = None
+        for row, position in zip(self.rows, self.positions(key)):
+            row[position] += weight
+            if estimate is None or row[position] < estimate:
+                estimate = row[position]
+        return estimate
+
+    def estimate(self, key):
+        """
+        Returns the estimated count of the key.
+        """
+        return min(row[position]
+                   for row, position in zip(self.rows, self.positions(key)))
+
+    def scale(self, factor):
+        """
+        Multiplies all counts by factor.
+        """
+        for row in self.rows:
+            for position in range(self.width):
+                row[position] *= factor
+
+
+class HeavyHitters(object):
+    """
+    Stage tracking the most frequent keys.
+        - key:
+            Function returning the key of an event. By default, name_key.
+            Events with a None key are not counted
+        - top:
+            The number of top keys kept
+        - width, depth:
+            The size of the count-min sketch
+        - half_life:
+            Optional time, in seconds, in which the weight of events halves
+        - passthrough:
+            If False, the events are not passed on to on_event
+    """
+
+    def __init__(self, key=name_key, top=10, width=2048, depth=4,
+                 half_life=None, passthrough=True, clock=time.time):
+        """
+        Creates an empty sketch.
+        """
+        if top < 1 or width < 1 or depth < 1:
+            raise LogException('Top, width and depth must be positive!')
+
+        if half_life is not None and half_life <= 0:
+            raise LogException('Half life must be positive!')
+
+        self.key = key
+        self.top = top
+        self.sketch = CountMinSketch(width, depth)
+        self.half_life = half_life
+        self.passthrough = passthrough
+        self.clock = clock
+
+        # Weights are kept relative to the time the sketch was last
+        # rescaled, so fading only rescales the counts now and then.
+        self.epoch = clock()
+        self.total = 0.0
+        # key -> estimated count, of the top keys
+        self.counts = {}
+        # Heap of (count, number, key), outdated counts being skipped.
+        self.heap = []
+        self.numbers = count()
+
+    def weight(self, now):
+        """
+        Returns the weight of an event at now, relative to the
+        epoch, rescaling the counts when the weight gets large.
+        """
+        if not self.half_life:
+            return 1.0
+
+        elapsed = now - self.epoch
+        if elapsed > 20 * self.half_life:
+            self.rescale(now)
+            elapsed = 0.0
+
+        return 2 ** (elapsed / self.half_life)
+
+    def rescale(self, now):
+        """
+        Moves the epoch to now, scaling all counts down.
+        """
+        factor = 2 ** (-(now - self.epoch) / self.half_life)
+        self.sketch.scale(factor)
+        self.total *= factor
+        self.counts = {key: estimate * factor
+                       for key, estimate in self.counts.items()}
+        self.rebuild_heap()
+        self.epoch = now
+
+    def process(self, event):
+        """
+        Counts the key of the event, and updates the top keys.
+        """
+        key = self.key(event)
+        if key is not None:
+            weight = self.weight(self.clock())
+            self.total += weight
+            estimate = self.sketch.add(key, weight)
+
+            if key in self.counts or len(self.counts) < self.top:
+                self.counts[key] = estimate
+                self.push(key, estimate)
+
+            elif estimate > self.minimum():
+                self.counts[key] = estimate
+                self.push(key, estimate)
+                self.drop_minimum()
+
+        return event if self.passthrough else None
+
+    def push(self, key, estimate):
+        """
+        Adds the count of a top key to the heap, compacting the heap
+        when it holds too many outdated counts.
+        """
+        heapq.heappush(self.heap, (estimate, next(self.numbers), key))
+
+        if len(self.heap) > 4 * self.top:
+            self.rebuild_heap()
+
+    def rebuild_heap(self):
+        """
+        Rebuilds the heap from the counts of the top keys.
+        """
+        self.heap = [(estimate, next(self.numbers), key)
+                     for key, estimate in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def minimum(self):
+        """
+        Returns the lowest count of the top keys, skipping
+        the outdated counts in the heap.
+        """
+        while self.heap[0][0] != self.counts.get(self.heap[0][2]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def drop_minimum(self):
+        """
+        Drops the top key with the lowest count.
+        """
+        self.minimum()
+        key = heapq.heappop(self.heap)[2]
+        del self.counts[key]
+
+    def top_keys(self):
+        """
+        Returns the top keys, as (key, estimated count, share of all
+        events) tuples, most frequent first. With half_life, the counts
+        are the faded weights as of the latest event.
+        """
+        factor = 2 ** (-(self.clock() - self.epoch) / self.half_life) \
+            if self.half_life else 1.0
+        total = self.total or 1.0
+
+        return [(key, estimate * factor, estimate / total)
+                for key, estimate in sorted(self.counts.items(),
+                                            key=lambda item: -item[1])]
+
+    def error_bound(self):
+        """
+        Returns the most the counts are overestimated
+        by, with a probability of 1 - e ** -depth.
+        """
+        return math.e / self.sketch.width * self.total
@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Hot reloading of filters for the log framework.
+
+Changing the filters of a running listener would mean restarting it,
+closing the sparkl('listen') connection and losing the events in the
+meantime. With a FilterReloader, log_frame swaps its filters and on_event
+function while it runs instead:
+
+    reloader = FilterReloader('my_filters.py')
+    log_frame(events, reloader.filter_funs, on_event=reloader.on_event,
+              reloader=reloader)
+
+The watched file is either:
+    - A Python module, setting FILTERS to a list of filters and
+      optionally ON_EVENT to an on_event function, as in main.py
+    - A text file of filter expressions, one per line, all of which
+      events must match. See filter_expr.py. Lines starting with #
+      are comments
+
+When the file changes, it is loaded and validated with validate_input.
+If it is valid, log_frame swaps the filters between two events, so the
+event being processed finishes under the old filters. Otherwise, the
+error is printed and the old filters are kept.
+
+New filters can also be set from code, e.g. a control socket thread,
+with reloader.update(filter_funs, on_event).
+
+NOTE, ON_EVENT is only swapped if log_frame was started with an
+on_event function.
+"""
+
+from __future__ import print_function
+
+import os
+import runpy
+import threading
+import time
+
+from filter_expr import compile_filter
+from log_exception import LogException
+from log_framework import validate_input
+
+
+def load_filters(path):
+    """
+    Returns the filters and the on_event function, or
+    None, set by the module or expression file at path.
+    """
+    if path.endswith('.py'):
+        module = runpy.run_path(path)
+        if 'FILTERS' not in module:
+            raise LogException('{} does not set FILTERS!'.format(path))
+        return module['FILTERS'], module.get('ON_EVENT')
+
+    with open(path) as expression_file:
+        lines = [line.strip() for line in expression_file]
+
+    return [compile_filter(line) for line in lines
+            if line and not line.startswith('#')], None
+
+
+class FilterReloader(object):
+    """
+    Watches a filter file, and hands new filters to log_frame.
+        - path:
+            Optional path of the watched file
+        - check_every:
+            The time, in seconds, between two checks of the file
+    """
+
+    def __init__(self, path=None, check_every=1.0):
+        """
+        Loads the filters of the file, if any. Raises
+        LogException if they are not valid.
+        """
+        self.path = path
+        self.check_every = check_every
+        self.lock = threading.Lock()
+        self.pending = None
+        self.reloads = 0
+        self.failures = 0
+
+        self.filter_funs = []
+        self.on_event = None
+        self.mtime = None
+        self.checked = time.time()
+
+        if path:
+            self.mtime = os.stat(path).st_mtime
+            self.filter_funs, self.on_event = load_filters(path)
+            validate_input(self.filter_funs, self.on_event, None)
+
+    def update(self, filter_funs, on_event=None):
+        """
+        Validates new filters and on_event function, and
+        queues them for log_frame to swap between two events.
+        """
+        validate_input(filter_funs, on_event, None)
+
+        with self.lock:
+            self.pending = (filter_funs, on_event)
+
+    def check_file(self):
+        """
+        Loads the file, if it changed since last loaded.
+        Prints the error and keeps the filters if not valid.
+        """
+        self.checked = time.time()
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+
+            self.mtime = mtime
+            self.update(*load_filters(self.path))
+
+        except Exception as error:
+            self.failures += 1
+            print('Warning, reloading {} failed: {}'.format(self.path, error))
+
+    def poll(self):
+        """
+        Returns the new (filter_funs, on_event) to swap in,
+        or None. Checks the file if a check is due.
+        """
+        if self.path and time.time() - self.checked >= self.check_every:
+            self.check_file()
+
+        if self.pending is None:
+            return None
+
+        with self.lock:
+            pending, self.pending = self.pending, None
+
+        self.filter_funs, self.on_event = pending
+        self.reloads += 1
+        return pending
+
+    def watch(self, events, swap):
+        """
+        Yields the events, calling swap with the new filters
+        and on_event function, if any, before each event.
+        """
+        for event in events:
+            pending = self.poll()
+            if pending:
+                swap(*pending)
+            yield event
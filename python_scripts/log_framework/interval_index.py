@@ -0,0 +1,306 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Range rules for the log framework.
+
+A range rule is the equivalent of filter_field_values: it matches the
+events whose field_name field has a value between min_val and max_val,
+exclusive. With thousands of rules, e.g. per-customer thresholds, listing
+each as a filter checks every rule on every event. RangeRules keeps the
+rules of each field in an interval tree instead. Finding the k rules
+matching a value among n rules visits O(log n) nodes per matched rule,
+and O(log n) nodes if none match:
+
+    rules = RangeRules(on_match=(alert, (), {}))
+    rules.add('speed', 0, 50, rule='green')
+    rules.add('speed', 50, 80, rule='amber')
+    red = rules.add('speed', 80, 200, rule='red')
+    rules.remove(red)
+
+    # As a single filter, letting through the events matching any rule.
+    log_frame(events, [(filter_range_rules, (rules,), {})], on_event=...)
+
+    # Or as a stage, also calling on_match with the matched rules.
+    log_frame(events, my_filters, stages=[rules])
+
+Like the on_match function of a PatternMatcher, the on_match function
+receives the match, then its own arguments. The match looks like:
+
+    {'event': {...}, 'rules': ['amber', ...]}
+
+Rules can be added and removed at any time, in O(log n).
+"""
+
+import random
+from itertools import count
+
+from field_index import get_field_index, release_field_index
+from log_exception import LogException
+from log_framework import validate_fun, compile_function
+from sample_filters import generic_filter_fun, DEFAULT
+
+
+class IntervalNode(object):
+    """
+    Node of an interval tree, ordered by the low end of the
+    intervals, and keeping the highest high end below it.
+    """
+    __slots__ = ('key', 'high', 'rule', 'priority', 'max_high',
+                 'left', 'right')
+
+    def __init__(self, key, high, rule, priority):
+        """
+        Creates a leaf node. The key is (low, rule number).
+        """
+        self.key = key
+        self.high = high
+        self.rule = rule
+        self.priority = priority
+        self.max_high = high
+        self.left = None
+        self.right = None
+
+    def update(self):
+        """
+        Recomputes the highest high end below the node.
+        """
+        max_high = self.high
+        for child in (self.left, self.right):
+            if child is not None and child.max_high > max_high:
+                max_high = child.max_high
+        self.max_high = max_high
+
+
+def rotate_right(node):
+    """
+    Rotates the left child of the node up, and returns it.
+    """
+    left = node.left
+    node.left = left.right
+    left.right = node
+    node.update()
+    left.update()
+    return left
+
+
+def rotate_left(node):
+    """
+    Rotates the right child of the node up, and returns it.
+    """
+    right = node.right
+    node.right = right.left
+    right.left = node
+    node.update()
+    right.update()
+    return right
+
+
+class IntervalTree(object):
+    """
+    Interval tree over open intervals, kept balanced as a treap.
+    """
+
+    def __init__(self, seed=None):
+        """
+        Creates an empty tree.
+        """
+        self.root = None
+        self.size = 0
+        self.random = random.Random(seed).random
+
+    def insert(self, key, high, rule):
+        """
+        Adds the interval (key[0], high), holding the rule.
+        """
+        self.root = self._insert(self.root, IntervalNode(
+            key, high, rule, self.random()))
+        self.size += 1
+
+    def _insert(self, node, new_node):
+        """
+        Inserts the new node below node, and returns the new subtree.
+        """
+        if node is None:
+            return new_node
+
+        if new_node.key < node.key:
+            node.left = self._insert(node.left, new_node)
+            if node.left.priority > node.priority:
+                return rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new_node)
+            if node.right.priority > node.priority:
+                return rotate_left(node)
+
+        node.update()
+        return node
+
+    def delete(self, key):
+        """
+        Removes the interval with the given key.
+        """
+        self.root = self._delete(self.root, key)
+        self.size -= 1
+
+    def _delete(self, node, key):
+        """
+        Deletes the key below node, and returns the new subtree.
+        """
+        if node is None:
+            raise LogException('No such interval: {}'.format(key))
+
+        if key < node.key:
+            node.left = self._delete(node.left, key)
+        elif node.key < key:
+            node.right = self._delete(node.right, key)
+
+        # Rotate the node down until it is a leaf.
+        elif node.left is None:
+            return node.right
+        elif node.right is None:
+            return node.left
+        elif node.left.priority > node.right.priority:
+            node = rotate_right(node)
+            node.right = self._delete(node.right, key)
+        else:
+            node = rotate_left(node)
+            node.left = self._delete(node.left, key)
+
+        node.update()
+        return node
+
+    def stab(self, value):
+        """
+        Returns the rules of the intervals holding value.
+        """
+        matched = []
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+
+            # Skip the subtrees ending at or before the value.
+            if node is None or node.max_high <= value:
+                continue
+
+            stack.append(node.left)
+
+            # The right subtree only starts later, if the node does.
+            if node.key[0] < value:
+                if value < node.high:
+                    matched.append(node.rule)
+                stack.append(node.right)
+
+        return matched
+
+
+class RangeRules(object):
+    """
+    Range rules over the fields of events, usable as
+    a stage or, with filter_range_rules, as a filter.
+        - on_match:
+            Optional function called by the stage with the match of
+            each event, as (fun, args, kwargs). See above
+    """
+
+    def __init__(self, on_match=None):
+        """
+        Creates the rules, without any rule.
+        """
+        if on_match:
+            validate_fun(on_match)
+
+        self.on_match = on_match
+        self._on_match_plan = compile_function(on_match) if on_match \
+            else None
+        self.numbers = count()
+
+        # field name -> interval tree
+        self.trees = {}
+
+    def add(self, field_name, min_val, max_val, rule=None):
+        """
+        Adds a rule matching min_val < value < max_val, and returns
+        a handle for removing it. By default, the rule returned for
+        matching events is (field_name, min_val, max_val).
+        """
+        if not min_val < max_val:
+            raise LogException('Min value must be below max value!')
+
+        if rule is None:
+            rule = (field_name, min_val, max_val)
+
+        handle = (field_name, (min_val, next(self.numbers)))
+        tree = self.trees.setdefault(field_name, IntervalTree())
+        tree.insert(handle[1], max_val, rule)
+        return handle
+
+    def remove(self, handle):
+        """
+        Removes the rule returned by add.
+        """
+        field_name, key = handle
+        tree = self.trees.get(field_name)
+        if tree is None:
+            raise LogException('No such rule: {}'.format(handle))
+
+        tree.delete(key)
+        if not tree.size:
+            del self.trees[field_name]
+
+    def rules_for(self, field_name, value):
+        """
+        Returns the rules of the field matching the value.
+        """
+        tree = self.trees.get(field_name)
+        if tree is None:
+            return []
+        return tree.stab(value)
+
+    def match(self, event):
+        """
+        Returns the rules matching the fields of the event.
+        """
+        matched = []
+        attrs = get_field_index(event).attrs()
+
+        for field_name, tree in self.trees.items():
+            attr = attrs.get(field_name)
+            if attr is None:
+                continue
+
+            value = attr.get('value')
+            if isinstance(value, (int, float)) and \
+                    not isinstance(value, bool):
+                matched.extend(tree.stab(value))
+
+        return matched
+
+    def process(self, event):
+        """
+        Passes the event on if it matches any rule,
+        calling on_match with the matched rules.
+        """
+        try:
+            matched = self.match(event)
+        finally:
+            release_field_index()
+
+        if not matched:
+            return None
+
+        if self._on_match_plan:
+            self._on_match_plan({'event': event, 'rules': matched})
+
+        return event
+
+
+@generic_filter_fun
+def filter_range_rules(event, rules, default=DEFAULT):
+    """
+    Returns True if the event matches any of the range rules.
+
+    Returns the default value on errors.
+    """
+    return bool(rules.match(event))
@@ -0,0 +1,328 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Reader thread for the events generator of sparkl('listen').
+
+By default, log_frame reads the events on the thread running the filters
+and on_event, so the event stream is not read while they lag behind. The
+server then buffers the events, and may drop the connection. A
+ListenReader reads the events on its own thread into a bounded buffer,
+from which log_frame takes them:
+
+    reader = ListenReader(sparkl('listen'), maxsize=10000,
+                          policy=DROP_OLDEST)
+    log_frame(reader, my_filters, on_event=on_event)
+    print(reader.stats())
+
+When the buffer is full, the policy decides what happens, as for the
+WorkerPool in dispatch.py:
+    - BLOCK - Reading the events waits until there is room in the
+      buffer. The reader is stalled, see stats
+    - DROP_OLDEST - The oldest buffered event is dropped
+    - DROP_NEWEST - The new event is dropped
+
+If reading the events raises an error, log_frame gets the buffered
+events first, then the error.
+
+NOTE, the events generator runs on the reader thread, so it cannot be
+closed from on_event. Use reader.close() instead, e.g. in stop_services
+in main.py. The reader thread then stops on the next event it reads.
+
+A BatchReader also reads the events on its own thread, but hands them
+over in batches of up to size events. A batch that is not full is handed
+over interval seconds after its first event, even if the events generator
+blocks waiting for the next event. Batch mode and log_frame_sharded use it:
+
+    for batch in BatchReader(events, size=1000, interval=0.05):
+        handle(batch)
+"""
+
+import threading
+import time
+from timeit import default_timer
+
+from dispatch import BoundedQueue, BLOCK, POLICIES, END
+from log_exception import LogException
+
+
+class ListenReader(object):
+    """
+    Reads events on a thread into a bounded buffer.
+        - events:
+            The events generator, e.g. returned by sparkl('listen')
+        - maxsize:
+            The maximum number of buffered events
+        - policy:
+            BLOCK, DROP_OLDEST or DROP_NEWEST. See above
+    """
+
+    def __init__(self, events, maxsize=10000, policy=BLOCK):
+        """
+        The reader thread starts when the events are iterated.
+        """
+        if maxsize < 1:
+            raise LogException('Maxsize must be >= 1!')
+
+        if policy not in POLICIES:
+            raise LogException('Policy must be one of {}!'.format(POLICIES))
+
+        self.events = events
+        self.buffer = BoundedQueue(maxsize, policy)
+        self.closed = False
+        self.error = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {
+            'read': 0,
+            'dropped_oldest': 0,
+            'dropped_newest': 0,
+            'max_depth': 0,
+            'stalls': 0,
+            'stall_seconds': 0.0}
+
+    def start(self):
+        """
+        Starts the reader thread.
+        """
+        if self.thread:
+            raise LogException('Listen reader already started!')
+
+        self.thread = threading.Thread(target=self._read,
+                                       name='log_frame_listen_reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        """
+        Reader thread putting the events in the buffer.
+        """
+        try:
+            for event in self.events:
+                if self.closed:
+                    break
+                self._put(event)
+
+        except Exception as error:
+            self.error = error
+
+        finally:
+            close = getattr(self.events, 'close', None)
+            if close:
+                close()
+            self.buffer.close()
+
+    def _put(self, event):
+        """
+        Puts an event in the buffer, counting stalls and drops.
+        """
+        buffer = self.buffer
+        stalled = buffer.policy == BLOCK and len(buffer) >= buffer.maxsize
+        started = time.time()
+        dropped = buffer.put(event)
+
+        with self.lock:
+            self.counters['read'] += 1
+            if stalled:
+                self.counters['stalls'] += 1
+                self.counters['stall_seconds'] += time.time() - started
+
+            if dropped is event:
+                self.counters['dropped_newest'] += 1
+            elif dropped is not END:
+                self.counters['dropped_oldest'] += 1
+
+            depth = len(buffer)
+            if depth > self.counters['max_depth']:
+                self.counters['max_depth'] = depth
+
+    def __iter__(self):
+        """
+        Yields the buffered events, starting the reader
+        thread. Raises the error of the reader, if any.
+        """
+        if not self.thread:
+            self.start()
+
+        try:
+            while not self.closed:
+                event = self.buffer.get()
+                if event is END:
+                    break
+                yield event
+
+            if self.error and not self.closed:
+                raise self.error
+
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops yielding events. The buffered events are dropped.
+        """
+        self.closed = True
+        self.buffer.close()
+
+    def stats(self):
+        """
+        Returns the counters of the reader, and the current
+        number of buffered events as depth. The high-water
+        mark of the buffer is max_depth.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats['depth'] = len(self.buffer)
+        return stats
+
+
+class BatchReader(object):
+    """
+    Reads events on a thread into batches.
+        - events:
+            The events generator, e.g. returned by sparkl('listen')
+        - size:
+            The maximum number of events in a batch
+        - interval:
+            The maximum time, in seconds, between the first event of
+            a batch and handing it over
+    """
+
+    def __init__(self, events, size=1000, interval=0.05):
+        """
+        The reader thread starts when the batches are iterated.
+        """
+        if size < 1:
+            raise LogException('Batch size must be >= 1!')
+
+        self.events = events
+        self.size = size
+        self.interval = interval
+        self.batch = []
+        self.started = None
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def start(self):
+        """
+        Starts the reader thread.
+        """
+        if self.thread:
+            raise LogException('Batch reader already started!')
+
+        self.thread = threading.Thread(target=self._read,
+                                       name='log_frame_batch_reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        """
+        Reader thread adding the events to the current batch. Once
+        the batch is full, waits until it is handed over.
+
+        Appending to and slicing a list are atomic, so the events are
+        added without taking the lock, which is only taken to start the
+        interval of a batch and when it is full.
+        """
+        batch = self.batch
+
+        try:
+            for event in self.events:
+                if self.closed:
+                    break
+
+                batch.append(event)
+                if len(batch) == 1 or len(batch) >= self.size:
+                    self._added()
+
+        except Exception as error:
+            self.error = error
+
+        finally:
+            close = getattr(self.events, 'close', None)
+            if close:
+                close()
+
+            with self.lock:
+                self.done = True
+                self.changed.notify()
+
+    def _added(self):
+        """
+        Starts the interval of a new batch, or waits
+        until a full batch is handed over.
+        """
+        with self.lock:
+            if self.started is None:
+                self.started = default_timer()
+            self.changed.notify()
+
+            while len(self.batch) >= self.size and not self.closed:
+                self.changed.wait()
+
+    def _take(self):
+        """
+        Waits until the current batch is full, interval seconds old,
+        or the last one. Returns it, or None once all events are read.
+        """
+        batch = self.batch
+
+        with self.lock:
+            while True:
+                if batch:
+                    if self.started is None:
+                        self.started = default_timer()
+
+                    waited = default_timer() - self.started
+                    if len(batch) >= self.size or self.done or \
+                            waited >= self.interval:
+                        taken = batch[:]
+                        del batch[:len(taken)]
+
+                        # Events added meanwhile start the next batch.
+                        self.started = default_timer() if batch else None
+                        self.changed.notify()
+                        return taken
+
+                    self.changed.wait(self.interval - waited)
+
+                elif self.done or self.closed:
+                    return None
+
+                else:
+                    self.changed.wait()
+
+    def __iter__(self):
+        """
+        Yields the batches, starting the reader thread. Raises the
+        error of the reader, if any, after the last batch.
+        """
+        if not self.thread:
+            self.start()
+
+        try:
+            while not self.closed:
+                batch = self._take()
+                if batch is None:
+                    break
+                yield batch
+
+            if self.error and not self.closed:
+                raise self.error
+
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops yielding batches. The events read but not
+        handed over yet are dropped.
+        """
+        with self.lock:
+            self.closed = True
+            self.changed.notify()
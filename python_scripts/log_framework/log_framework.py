@@ -13,20 +13,52 @@ Use the log_frame function to specify:
       the close method on the events generator
 """
 
+from __future__ import print_function
+
 from log_exception import LogException
+from field_index import release_field_index
+
+
+def compile_function(fun_args_tuple):
+    """
+    Compiles a (fun, args, kwargs) tuple into an invocation plan.
 
+    The plan is a callable taking the event as its only argument. It
+    calls fun with the event as the first positional argument, followed
+    by the positional and keyword arguments bound at compile time.
 
-def add_event_to_args(fun_arg_tuple, event):
+    The plan never rebuilds or extends the argument tuple,
+    so it can be called on any number of events.
     """
-    Adds the event to the positional arguments
-    of the function.
+    fun, args, kwargs = fun_args_tuple
+
+    # Nothing to bind, the function itself is the plan.
+    if not args and not kwargs:
+        return fun
+
+    if not kwargs:
+        def positional_plan(event):
+            """
+            Calls fun with the event and the bound positional args.
+            """
+            return fun(event, *args)
+        return positional_plan
+
+    def plan(event):
+        """
+        Calls fun with the event and the bound args and kwargs.
+        """
+        return fun(event, *args, **kwargs)
+    return plan
 
-    Event is always inserted as the first positional
-    argument.
+
+def compile_functions(fun_args_tuples):
+    """
+    Compiles a list of (fun, args, kwargs) tuples into
+    a list of invocation plans.
     """
-    fun, arg, kwargs = fun_arg_tuple
-    arg = (event, ) + arg
-    return fun, arg, kwargs
+    return [compile_function(fun_args_tuple)
+            for fun_args_tuple in fun_args_tuples]
 
 
 def process_function(fun_args_tuple):
@@ -62,30 +94,136 @@ def print_filters_info(filter_tuples):
         print(get_fun_name(filter_tuple))
 
 
+def print_frame_info(filter_funs, on_event):
+    """
+    Prints the name of all filters and
+    of the on_event function, if any.
+    """
+    if filter_funs:
+        # Print the name of each specified filter function.
+        print_filters_info(filter_funs)
+
+    # Unless there isn't any
+    else:
+        print('No filters applied.')
+
+    # Print the name of the specified on_event function, if any.
+    if on_event:
+        print('On matched event call:')
+        print(get_fun_name(on_event))
+
+
 def apply_filters(event, constraints):
     """
     If any of the supplied filter functions
     returns False, return nothing.
     Otherwise, return the event.
+
+    The filter functions are (fun, args, kwargs) tuples. To filter
+    many events, compile them once and use apply_filter_plans.
+    """
+    return apply_filter_plans(event, compile_functions(constraints))
+
+
+def apply_filter_plans(event, filter_plans):
     """
+    Same as apply_filters, but takes the filter plans,
+    i.e. the compiled filter functions. See compile_function.
 
-    for constraint in constraints:
+    The filters share the field index of the event, which is
+    dropped once the event is filtered. See field_index.py.
+    """
 
-        # Add the event to all filter functions as first
-        # positional argument
-        constraint = add_event_to_args(constraint, event)
+    try:
+        for filter_plan in filter_plans:
 
-        # Filters return True(success) or False(filtered out)
-        result = process_function(constraint)
+            # Filters return True(success) or False(filtered out).
+            # The plan inserts the event as first positional argument.
+            # If any of the filters returns False, the event is filtered out
+            if not filter_plan(event):
+                return False
 
-        # If any of the filters returns False, the event is filtered out
-        if not result:
-            return False
+    finally:
+        release_field_index()
 
     # Only return event if all filter conditions succeed
     return event
 
 
+def filter_events(events, filter_plans, filter_order=None, swappable=False):
+    """
+    Yields the events getting through all filters.
+
+    If filter_order is specified, the filters are applied in the
+    order it maintains. See adaptive_order.py.
+
+    If swappable is True, the filter plans may be replaced in the list
+    between two events, e.g. by a FilterReloader. See hot_reload.py.
+    """
+    if not filter_plans and not swappable:
+        for event in events:
+            yield event
+
+    elif filter_order:
+        for event in events:
+            if filter_order.apply(event):
+                yield event
+
+    else:
+        for event in events:
+            if apply_filter_plans(event, filter_plans):
+                yield event
+
+
+def apply_stages(events, stages):
+    """
+    Yields the events passed on by all stages.
+
+    Each stage is an object with a process method, which
+    takes an event and returns either:
+        - An event to pass on to the next stage, usually the same one
+        - None, if the event stops at this stage
+    """
+    for event in events:
+        for stage in stages:
+            event = stage.process(event)
+            if event is None:
+                break
+        else:
+            yield event
+
+
+def close_stages(stages):
+    """
+    Calls the close method of the stages having one, e.g.
+    to flush the data they hold. Closes all stages even if
+    one of them fails, then raises the first error.
+    """
+    error = None
+
+    for stage in stages:
+        try:
+            if hasattr(stage, 'close'):
+                stage.close()
+        except Exception as stage_error:
+            error = error or stage_error
+
+    if error:
+        raise error
+
+
+def validate_stages(stages):
+    """
+    Validates the stages.
+    """
+    if not isinstance(stages, list):
+        raise LogException('Add stages as a list!')
+
+    for stage in stages:
+        if not callable(getattr(stage, 'process', None)):
+            raise LogException('Stages must have a process method!')
+
+
 def validate_fun(fun_arg_tuple):
     """
     Validates the function inputs such as filter functions
@@ -129,7 +267,178 @@ def validate_input(filter_funs, on_event, on_exit):
             validate_fun(function)
 
 
-def log_frame(events, filter_funs, on_event=None, on_exit=None):
+def make_swap(filter_plans, on_event_plans, on_event, stats):
+    """
+    Returns the function swapping in new filters and on_event function,
+    replacing the plans in the filter_plans and on_event_plans lists.
+
+    The on_event function is only swapped if there was one to start with.
+    """
+    current_on_event = [on_event]
+
+    def swap(new_filter_funs, new_on_event):
+        """
+        Compiles and swaps in the new functions.
+        """
+        if on_event and new_on_event:
+            current_on_event[0] = new_on_event
+        active_on_event = current_on_event[0]
+
+        print('Reloading filters.')
+        print_frame_info(new_filter_funs, active_on_event)
+
+        new_plans = compile_functions(new_filter_funs)
+        new_on_event_plan = compile_function(active_on_event) \
+            if active_on_event else None
+
+        # Instrument the new functions, keeping the event count.
+        if stats:
+            events = stats.events
+            new_plans, new_on_event_plan = stats.instrument(
+                new_filter_funs, new_plans, active_on_event,
+                new_on_event_plan)
+            stats.events = events
+
+        filter_plans[:] = new_plans
+        on_event_plans[0] = new_on_event_plan
+
+    return swap
+
+
+def validate_options(on_event, options):
+    """
+    Validates the optional arguments of log_frame,
+    and that they can be used together.
+    """
+    for name in ('stages', 'pre_stages'):
+        if options[name]:
+            validate_stages(options[name])
+
+    if options['sink'] and on_event:
+        raise LogException('Use either a sink or an on_event function!')
+
+    if options['filter_order'] and options['batch']:
+        raise LogException('Adaptive filter order and batch mode '
+                           'cannot be used together!')
+
+    # In batch mode, the events are read on another thread, which
+    # would save the snapshots while the stages change their state.
+    if options['checkpoint'] and options['batch']:
+        raise LogException('Checkpoints and batch mode '
+                           'cannot be used together!')
+
+    if options['reloader'] and (options['filter_order'] or
+                                options['batch'] or options['dispatcher']):
+        raise LogException('Filter reloading cannot be used with adaptive '
+                           'filter order, batch mode or a worker pool!')
+
+
+def watch_reloads(events, reloader, filter_plans, on_event_plan, on_event,
+                  stats):
+    """
+    Returns the events, swapping in the reloaded filters and on_event
+    function between them, and the plan calling the latest on_event.
+    """
+    on_event_plans = [on_event_plan]
+    events = reloader.watch(events, make_swap(
+        filter_plans, on_event_plans, on_event, stats))
+
+    if not on_event_plan:
+        return events, None
+
+    def reloadable_plan(event):
+        """
+        Calls the latest on_event function.
+        """
+        return on_event_plans[0](event)
+
+    return events, reloadable_plan
+
+
+def build_pipeline(events, filter_funs, on_event, options):
+    """
+    Compiles the filter and on_event functions, and chains the events
+    through the options of log_frame: stats, checkpoint, reloader,
+    pre-stages, filters, stages and dispatcher, in this order.
+
+    Returns the matched events, and the plan to call on each of them.
+    """
+    stats = options['stats']
+    checkpoint = options['checkpoint']
+    filter_order = options['filter_order']
+    batch = options['batch']
+    dispatcher = options['dispatcher']
+
+    # Compile the filter and on_event functions once. The plans bind their
+    # arguments up front and only take the event on each call.
+    filter_plans = compile_functions(filter_funs)
+    on_event_plan = compile_function(on_event) if on_event else None
+
+    # Instrument the compiled functions, if asked to.
+    if stats:
+        filter_plans, on_event_plan = stats.instrument(
+            filter_funs, filter_plans, on_event, on_event_plan)
+        events = stats.count_events(events)
+
+    # Restore the saved state, and count the events processed from there.
+    if checkpoint:
+        checkpoint.restore()
+        events = checkpoint.track(events)
+
+    # Swap in the reloaded filters and on_event function between events.
+    if options['reloader']:
+        events, on_event_plan = watch_reloads(
+            events, options['reloader'], filter_plans, on_event_plan,
+            on_event, stats)
+
+    # Send the events through the pre-stages, if any, before the filters.
+    if options['pre_stages']:
+        events = apply_stages(events, options['pre_stages'])
+
+    # Send the events through all specified filters, either one by one,
+    # in the adaptive order or in batches.
+    if filter_order and filter_plans:
+        filter_order.bind(filter_funs, filter_plans)
+
+    if batch and filter_plans:
+        batch.bind(filter_funs, filter_plans)
+        filtered_events = batch.filtered_events(events)
+    else:
+        filtered_events = filter_events(events, filter_plans, filter_order,
+                                        swappable=bool(options['reloader']))
+
+    # Send the matched events through the stages, if any.
+    if options['stages']:
+        filtered_events = apply_stages(filtered_events, options['stages'])
+
+    # Hand the matched events to the worker pool, if there is one.
+    if dispatcher and on_event_plan:
+        dispatcher.start(on_event_plan)
+        on_event_plan = dispatcher.submit
+
+    return filtered_events, on_event_plan
+
+
+def close_pipeline(on_event, options):
+    """
+    Lets the workers handle the queued events first. Then saves
+    the checkpoint, before closing the stages drops their state,
+    and lets the stages and the sink flush the data they hold.
+    """
+    if options['dispatcher'] and on_event:
+        options['dispatcher'].shutdown()
+
+    if options['checkpoint']:
+        options['checkpoint'].save()
+
+    close_stages((options['pre_stages'] or []) + (options['stages'] or []) +
+                 ([options['sink']] if options['sink'] else []))
+
+
+def log_frame(events, filter_funs, on_event=None, on_exit=None,
+              filter_order=None, batch=None, dispatcher=None, stats=None,
+              stages=None, pre_stages=None, sink=None, checkpoint=None,
+              reloader=None):
     """
     Events is the generator instance returned on calling sparkl('listen').
 
@@ -145,54 +454,86 @@ def log_frame(events, filter_funs, on_event=None, on_exit=None):
         - The positional arguments (another tuple)
         - The keyword arguments (a dictionary)
     E.g. (my_fun, (1,2), {'foo':'bar'}) or (my_empty_fun, (), {})
+
+    Optionally, filter_order is an AdaptiveOrder instance, which reorders
+    the filters at runtime by their pass rate and cost.
+    See adaptive_order.py.
+
+    Optionally, batch is a BatchMode instance, which filters the events
+    in batches using NumPy. See batch_filters.py.
+
+    Optionally, dispatcher is a WorkerPool instance, which calls on_event
+    from a pool of worker threads. See dispatch.py.
+
+    Optionally, stats is a FrameStats instance, which counts the calls,
+    results, errors and latency of each filter and of on_event.
+    See frame_stats.py.
+
+    Optionally, stages is a list of stages, e.g. a WindowAggregator (see
+    windows.py). The events getting through the filters go through each
+    stage before on_event. See apply_stages. When the events stop, the
+    stages are closed before on_exit is called.
+
+    Optionally, pre_stages is a list of stages, e.g. a Deduplicator (see
+    dedup.py), which the events go through before the filters.
+
+    Optionally, sink is used instead of print when there is no on_event
+    function, e.g. a JsonLinesSink writing the matched events to a file
+    in batches (see sinks.py). The sink is closed before on_exit is called.
+
+    Optionally, checkpoint is a Checkpointer instance, which restores the
+    state of the stages on start, and saves it periodically and once the
+    events stop, before the stages are closed. See checkpoint.py.
+
+    Optionally, reloader is a FilterReloader instance, which swaps in new
+    filters and on_event function between two events, e.g. when a filter
+    file changes. See hot_reload.py.
     """
 
+    options = {
+        'filter_order': filter_order,
+        'batch': batch,
+        'dispatcher': dispatcher,
+        'stats': stats,
+        'stages': stages,
+        'pre_stages': pre_stages,
+        'sink': sink,
+        'checkpoint': checkpoint,
+        'reloader': reloader}
+
     # Collect functions and validate them. Validation failure raises
     # an exception crashing out
     validate_input(filter_funs, on_event, on_exit)
+    validate_options(on_event, options)
 
-    # Print the name of all specified filters.
-    if filter_funs:
-        # Print the name of each specified filter function.
-        print_filters_info(filter_funs)
+    # Print the name of all specified filters and on_event function.
+    print_frame_info(filter_funs, on_event)
 
-    # Unless there isn't any
-    else:
-        print('No filters applied.')
+    filtered_events, on_event_plan = build_pipeline(
+        events, filter_funs, on_event, options)
 
-    # Print the name of the specified on_event function, if any.
-    if on_event:
-        print('On matched event call:')
-        print(get_fun_name(on_event))
+    # If there is no on_event function, send the events getting
+    # through the filters to the sink, if any. Or just print them.
+    if not on_event_plan:
+        on_event_plan = sink.write if sink else print
 
     # Process all events.
     try:
-        for event in events:
-
-            if filter_funs:
-                # Send the event through all specified filters.
-                filtered_event = apply_filters(event, filter_funs)
-            else:
-                # Unless there are no filters.
-                filtered_event = event
+        for filtered_event in filtered_events:
 
-            # If the event succeeds and there is an on_event function, call it.
-            if filtered_event and on_event:
-
-                # Add event to on_event function
-                on_event = add_event_to_args(on_event, event)
-                # And call on event function
-                process_function(on_event)
-
-            # If there is no on_event function, just print all events
-            # that get through the filters.
-            elif filtered_event:
-                print(filtered_event)
+            # Call the on_event function with the event inserted
+            on_event_plan(filtered_event)
 
     # When the loop ends - either because of an interruption caused by the user
     # or the on-event function, execute the on-exit function, if there is one.
     finally:
         print('Exiting...')
-        if on_exit:
-            print('Calling exit function: {}'.format(get_fun_name(on_exit)))
-            process_function(on_exit)
+
+        try:
+            close_pipeline(on_event, options)
+
+        finally:
+            if on_exit:
+                print('Calling exit function: {}'.format(
+                    get_fun_name(on_exit)))
+                process_function(on_exit)
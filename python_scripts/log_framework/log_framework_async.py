@@ -0,0 +1,179 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+asyncio version of the SPARKL logging framework. Needs Python 3.6+.
+
+Use the log_frame_async coroutine the same way as log_frame, but with
+an async iterator of events. The filter, on_event and on_exit functions
+can be either plain functions or coroutine functions:
+
+    async def post_to_slack(event, webhook):
+        ...
+
+    await log_frame_async(events, my_filters,
+                          on_event=(post_to_slack, (webhook,), {}),
+                          concurrency=10)
+
+Up to concurrency on_event calls run at the same time. When the limit is
+reached, no more events are read until an on_event call finishes.
+
+Use async_events to turn the generator returned by sparkl('listen')
+into an async iterator. The generator is read in a worker thread, so
+it does not block the event loop.
+"""
+
+import asyncio
+import inspect
+
+from field_index import release_field_index
+from log_exception import LogException
+from log_framework import (validate_input, print_frame_info, get_fun_name,
+                           compile_function, compile_functions,
+                           process_function)
+
+
+async def async_events(events, executor=None):
+    """
+    Yields the events of a plain generator, e.g. the one returned by
+    sparkl('listen'), reading it in the executor of the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    end = object()
+
+    while True:
+        event = await loop.run_in_executor(executor, next, events, end)
+        if event is end:
+            return
+        yield event
+
+
+async def maybe_await(result):
+    """
+    Awaits the result of a function call if it is awaitable,
+    e.g. the call of a coroutine function.
+    """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def apply_filters_async(event, filter_plans):
+    """
+    Same as apply_filter_plans, but awaits the coroutine filters.
+    """
+    try:
+        for filter_plan in filter_plans:
+            if not await maybe_await(filter_plan(event)):
+                return False
+
+    finally:
+        release_field_index()
+
+    return event
+
+
+async def call_on_event(on_event_plan, event, semaphore, in_executor):
+    """
+    Calls the on_event function and frees its concurrency slot.
+
+    If in_executor is True, on_event is a plain function and
+    it is called in the default executor of the event loop.
+    """
+    try:
+        if in_executor:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, on_event_plan, event)
+        else:
+            await maybe_await(on_event_plan(event))
+
+    finally:
+        semaphore.release()
+
+
+async def log_frame_async(events, filter_funs, on_event=None, on_exit=None,
+                          concurrency=1, in_executor=False):
+    """
+    Events is an async iterator of SPARKL events. See async_events.
+
+    Same as log_frame, but the filter, on_event and on_exit functions
+    can be coroutine functions.
+
+    Up to concurrency on_event calls are run at the same time.
+
+    If in_executor is True and on_event is a plain function, on_event is
+    called in the default executor of the event loop. Use it for on_event
+    functions blocking on e.g. network calls.
+
+    The on_exit function is called even if log_frame_async is cancelled.
+    If the events end normally, it is called after all on_event calls
+    finish. Otherwise, the running on_event calls are cancelled first.
+
+    If an on_event call fails, log_frame_async stops and raises its error.
+    """
+    validate_input(filter_funs, on_event, on_exit)
+
+    if concurrency < 1:
+        raise LogException('Concurrency must be >= 1!')
+
+    print_frame_info(filter_funs, on_event)
+
+    filter_plans = compile_functions(filter_funs)
+    on_event_plan = compile_function(on_event) if on_event else None
+
+    # Only plain on_event functions are sent to the default executor.
+    in_executor = bool(in_executor and on_event and
+                       not asyncio.iscoroutinefunction(on_event[0]))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+    errors = []
+
+    def on_done(task):
+        """
+        Forgets the finished on_event call, keeping its error if any.
+        """
+        pending.discard(task)
+        if not task.cancelled() and task.exception():
+            errors.append(task.exception())
+
+    try:
+        async for event in events:
+
+            if errors:
+                raise errors[0]
+
+            if filter_plans and \
+                    not await apply_filters_async(event, filter_plans):
+                continue
+
+            # If there is no on_event function, just print all events
+            # that get through the filters.
+            if not on_event_plan:
+                print(event)
+                continue
+
+            # Wait for a free slot before starting the on_event call.
+            await semaphore.acquire()
+            task = asyncio.ensure_future(
+                call_on_event(on_event_plan, event, semaphore, in_executor))
+            pending.add(task)
+            task.add_done_callback(on_done)
+
+        # Let the running on_event calls finish.
+        if pending:
+            await asyncio.wait(list(pending))
+        if errors:
+            raise errors[0]
+
+    finally:
+        # Stopped early, e.g. cancelled. Cancel the running on_event calls.
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(list(pending))
+
+        print('Exiting...')
+        if on_exit:
+            print('Calling exit function: {}'.format(get_fun_name(on_exit)))
+            await maybe_await(process_function(on_exit))
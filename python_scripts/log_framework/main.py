@@ -25,20 +25,16 @@ The sample also introduces:
 
 from __future__ import print_function
 
-import sys
 from sparkl_cli.main import sparkl, CliException
 
 from log_framework import log_frame
+from spill_queue import SpillQueue
+from listen_reader import ListenReader
 from log_exception import LogException
+from filter_expr import compile_filter
 from sample_filters import (filter_tag, filter_field, filter_name,
                             filter_field_values)
 
-# Import queue without upsetting either Py2 or Py3.
-if sys.version_info.major == 3:
-    import queue as queue_mod
-else:
-    import Queue as queue_mod
-
 # Specify user and alias
 FILTER_ALIAS = 'test_filter'
 FILTER_USER = 'demo@sparkl.com'
@@ -59,6 +55,13 @@ SAMPLE_FILTERS = [
     # And where the value of n is between 1 and 14
     (filter_field_values, ('n',), {'min_val': 1, 'max_val': 14})]
 
+# The same filters as a single filter expression. The expression is
+# compiled once into one filter function, which can be used instead of
+# SAMPLE_FILTERS. E.g. main(FILTER_USER, SAMPLE_FILTER_EXPR)
+SAMPLE_FILTER_EXPR = [
+    compile_filter('tag == "solicit" and name == "CheckPrime" and '
+                   'has_field("n") and 1 < field("n") < 14')]
+
 
 def logout(alias='default'):
     """
@@ -74,7 +77,7 @@ def stop_services(event, path, events, event_queue, alias='default'):
 
     Prints the specified event, stops all
     running SPARKL services in path and
-    closes the event generator.
+    stops reading the events.
 
     NOTE: The 'event' argument is inserted by the log framework.
     The function is sent to the framework thus:
@@ -111,15 +114,20 @@ def login(user, alias):
 
 def read_queue(event_queue):
     """
-    Tries to retrieve events from a queue.
-    Immediately stops if the queue is empty.
+    Retrieves all events collected in the queue,
+    then removes the files it spilled to.
     """
     try:
-        event = event_queue.get(block=False)
-        print(event)
+        collected = 0
+        for event in event_queue.drain():
+            print(event)
+            collected += 1
+
+        if not collected:
+            print('No events collected.')
 
-    except queue_mod.Empty:
-        print('No events collected.')
+    finally:
+        event_queue.close()
 
 
 def main(user, filters, alias='default'):
@@ -148,11 +156,13 @@ def main(user, filters, alias='default'):
             print(error)
         return
 
-    # If login was successful, evens generator is returned by login
-    events = result
+    # If login was successful, evens generator is returned by login.
+    # It is read on its own thread, so slow filters do not stall the stream.
+    events = ListenReader(result, maxsize=10000)
 
-    # Create a queue shared between the main process and the on-event function
-    event_queue = queue_mod.Queue()
+    # Create a queue shared between the main process and the on-event function.
+    # It spills to disk over 1000 events, so long sessions use bounded memory.
+    event_queue = SpillQueue(memory_size=1000)
 
     # Cleanup function to call when exiting from logging.
     on_exit = (logout,
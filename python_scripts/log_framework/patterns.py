@@ -0,0 +1,293 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Event pattern matching stage for the log framework.
+
+Filters look at one event at a time. A PatternMatcher finds sequences of
+events instead, such as a CheckPrime solicit followed by a No response
+in the same transaction, within 500 ms:
+
+    no_prime = compile_pattern(
+        'tag == "solicit" and name == "CheckPrime" -> '
+        'tag == "response" and name == "No"', within=0.5, name='no_prime')
+
+    matcher = PatternMatcher([no_prime], on_match=(print_match, (), {}),
+                             on_timeout=(print_timeout, (), {}))
+    log_frame(events, [], stages=[matcher])
+
+Each step of a pattern is a filter expression (see filter_expr.py) or a
+filter function, as (fun, args, kwargs). The steps are separated by ->.
+A pattern is matched as an NFA, incrementally: each event matching the
+first step starts a partial match (a run) for its key, and each event of
+the same key matching the next step of a run advances it. The events in
+between, not matching the next step, are skipped.
+
+The on_match function receives the completed matches, and the optional
+on_timeout function the runs not completed within the time limit, e.g.
+a solicit without a response. Both look like:
+
+    {'pattern': 'no_prime', 'key': 'T-12', 'events': [...],
+     'start': 1530000000.0, 'end': 1530000000.2, 'step': 2}
+
+where step is the number of steps matched. Runs time out when an event
+from after their time limit arrives. At most max_runs runs are kept,
+the ones closest to their time limit being dropped first.
+"""
+
+import heapq
+import time
+from itertools import count
+
+from field_index import release_field_index
+from filter_expr import compile_filter
+from log_exception import LogException
+from log_framework import validate_fun, compile_function
+
+
+def transaction_key(event):
+    """
+    Key function grouping events by their SPARKL transaction id,
+    or None for events outside of transactions.
+    """
+    return event['attr'].get('txn')
+
+
+class Pattern(object):
+    """
+    Sequence of steps to match within a time limit.
+        - steps:
+            List of filter expressions or (fun, args, kwargs) filters
+        - within:
+            The longest time, in seconds, between the first and the
+            last event of a match
+        - name:
+            The name of the pattern, passed to on_match and on_timeout
+    """
+
+    def __init__(self, steps, within, name=None):
+        """
+        Compiles the steps into filter plans.
+        """
+        if not steps:
+            raise LogException('Patterns need at least one step!')
+
+        if within <= 0:
+            raise LogException('Within must be positive!')
+
+        self.steps = steps
+        self.within = within
+        self.name = name
+        self.plans = []
+
+        for step in steps:
+            if not isinstance(step, tuple):
+                step = compile_filter(step, default=False)
+            validate_fun(step)
+            self.plans.append(compile_function(step))
+
+
+def compile_pattern(text, within, name=None):
+    """
+    Returns the pattern of the filter expressions separated by ->.
+    """
+    return Pattern([step.strip() for step in text.split('->')],
+                   within, name=name or text)
+
+
+class Run(object):
+    """
+    Partial match of a pattern.
+    """
+    __slots__ = ('pattern', 'key', 'events', 'start', 'done')
+
+    def __init__(self, pattern, key, event, start):
+        """
+        Starts the run with its first event.
+        """
+        self.pattern = pattern
+        self.key = key
+        self.events = [event]
+        self.start = start
+        self.done = False
+
+
+class PatternMatcher(object):
+    """
+    Stage matching patterns over the events of each key.
+        - patterns:
+            List of Pattern instances
+        - on_match:
+            Function called with each match, as (fun, args, kwargs)
+        - on_timeout:
+            Optional function called with each run timing out
+        - key:
+            Function returning the key of an event, e.g. the
+            transaction. By default, transaction_key
+        - timestamp:
+            Optional function returning the time of an event, in seconds
+        - max_runs:
+            The maximum number of runs kept
+        - passthrough:
+            If True, events are also passed on to on_event
+    """
+
+    def __init__(self, patterns, on_match, on_timeout=None,
+                 key=transaction_key, timestamp=None, max_runs=100000,
+                 passthrough=False):
+        """
+        Validates the functions.
+        """
+        validate_fun(on_match)
+        if on_timeout:
+            validate_fun(on_timeout)
+
+        if max_runs < 1:
+            raise LogException('Max runs must be positive!')
+
+        self.patterns = patterns
+        self._on_match_plan = compile_function(on_match)
+        self._on_timeout_plan = compile_function(on_timeout) \
+            if on_timeout else None
+        self.key = key
+        self.timestamp = timestamp or (lambda event: time.time())
+        self.max_runs = max_runs
+        self.passthrough = passthrough
+
+        # key -> runs of the key, oldest first
+        self.runs = {}
+        # Heap of (deadline, number, run), runs done being skipped.
+        self.deadlines = []
+        self.numbers = count()
+        self.live = 0
+
+        self.matches = 0
+        self.timeouts = 0
+        self.evicted = 0
+
+    def process(self, event):
+        """
+        Advances the runs of the event's key, and
+        starts runs of the patterns it begins.
+        """
+        now = self.timestamp(event)
+        self.expire(now)
+
+        try:
+            key = self.key(event)
+            if key is not None:
+                self.advance(key, event, now)
+                self.begin(key, event, now)
+
+        finally:
+            release_field_index()
+
+        return event if self.passthrough else None
+
+    def advance(self, key, event, now):
+        """
+        Adds the event to the runs of the key waiting for it.
+        """
+        for run in list(self.runs.get(key, ())):
+            pattern = run.pattern
+            if not pattern.plans[len(run.events)](event):
+                continue
+
+            run.events.append(event)
+            if len(run.events) == len(pattern.plans):
+                self.finish(run)
+                self.matches += 1
+                self._on_match_plan(self.result(run, now))
+
+    def begin(self, key, event, now):
+        """
+        Starts a run of each pattern whose first step the event matches.
+        """
+        for pattern in self.patterns:
+            if not pattern.plans[0](event):
+                continue
+
+            run = Run(pattern, key, event, now)
+            if len(pattern.plans) == 1:
+                self.matches += 1
+                self._on_match_plan(self.result(run, now))
+                continue
+
+            self.runs.setdefault(key, []).append(run)
+            heapq.heappush(self.deadlines,
+                           (now + pattern.within, next(self.numbers), run))
+            self.live += 1
+
+            if self.live > self.max_runs:
+                self.evict()
+
+    def finish(self, run):
+        """
+        Removes a run from the runs of its key.
+        """
+        run.done = True
+        self.live -= 1
+
+        runs = self.runs[run.key]
+        runs.remove(run)
+        if not runs:
+            del self.runs[run.key]
+
+    def expire(self, now):
+        """
+        Times out the runs whose time limit ended before now.
+        """
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] < now:
+            run = heapq.heappop(deadlines)[2]
+            if run.done:
+                continue
+
+            self.finish(run)
+            self.timeouts += 1
+            if self._on_timeout_plan:
+                self._on_timeout_plan(
+                    self.result(run, run.start + run.pattern.within))
+
+    def evict(self):
+        """
+        Drops the run closest to its time limit.
+        """
+        while self.deadlines:
+            run = heapq.heappop(self.deadlines)[2]
+            if not run.done:
+                self.finish(run)
+                self.evicted += 1
+                return
+
+    @staticmethod
+    def result(run, end):
+        """
+        Returns the match or timeout passed to on_match or on_timeout.
+        """
+        return {
+            'pattern': run.pattern.name,
+            'key': run.key,
+            'events': run.events,
+            'start': run.start,
+            'end': end,
+            'step': len(run.events)}
+
+    def stats(self):
+        """
+        Returns the number of matches, timeouts,
+        evicted runs and runs in progress.
+        """
+        return {
+            'matches': self.matches,
+            'timeouts': self.timeouts,
+            'evicted': self.evicted,
+            'runs': self.live}
+
+    def close(self):
+        """
+        Drops the runs in progress, as they did not time out yet.
+        """
+        self.runs = {}
+        self.deadlines = []
+        self.live = 0
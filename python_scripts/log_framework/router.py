@@ -0,0 +1,283 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Topic router for the log framework.
+
+A TopicRouter reads one event stream for many subscriptions, each with
+its own filters and on_event function. This way, N consumers share one
+sparkl('listen') connection instead of opening N:
+
+    router = TopicRouter()
+    router.subscribe([], on_event=(print_event, (), {}), tag='solicit')
+    router.subscribe(my_filters, on_event=(post_to_slack, (), {}),
+                     name='CheckPrime', path='Scratch/Primes')
+
+    log_frame(events, [], on_event=(router.route, (), {}))
+
+Besides its filters, a subscription may be restricted to:
+    - tag - The event tag, e.g. 'solicit'
+    - name - The operation name, i.e. attr.name
+    - path - A SPARKL path prefix, matched segment by segment against
+      the path of the event, e.g. 'Scratch/Primes' matches the events
+      of 'Scratch/Primes/Sequencer/CheckPrime'
+
+Each subscription is indexed under the most selective of these: its
+name, else its path, else its tag. Routing an event only looks at the
+subscriptions indexed under the name, path prefixes and tag of the event,
+and at those without any restriction, checking their other restrictions.
+So adding subscriptions for other names, paths or tags does not slow
+routing down. The filters and on_event function run only for those
+matching all restrictions.
+
+An error in the on_event function of a subscription is printed and
+counted, and does not stop the other subscriptions.
+"""
+
+from itertools import chain, count
+
+from field_index import release_field_index
+from log_framework import validate_input, compile_functions, compile_function
+from sample_filters import print_warning
+
+
+def event_path(event):
+    """
+    Returns the SPARKL path of the event, e.g. the full path of the
+    operation in attr.solicit for solicit events, or an empty string.
+    """
+    attr = event.get('attr') or {}
+    path = attr.get(event.get('tag')) or attr.get('service')
+    return path if isinstance(path, str) else ''
+
+
+def path_segments(path):
+    """
+    Returns the segments of a path, as in filters.get_short_name.
+    """
+    return [segment for segment in path.split('/') if segment]
+
+
+class PathTrie(object):
+    """
+    Trie over path segments, holding the subscriptions registered
+    with each path prefix, in the order they were added.
+    """
+
+    def __init__(self):
+        """
+        Creates the root node, holding the subscriptions with no path.
+        """
+        self.subscriptions = []
+        self.children = {}
+
+    def add(self, segments, subscription):
+        """
+        Adds a subscription under a path prefix.
+        """
+        node = self
+        for segment in segments:
+            node = node.children.setdefault(segment, PathTrie())
+        node.subscriptions.append(subscription)
+
+    def remove(self, segments, subscription):
+        """
+        Removes a subscription, and the nodes left empty.
+        """
+        nodes = [self]
+        for segment in segments:
+            nodes.append(nodes[-1].children[segment])
+
+        nodes[-1].subscriptions.remove(subscription)
+
+        for parent, segment, node in reversed(
+                list(zip(nodes, segments, nodes[1:]))):
+            if node.subscriptions or node.children:
+                break
+            del parent.children[segment]
+
+    def match(self, segments):
+        """
+        Returns the non-empty lists of subscriptions
+        under any prefix of the path.
+        """
+        matched = [self.subscriptions] if self.subscriptions else []
+        node = self
+
+        for segment in segments:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.subscriptions:
+                matched.append(node.subscriptions)
+
+        return matched
+
+
+class Subscription(object):
+    """
+    Filters and on_event function of a consumer.
+    """
+
+    def __init__(self, number, filter_funs, on_event, tag, name, path):
+        """
+        Compiles the filters and the on_event function.
+        """
+        self.number = number
+        self.filter_funs = filter_funs
+        self.on_event = on_event
+        self.filter_plans = compile_functions(filter_funs)
+        self.on_event_plan = compile_function(on_event)
+        self.tag = tag
+        self.name = name
+        self.path = path
+        self.segments = path_segments(path or '')
+
+        self.matched = 0
+        self.errors = 0
+
+    def accepts(self, tag, name, segments):
+        """
+        True if the tag, name and path segments of an
+        event meet the restrictions of the subscription.
+        """
+        return ((self.tag is None or self.tag == tag) and
+                (self.name is None or self.name == name) and
+                segments[:len(self.segments)] == self.segments)
+
+    def __lt__(self, other):
+        """
+        Subscriptions are called in the order they were added.
+        """
+        return self.number < other.number
+
+
+class TopicRouter(object):
+    """
+    Routes each event to the subscriptions it matches.
+    """
+
+    def __init__(self):
+        """
+        Creates the router without any subscription.
+        """
+        self.numbers = count()
+        self.subscriptions = []
+
+        # Each subscription is in one of these, see index_of.
+        # name or tag -> subscriptions, in the order they were added.
+        self.by_name = {}
+        self.by_path = PathTrie()
+        self.by_tag = {}
+        # The subscriptions without tag, name or path.
+        self.wildcards = []
+
+    def index_of(self, subscription):
+        """
+        Returns the list of subscriptions a subscription belongs
+        in, creating it if needed, or None for the path trie.
+        """
+        if subscription.name is not None:
+            return self.by_name.setdefault(subscription.name, [])
+
+        if subscription.segments:
+            return None
+
+        if subscription.tag is not None:
+            return self.by_tag.setdefault(subscription.tag, [])
+
+        return self.wildcards
+
+    def subscribe(self, filter_funs, on_event, tag=None, name=None,
+                  path=None):
+        """
+        Adds a subscription, and returns it. The filter and on_event
+        functions are (fun, args, kwargs) tuples, as in log_frame.
+        """
+        validate_input(filter_funs, on_event, None)
+
+        subscription = Subscription(next(self.numbers), filter_funs,
+                                    on_event, tag, name, path)
+
+        self.subscriptions.append(subscription)
+        index = self.index_of(subscription)
+        if index is None:
+            self.by_path.add(subscription.segments, subscription)
+        else:
+            index.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription.
+        """
+        self.subscriptions.remove(subscription)
+
+        index = self.index_of(subscription)
+        if index is None:
+            self.by_path.remove(subscription.segments, subscription)
+            return
+
+        index.remove(subscription)
+        for by_key, key in ((self.by_name, subscription.name),
+                            (self.by_tag, subscription.tag)):
+            if by_key.get(key) is index and not index:
+                del by_key[key]
+
+    def candidates(self, event):
+        """
+        Returns the subscriptions whose tag, name and path
+        match the event, in the order they were added.
+        """
+        attr = event.get('attr') or {}
+        tag = event.get('tag')
+        name = attr.get('name')
+        segments = path_segments(event_path(event))
+
+        lists = self.by_path.match(segments)
+        for subscriptions in (self.by_name.get(name), self.by_tag.get(tag),
+                              self.wildcards):
+            if subscriptions:
+                lists.append(subscriptions)
+
+        matches = [subscription for subscription in chain(*lists)
+                   if subscription.accepts(tag, name, segments)]
+
+        # Each list is in the order the subscriptions were added.
+        if len(lists) > 1:
+            matches.sort()
+        return matches
+
+    def route(self, event):
+        """
+        Calls the on_event function of each subscription whose
+        filters the event gets through.
+        """
+        try:
+            for subscription in self.candidates(event):
+                if not all(filter_plan(event)
+                           for filter_plan in subscription.filter_plans):
+                    continue
+
+                subscription.matched += 1
+                try:
+                    subscription.on_event_plan(event)
+                except Exception as error:
+                    subscription.errors += 1
+                    print_warning(
+                        error, subscription.on_event[0].__name__)
+
+        finally:
+            release_field_index()
+
+    def stats(self):
+        """
+        Returns the matched events and on_event errors
+        of each subscription, in the order they were added.
+        """
+        return [{'tag': subscription.tag,
+                 'name': subscription.name,
+                 'path': subscription.path,
+                 'matched': subscription.matched,
+                 'errors': subscription.errors}
+                for subscription in self.subscriptions]
@@ -27,19 +27,40 @@ filter function into a try/except statement.
 
 On any exception, the decorator prints a warning message
 and returns a default True/False value.
+
+Filters looking up fields by name use the field index of the event
+(see field_index.py). The index is built once per event and shared
+by all filters.
 """
 
+import threading
+from functools import wraps
+
+from field_index import get_field_index
+
 DEFAULT = True
 
+# Number of filter errors warned about, per thread.
+WARNINGS = threading.local()
+
 
 def print_warning(error, fun_name):
     """
     Prints warnings if a filter function fails
-    due to exception.
+    due to exception, and counts them.
     """
+    WARNINGS.count = warning_count() + 1
     print('Warning, {} function error: {}'.format(fun_name, error))
 
 
+def warning_count():
+    """
+    Returns the number of filter errors warned about
+    so far, by the current thread.
+    """
+    return getattr(WARNINGS, 'count', 0)
+
+
 def generic_filter_fun(filter_fun):
     """
     Decorator for filter functions. All
@@ -52,7 +73,10 @@ def generic_filter_fun(filter_fun):
 
     If the filter function does not specify a default
     value, the wrapper returns default_fallback.
+
+    The wrapper keeps the name of the filter function.
     """
+    @wraps(filter_fun)
     def filter_wrapper(*args, **kwargs):
         """
         Filter function wrapper handling all exceptions.
@@ -95,8 +119,7 @@ def filter_field(event, field_name, default=DEFAULT):
 
     Returns the default boolean value on errors.
     """
-    content = event['content']
-    return any(x['attr']['name'] == field_name for x in content)
+    return field_name in get_field_index(event)
 
 
 @generic_filter_fun
@@ -108,8 +131,7 @@ def filter_field_values(event, field_name,
 
     Returns the default value on errors.
     """
-    value = [x['attr']['value'] for x in event['content']
-             if x['attr']['name'] == field_name][0]
+    value = get_field_index(event).value(field_name)
     return min_val < value < max_val
 
 
@@ -0,0 +1,224 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Multi-process, sharded version of the log framework.
+
+log_frame runs all filters in a single process, using at most one CPU
+core. log_frame_sharded reads the events in the calling process and
+partitions them by key across a pool of worker processes. Each worker
+runs the same filters and on_event function:
+
+    log_frame_sharded(events, my_filters, on_event=on_event,
+                      on_exit=logout, workers=4, key=service_key)
+
+Events with the same key always go to the same worker, and are handled
+in order. Without a key, the events are spread evenly across workers.
+
+The on_worker_exit function is called by each worker when it stops.
+The on_exit function is called once, in the calling process, after
+all workers have stopped.
+
+The events are read on a separate thread, see BatchReader in
+listen_reader.py, in batches of chunk_size events per worker, or
+chunk_interval seconds' worth of events. Each batch is split into one
+chunk per worker. A batch that is not full is sent chunk_interval seconds
+after its first event, even if the events generator blocks waiting for
+the next event.
+
+Errors of the filters and of on_event are printed by the workers, which
+go on with the next event. If a worker exits anyway, e.g. killed, no more
+events are sent to it: log_frame_sharded raises a LogException once the
+other workers stopped, instead of waiting for room in its queue.
+
+NOTE:
+    - The filter, on_event and on_worker_exit functions and their
+      arguments are sent to the workers. On systems not forking
+      processes, they must be picklable, e.g. module-level functions
+    - The workers can not close the events generator, which runs on
+      the reader thread. on_event functions like stop_services in
+      main.py do not work here
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+
+from listen_reader import BatchReader
+from log_exception import LogException
+from log_framework import (validate_input, validate_fun, print_frame_info,
+                           get_fun_name, compile_function, compile_functions,
+                           process_function, apply_filter_plans)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# The time, in seconds, to wait for room in the queue of a worker
+# before checking that the worker is still alive.
+PUT_TIMEOUT = 0.1
+
+
+def service_key(event):
+    """
+    Key function partitioning events by their service.
+    """
+    return event['attr'].get('svc')
+
+
+def run_shard(chunks, filter_funs, on_event, on_worker_exit):
+    """
+    Worker process. Filters the events received in chunks
+    and calls on_event on the matched ones. Prints the errors
+    of the filters and of on_event, and goes on.
+
+    A None chunk stops the worker.
+    """
+    filter_plans = compile_functions(filter_funs)
+    on_event_plan = compile_function(on_event) if on_event else print
+    name = multiprocessing.current_process().name
+
+    events = (event for chunk in iter(chunks.get, None) for event in chunk)
+
+    try:
+        for event in events:
+            try:
+                if apply_filter_plans(event, filter_plans):
+                    on_event_plan(event)
+
+            except Exception as error:
+                print('Warning, {} error: {}'.format(name, error))
+
+    finally:
+        if on_worker_exit:
+            process_function(on_worker_exit)
+
+
+def put_chunk(chunk_queue, process, chunk):
+    """
+    Puts a chunk in the queue of a worker, waiting for room while
+    the worker is alive. Raises LogException if it exited.
+    """
+    while True:
+        if not process.is_alive():
+            raise LogException('Worker {} exited with code {}!'.format(
+                process.name, process.exitcode))
+        try:
+            chunk_queue.put(chunk, timeout=PUT_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+
+def stop_workers(queues, processes):
+    """
+    Stops the workers, after they are done with their queued
+    events. Returns the workers that exited with an error.
+    """
+    for chunk_queue, process in zip(queues, processes):
+        try:
+            put_chunk(chunk_queue, process, None)
+        except LogException:
+            # Nothing reads the queue of an exited worker any more.
+            chunk_queue.cancel_join_thread()
+
+    failed = []
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            print('Warning, worker {} exited with code {}'.format(
+                process.name, process.exitcode))
+            failed.append(process)
+
+    return failed
+
+
+def log_frame_sharded(events, filter_funs, on_event=None, on_exit=None,
+                      workers=None, key=None, on_worker_exit=None,
+                      chunk_size=64, chunk_interval=0.1, maxsize=64):
+    """
+    Same as log_frame, but the events are filtered by worker processes.
+        - workers:
+            The number of worker processes. By default, one per CPU
+        - key:
+            Optional function returning the key of an event, e.g.
+            service_key. Events with the same key go to the same worker
+        - on_worker_exit:
+            Optional function called by each worker when it stops
+        - chunk_size, chunk_interval:
+            The events are read in batches of up to chunk_size events
+            per worker, or chunk_interval seconds' worth of events, and
+            each batch is sent to the workers in one chunk per worker
+        - maxsize:
+            The maximum number of chunks queued for a worker. When a
+            worker falls behind, reading the events waits
+    """
+    validate_input(filter_funs, on_event, on_exit)
+    if on_worker_exit:
+        validate_fun(on_worker_exit)
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers < 1 or chunk_size < 1:
+        raise LogException('Workers and chunk_size must be >= 1!')
+
+    print_frame_info(filter_funs, on_event)
+    print('Sharded across {} workers.'.format(workers))
+
+    queues = [multiprocessing.Queue(maxsize) for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(
+            target=run_shard,
+            args=(chunks, filter_funs, on_event, on_worker_exit))
+        for chunks in queues]
+
+    for process in processes:
+        process.start()
+
+    chunks = [[] for _ in range(workers)]
+
+    def send_chunks(skip_exited=False):
+        """
+        Sends the non-empty chunks to their workers. If skip_exited is
+        True, the chunks of exited workers are dropped instead of
+        raising a LogException.
+        """
+        for index, chunk in enumerate(chunks):
+            if chunk:
+                chunks[index] = []
+                try:
+                    put_chunk(queues[index], processes[index], chunk)
+                except LogException:
+                    if not skip_exited:
+                        raise
+
+    try:
+        read = 0
+
+        for batch in BatchReader(events, chunk_size * workers,
+                                 chunk_interval):
+            for count, event in enumerate(batch, read):
+                index = hash(key(event)) % workers if key \
+                    else count % workers
+                chunks[index].append(event)
+
+            read += len(batch)
+            send_chunks()
+
+    # Stop the workers, after they are done with all events.
+    # Then call the on_exit function, if there is one.
+    finally:
+        try:
+            send_chunks(skip_exited=True)
+        finally:
+            failed = stop_workers(queues, processes)
+
+            print('Exiting...')
+            if on_exit:
+                print('Calling exit function: {}'.format(
+                    get_fun_name(on_exit)))
+                process_function(on_exit)
+
+    if failed:
+        raise LogException('Workers {} exited with an error!'.format(
+            ', '.join(process.name for process in failed)))
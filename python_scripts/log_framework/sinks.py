@@ -0,0 +1,291 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Buffered output sinks for the log framework.
+
+Without an on_event function, log_frame prints each matched event, which
+formats and writes every event on its own. A sink writes the events as
+JSON lines instead, in batches:
+
+    log_frame(events, my_filters, sink=StdoutSink())
+
+    log_frame(events, my_filters,
+              sink=JsonLinesSink('events.jsonl', max_bytes=100 * 2 ** 20,
+                                 max_age=3600, compress=True))
+
+A batch is written once flush_every events are buffered, or by a timer
+thread flush_interval seconds after the last write, even if no further
+event arrives. When the events stop, log_frame closes the sink, writing
+the last batch before on_exit is called.
+
+JsonLinesSink rotates its file when it grows over max_bytes, or gets older
+than max_age seconds. The rotated files are named events.jsonl.1,
+events.jsonl.2, etc., and gzip compressed as events.jsonl.1.gz etc. if
+compress is True. With backup_count, only the newest backup_count rotated
+files are kept, including those left by earlier runs, and the older ones
+are deleted.
+
+Other sinks are BufferedSinks writing the batches with their own writer
+function, e.g. BufferedSink(connection.sendall) with a function encoding
+the JSON lines first. The writer is called either by the thread writing
+the events or by the timer thread, never by both at once.
+"""
+
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+from event import json_default
+from log_exception import LogException
+
+
+def json_line(event):
+    """
+    Returns the event as a line of compact JSON.
+    """
+    return json.dumps(event, separators=(',', ':'),
+                      default=json_default) + '\n'
+
+
+def rotated_number(rotated):
+    """
+    Returns the number of a rotated file, e.g. 2 for events.jsonl.2.gz.
+    """
+    return int(re.search(r'\.(\d+)(\.gz)?$', rotated).group(1))
+
+
+class BufferedSink(object):
+    """
+    Buffers the events, and writes them in batches.
+        - writer:
+            Function writing a batch, as a string of JSON lines
+        - flush_every:
+            The number of events written in one batch
+        - flush_interval:
+            The longest time, in seconds, events wait in the buffer.
+            If None, there is no timer thread
+    """
+
+    def __init__(self, writer, flush_every=1000, flush_interval=1.0):
+        """
+        Creates an empty buffer.
+        """
+        if not callable(writer):
+            raise LogException('Writer must be a callable function!')
+
+        if flush_every < 1:
+            raise LogException('Flush every must be positive!')
+
+        self.writer = writer
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flushed = time.time()
+        self.written = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = None
+
+    def write(self, event):
+        """
+        Adds the event to the buffer, writing the buffer if it is
+        full. The timer thread is started on the first event.
+
+        Raises the error of the writer, if it failed on the timer thread.
+        """
+        if self.error:
+            raise self.error
+
+        if self.timer is None and self.flush_interval:
+            self.timer = threading.Thread(target=self._flush_on_time,
+                                          name='log_frame_sink_timer')
+            self.timer.daemon = True
+            self.timer.start()
+
+        # Appending to and slicing a list are atomic, so the
+        # events are added without taking the lock.
+        self.buffer.append(json_line(event))
+
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def _flush_on_time(self):
+        """
+        Timer thread writing the buffered events once
+        flush_interval seconds passed since the last write.
+        """
+        while not self.stopped.wait(
+                max(0, self.flushed + self.flush_interval - time.time())):
+            if time.time() - self.flushed >= self.flush_interval:
+                try:
+                    self.flush()
+                except Exception as error:
+                    self.error = error
+                    return
+
+    def flush(self):
+        """
+        Writes the buffered events.
+        """
+        with self.lock:
+            lines = self.buffer[:]
+            if lines:
+                del self.buffer[:len(lines)]
+                self.written += len(lines)
+                self.writer(''.join(lines))
+
+            self.flushed = time.time()
+
+    def close(self):
+        """
+        Stops the timer thread, and writes the buffered events.
+        """
+        self.stopped.set()
+        if self.timer:
+            self.timer.join()
+
+        self.flush()
+        if self.error:
+            raise self.error
+
+
+class StdoutSink(BufferedSink):
+    """
+    Writes the events to the standard output.
+    """
+
+    def __init__(self, flush_every=1000, flush_interval=1.0, stream=None):
+        """
+        Writes to stream, by default sys.stdout.
+        """
+        BufferedSink.__init__(self, self.write_stream, flush_every,
+                              flush_interval)
+        self.stream = stream
+
+    def write_stream(self, data):
+        """
+        Writes and flushes a batch.
+        """
+        stream = self.stream or sys.stdout
+        stream.write(data)
+        stream.flush()
+
+
+class JsonLinesSink(BufferedSink):
+    """
+    Appends the events to a JSON lines file, rotating it.
+        - max_bytes:
+            Optional size, in bytes, over which the file is rotated
+        - max_age:
+            Optional time, in seconds, after which the file is rotated
+        - compress:
+            If True, the rotated files are gzip compressed
+        - backup_count:
+            Optional number of rotated files kept, the oldest
+            ones being deleted
+    """
+
+    def __init__(self, path, max_bytes=None, max_age=None, compress=False,
+                 flush_every=1000, flush_interval=1.0, backup_count=None):
+        """
+        Opens the file for appending.
+        """
+        BufferedSink.__init__(self, self.write_file, flush_every,
+                              flush_interval)
+        if backup_count is not None and backup_count < 0:
+            raise LogException('Backup count must not be negative!')
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.backup_count = backup_count
+        self.rotated = self.find_rotated()
+        self.delete_backups()
+        self.open()
+
+    def find_rotated(self):
+        """
+        Returns the rotated files already on disk, oldest first.
+        """
+        directory, name = os.path.split(os.path.abspath(self.path))
+        pattern = re.compile(re.escape(name) + r'\.(\d+)(\.gz)?$')
+
+        numbered = []
+        for file_name in os.listdir(directory):
+            matched = pattern.match(file_name)
+            if matched:
+                numbered.append((int(matched.group(1)), file_name))
+
+        return ['{}{}'.format(self.path, file_name[len(name):])
+                for _, file_name in sorted(numbered)]
+
+    def open(self):
+        """
+        Opens the file, starting its age.
+        """
+        self.file = open(self.path, 'a')
+        self.opened = time.time()
+
+    def write_file(self, data):
+        """
+        Writes a batch, then rotates the file if needed.
+        """
+        self.file.write(data)
+        self.file.flush()
+
+        if (self.max_bytes and self.file.tell() >= self.max_bytes) or \
+                (self.max_age and time.time() - self.opened >= self.max_age):
+            self.rotate()
+
+    def rotate(self):
+        """
+        Renames the file to the next free rotated name, compressing
+        it if asked to, deletes the oldest rotated files over
+        backup_count, and opens a new file.
+        """
+        self.file.close()
+
+        suffix = '.gz' if self.compress else ''
+        number = rotated_number(self.rotated[-1]) + 1 if self.rotated else 1
+        while os.path.exists('{}.{}{}'.format(self.path, number, suffix)):
+            number += 1
+        rotated = '{}.{}{}'.format(self.path, number, suffix)
+
+        if self.compress:
+            with open(self.path, 'rb') as source, \
+                    gzip.open(rotated, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, rotated)
+
+        self.rotated.append(rotated)
+        self.delete_backups()
+        self.open()
+
+    def delete_backups(self):
+        """
+        Deletes the oldest rotated files over backup_count.
+        """
+        if self.backup_count is None:
+            return
+
+        while len(self.rotated) > self.backup_count:
+            os.remove(self.rotated.pop(0))
+
+    def close(self):
+        """
+        Writes the buffered events, and closes the file.
+        """
+        try:
+            BufferedSink.close(self)
+        finally:
+            self.file.close()
@@ -0,0 +1,218 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Disk-spilling event queue for the log framework.
+
+A SpillQueue has the put/get API of queue.Queue, but keeps at most
+memory_size events in memory. Once full, new events are appended to
+segment files on disk, each holding up to segment_size events as JSON
+lines. Segments are read back, oldest first, once the events in memory
+are consumed. So a long listen session collecting events keeps a bounded
+memory use:
+
+    event_queue = SpillQueue(memory_size=1000)
+    log_frame(events, my_filters, on_event=(event_queue.put, (), {}))
+
+    for event in event_queue.drain():
+        print(event)
+
+    event_queue.close()
+
+The events must be JSON serializable. By default, the segments are
+written to a temporary directory, removed by close.
+"""
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from event import json_default
+from log_exception import LogException
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+class SpillQueue(object):
+    """
+    FIFO queue spilling to disk.
+        - directory:
+            Optional directory of the segment files
+        - memory_size:
+            The number of events kept in memory before spilling
+        - segment_size:
+            The number of events per segment file
+    """
+
+    def __init__(self, directory=None, memory_size=1000, segment_size=1000):
+        """
+        Creates an empty queue.
+        """
+        if memory_size < 1 or segment_size < 1:
+            raise LogException('Memory and segment size must be positive!')
+
+        self.own_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='spill_')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.memory_size = memory_size
+        self.segment_size = segment_size
+
+        self.memory = collections.deque()
+        # Paths of the full segments, oldest first.
+        self.segments = collections.deque()
+        # The segment being written, and the number of events in it.
+        self.writing = None
+        self.writing_path = None
+        self.writing_count = 0
+        self.segment_number = 0
+
+        self.spilled = 0
+        self.size = 0
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Adds an item. Never blocks, block and timeout are
+        accepted for compatibility with queue.Queue.
+        """
+        with self.not_empty:
+            if self.segments or self.writing is not None or \
+                    len(self.memory) >= self.memory_size:
+                self.spill(item)
+            else:
+                self.memory.append(item)
+
+            self.size += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        """
+        Adds an item.
+        """
+        self.put(item, block=False)
+
+    def spill(self, item):
+        """
+        Appends an item to the segment being written, sealing
+        the segment when full.
+        """
+        if self.writing is None:
+            self.segment_number += 1
+            self.writing_path = os.path.join(
+                self.directory, 'segment_{:08d}.jsonl'.format(
+                    self.segment_number))
+            self.writing = open(self.writing_path, 'a')
+            self.writing_count = 0
+
+        self.writing.write(json.dumps(
+            item, separators=(',', ':'), default=json_default) + '\n')
+        self.writing.flush()
+        self.writing_count += 1
+        self.spilled += 1
+
+        if self.writing_count >= self.segment_size:
+            self.seal()
+
+    def seal(self):
+        """
+        Closes the segment being written, queueing it for reading.
+        """
+        self.writing.close()
+        self.segments.append(self.writing_path)
+        self.writing = None
+        self.writing_path = None
+
+    def load(self):
+        """
+        Moves the events of the oldest segment to memory,
+        and removes the segment file.
+        """
+        if not self.segments:
+            self.seal()
+
+        path = self.segments.popleft()
+        with open(path) as segment:
+            for line in segment:
+                self.memory.append(json.loads(line))
+        os.remove(path)
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the oldest item. Raises Empty if
+        there is none, after waiting if block is True.
+        """
+        with self.not_empty:
+            if block:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self.size:
+                    remaining = None if deadline is None \
+                        else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+
+            elif not self.size:
+                raise Empty
+
+            if not self.memory:
+                self.load()
+
+            self.size -= 1
+            return self.memory.popleft()
+
+    def get_nowait(self):
+        """
+        Removes and returns the oldest item, or raises Empty.
+        """
+        return self.get(block=False)
+
+    def drain(self):
+        """
+        Yields all items in the queue, oldest first, reading
+        the spilled segments back one at a time.
+        """
+        while True:
+            try:
+                yield self.get(block=False)
+            except Empty:
+                return
+
+    def qsize(self):
+        """
+        Returns the number of items in the queue.
+        """
+        return self.size
+
+    def empty(self):
+        """
+        True if the queue holds no item.
+        """
+        return not self.size
+
+    def close(self):
+        """
+        Drops the items, and removes the segment files.
+        """
+        with self.not_empty:
+            if self.writing is not None:
+                self.seal()
+
+            for path in self.segments:
+                if os.path.exists(path):
+                    os.remove(path)
+
+            self.segments.clear()
+            self.memory.clear()
+            self.size = 0
+
+            if self.own_directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,112 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Synthetic SPARKL events, for testing and benchmarking the log framework
+without a running SPARKL instance.
+
+The events share the struct of the events sent by sparkl('listen'),
+see sample_filters.py. E.g.:
+
+    events = synthetic_events(1000, seed=1,
+                              tag_mix={'solicit': 1, 'notify': 19},
+                              field_names=('n', 'div'), field_count=10,
+                              values=normal(50, 10))
+
+    for event in events:
+        print(event['tag'], event['attr']['name'])
+
+The value distributions are functions returning a value drawing function,
+such as uniform, normal and choice below.
+"""
+
+import random
+
+# Default share of each event tag.
+TAG_MIX = {
+    'solicit': 0.05,
+    'request': 0.15,
+    'reply': 0.15,
+    'response': 0.05,
+    'notify': 0.3,
+    'consume': 0.3}
+
+# Default operation names and their service.
+OPERATIONS = [
+    ('CheckPrime', 'Sequencer'),
+    ('FirstDivisor', 'Sequencer'),
+    ('Test', 'Sequencer'),
+    ('Iterate', 'Sequencer')]
+
+
+def uniform(low=0, high=100):
+    """
+    Integers drawn uniformly between low and high, inclusive.
+    """
+    return lambda rng: rng.randint(low, high)
+
+
+def normal(mean=50.0, stddev=10.0):
+    """
+    Floats drawn from a normal distribution.
+    """
+    return lambda rng: rng.gauss(mean, stddev)
+
+
+def choice(values):
+    """
+    Values drawn uniformly from a list of values.
+    """
+    values = list(values)
+    return lambda rng: rng.choice(values)
+
+
+def make_field(field_name, value):
+    """
+    Returns a field in the struct of SPARKL events.
+    """
+    field_type = 'integer' if isinstance(value, int) else 'float'
+    if not isinstance(value, (int, float)):
+        field_type = 'string'
+
+    return {'tag': 'field',
+            'attr': {'type': field_type, 'name': field_name, 'value': value}}
+
+
+def synthetic_events(count, seed=None, tag_mix=None, operations=None,
+                     field_names=('n',), field_count=None, values=None):
+    """
+    Yields count events.
+        - seed:
+            Seed of the random generator, for repeatable events
+        - tag_mix:
+            Dict of tag -> weight. By default, TAG_MIX
+        - operations:
+            List of (name, service) tuples. By default, OPERATIONS
+        - field_names:
+            The fields carried by each event, first in the content
+        - field_count:
+            The total number of fields in each event. The fields
+            not in field_names are named field_1, field_2, etc.
+        - values:
+            The distribution of the field values. By default, uniform()
+    """
+    rng = random.Random(seed)
+    tag_mix = tag_mix or TAG_MIX
+    operations = operations or OPERATIONS
+    values = values or uniform()
+    tags = list(tag_mix)
+    weights = [tag_mix[tag] for tag in tags]
+
+    field_names = list(field_names)
+    if field_count and field_count > len(field_names):
+        field_names += ['field_{}'.format(index) for index
+                        in range(1, field_count - len(field_names) + 1)]
+
+    for _ in range(count):
+        name, svc = rng.choice(operations)
+        yield {
+            'tag': rng.choices(tags, weights)[0],
+            'attr': {'name': name, 'svc': svc},
+            'content': [make_field(field_name, values(rng))
+                        for field_name in field_names]}
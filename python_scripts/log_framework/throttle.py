@@ -0,0 +1,263 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Rate limiting and sampling stages for the log framework.
+
+During incident storms, every event getting through the filters may call
+on_event, e.g. posting to Slack. These stages cap the events reaching
+on_event per key, e.g. per operation name, without stopping the listener:
+    - RateLimiter - A token bucket per key, passing on at most rate
+      events per second, with bursts of up to burst events
+    - Sampler - Passes on each event with a probability
+    - ReservoirSampler - Keeps a uniform sample of at most size events
+      per key and interval, and passes them to on_sample when the
+      interval ends
+
+E.g.:
+
+    limiter = RateLimiter(rate=1, burst=5)
+    log_frame(events, my_filters, on_event=post_to_slack, stages=[limiter])
+    print(limiter.stats())
+
+The events not passed on are counted per key, see stats.
+"""
+
+import random
+import time
+
+from log_exception import LogException
+from log_framework import validate_fun, compile_function
+from windows import name_key
+
+
+class KeyCounters(object):
+    """
+    Counts the events passed on and suppressed, per key.
+    """
+    # Attributes saved by checkpoints, see checkpoint.py.
+    state_attrs = ('passed', 'suppressed')
+
+    def __init__(self, key):
+        """
+        Starts with no events counted.
+        """
+        self.key = key
+        self.passed = {}
+        self.suppressed = {}
+
+    def count(self, key, passed):
+        """
+        Counts an event of key, passed on or not.
+        """
+        counters = self.passed if passed else self.suppressed
+        counters[key] = counters.get(key, 0) + 1
+
+    def stats(self):
+        """
+        Returns the number of events passed on and
+        suppressed, in total and per key.
+        """
+        return {
+            'passed': sum(self.passed.values()),
+            'suppressed': sum(self.suppressed.values()),
+            'passed_per_key': dict(self.passed),
+            'suppressed_per_key': dict(self.suppressed)}
+
+    def get_state(self):
+        """
+        Returns the counters, for checkpointing.
+        """
+        return {name: getattr(self, name) for name in self.state_attrs}
+
+    def set_state(self, state):
+        """
+        Restores the counters returned by get_state.
+        """
+        for name in self.state_attrs:
+            setattr(self, name, state[name])
+
+
+class RateLimiter(KeyCounters):
+    """
+    Stage passing on at most rate events per second per key.
+        - rate:
+            The number of events per second let through, on average
+        - burst:
+            The number of events let through at once, after a quiet period
+        - key:
+            Function returning the key of an event. By default, name_key
+    """
+    state_attrs = KeyCounters.state_attrs + ('buckets',)
+
+    def __init__(self, rate, burst=1, key=name_key, clock=time.time):
+        """
+        Creates the stage without any token bucket.
+        """
+        if rate <= 0 or burst < 1:
+            raise LogException('Rate and burst must be positive!')
+
+        KeyCounters.__init__(self, key)
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+
+        # key -> [tokens, time of the last refill]
+        self.buckets = {}
+
+    def process(self, event):
+        """
+        Passes the event on if its bucket holds a token.
+        """
+        key = self.key(event)
+        now = self.clock()
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst,
+                            bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        passed = bucket[0] >= 1
+        if passed:
+            bucket[0] -= 1
+
+        self.count(key, passed)
+        return event if passed else None
+
+
+class Sampler(KeyCounters):
+    """
+    Stage passing on each event with a probability.
+        - probability:
+            The share of events passed on, between 0 and 1
+        - probabilities:
+            Optional dict of key -> probability, overriding probability
+        - key:
+            Function returning the key of an event. By default, name_key
+        - seed:
+            Seed of the random generator, for repeatable samples
+    """
+
+    def __init__(self, probability, probabilities=None, key=name_key,
+                 seed=None):
+        """
+        Validates the probabilities.
+        """
+        probabilities = probabilities or {}
+        for value in [probability] + list(probabilities.values()):
+            if not 0 <= value <= 1:
+                raise LogException('Probabilities must be between 0 and 1!')
+
+        KeyCounters.__init__(self, key)
+        self.probability = probability
+        self.probabilities = probabilities
+        self.random = random.Random(seed).random
+
+    def process(self, event):
+        """
+        Passes the event on, with the probability of its key.
+        """
+        key = self.key(event)
+        passed = self.random() < self.probabilities.get(key, self.probability)
+
+        self.count(key, passed)
+        return event if passed else None
+
+
+class ReservoirSampler(KeyCounters):
+    """
+    Stage keeping a uniform sample of the events of each key per interval.
+    When an interval ends, the sampled events are passed to on_sample,
+    e.g. the on_event function, instead of passing them on.
+        - on_sample:
+            Function called with each sampled event, as (fun, args, kwargs)
+        - size:
+            The maximum number of events sampled per key and interval
+        - interval:
+            The length of an interval, in seconds
+        - key:
+            Function returning the key of an event. By default, name_key
+        - seed:
+            Seed of the random generator, for repeatable samples
+
+    NOTE, an interval ends when an event from a later interval arrives,
+    or when the events stop.
+    """
+    state_attrs = KeyCounters.state_attrs + ('reservoirs', 'started')
+
+    def __init__(self, on_sample, size=10, interval=60.0, key=name_key,
+                 seed=None, clock=time.time):
+        """
+        Validates the on_sample function and the sample size.
+        """
+        validate_fun(on_sample)
+
+        if size < 1 or interval <= 0:
+            raise LogException('Size and interval must be positive!')
+
+        KeyCounters.__init__(self, key)
+        self.on_sample = on_sample
+        self._on_sample_plan = compile_function(on_sample)
+        self.size = size
+        self.interval = interval
+        self.random = random.Random(seed)
+        self.clock = clock
+
+        # key -> [events seen in the interval, sampled events]
+        self.reservoirs = {}
+        self.started = None
+
+    def process(self, event):
+        """
+        Adds the event to the sample of its key, replacing
+        a sampled event at random once the sample is full.
+        """
+        now = self.clock()
+
+        if self.started is None:
+            self.started = now
+        elif now - self.started >= self.interval:
+            self.flush()
+            self.started = now
+
+        key = self.key(event)
+        reservoir = self.reservoirs.get(key)
+        if reservoir is None:
+            reservoir = self.reservoirs[key] = [0, []]
+
+        reservoir[0] += 1
+        sample = reservoir[1]
+
+        if len(sample) < self.size:
+            sample.append(event)
+        else:
+            # Algorithm R: keep the event with probability size / seen.
+            index = self.random.randrange(reservoir[0])
+            if index < self.size:
+                sample[index] = event
+
+        return None
+
+    def flush(self):
+        """
+        Passes the sampled events to on_sample, and starts a new interval.
+        """
+        reservoirs, self.reservoirs = self.reservoirs, {}
+
+        for key, (seen, sample) in reservoirs.items():
+            self.passed[key] = self.passed.get(key, 0) + len(sample)
+            self.suppressed[key] = \
+                self.suppressed.get(key, 0) + seen - len(sample)
+
+            for event in sample:
+                self._on_sample_plan(event)
+
+    def close(self):
+        """
+        Passes on the sample of the last interval.
+        """
+        self.flush()
+        self.started = None
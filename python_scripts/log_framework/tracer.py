@@ -0,0 +1,358 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Transaction tracing stage for the log framework.
+
+A TransactionTracer groups the events of each transaction into spans,
+each from an event starting an exchange to the event ending it:
+    - solicit -> response
+    - request -> reply
+    - notify -> consume
+
+Once all spans of a transaction are closed, it computes:
+    - The latency of the transaction, and of each span, per operation
+    - The hop count, i.e. the number of events in the transaction
+    - The critical path: starting from the outermost span, the span
+      nested in it ending last, and so on. E.g. for CheckPrime, the
+      path shows how much of the solicit is spent in each Test/Iterate
+
+    tracer = TransactionTracer(sink=JsonLinesSink('spans.jsonl'),
+                               group_field='n', timeout=60)
+    log_frame(events, [], stages=[tracer])
+    print(tracer.summary())
+
+The spans and the transactions are written to the sink as they close,
+see sinks.py. The summary holds latency histograms per operation, and
+per value of group_field in the first event of the transaction, e.g. to
+see how CheckPrime latency grows with n.
+
+An end event closes the span of the start event whose id is in its
+parent attribute, if any. Otherwise, it closes the oldest open span
+started by the matching tag.
+
+Transactions still open after timeout seconds are closed as orphans.
+At most max_open transactions are kept open, the oldest ones being
+closed as orphans first.
+"""
+
+import time
+from collections import OrderedDict
+
+from field_index import field_attr
+from frame_stats import FunctionStats
+from log_exception import LogException
+from patterns import transaction_key
+
+# Tag starting a span -> tag ending it.
+SPAN_TAGS = {
+    'solicit': 'response',
+    'request': 'reply',
+    'notify': 'consume'}
+
+END_TAGS = {end: start for start, end in SPAN_TAGS.items()}
+
+
+def event_id(event):
+    """
+    Returns the id of an event, or None.
+    """
+    return event['attr'].get('id')
+
+
+def parent_id(event):
+    """
+    Returns the id of the event an event answers, or None.
+    """
+    return event['attr'].get('parent')
+
+
+class Trace(object):
+    """
+    Events and spans of one transaction.
+    """
+
+    def __init__(self, txn, first_event, started):
+        """
+        Starts the trace with its first event.
+        """
+        self.txn = txn
+        self.first_event = first_event
+        self.started = started
+        self.ended = started
+        self.hops = 0
+        # tag -> open spans, oldest first
+        self.open = {}
+        self.closed = []
+
+
+def nest_spans(spans):
+    """
+    Returns the spans with no enclosing span, and a dict of
+    span index -> indexes of the spans directly nested in it.
+    """
+    order = sorted(range(len(spans)), key=lambda index: (
+        spans[index]['start'], -spans[index]['end']))
+    roots = []
+    children = {}
+    stack = []
+
+    for index in order:
+        span = spans[index]
+        while stack and spans[stack[-1]]['end'] < span['end']:
+            stack.pop()
+
+        if stack:
+            children.setdefault(stack[-1], []).append(index)
+        else:
+            roots.append(index)
+        stack.append(index)
+
+    return roots, children
+
+
+def critical_path(spans):
+    """
+    Returns the critical path of the spans, as a list of
+    (operation, latency, self time) tuples. The self time of a
+    span excludes the time of the next span of the path.
+    """
+    if not spans:
+        return []
+
+    roots, children = nest_spans(spans)
+    path = []
+    index = max(roots, key=lambda root: spans[root]['end'])
+
+    while index is not None:
+        nested = children.get(index)
+        next_index = max(nested, key=lambda child: spans[child]['end']) \
+            if nested else None
+
+        span = spans[index]
+        nested_latency = spans[next_index]['latency'] \
+            if next_index is not None else 0.0
+        path.append((span['operation'], span['latency'],
+                     span['latency'] - nested_latency))
+        index = next_index
+
+    return path
+
+
+class TransactionTracer(object):
+    """
+    Stage tracing the spans of transactions.
+        - sink:
+            Optional sink, e.g. a JsonLinesSink, to which the spans and
+            the transactions are written as they close
+        - group_field:
+            Optional field of the first event of transactions, to group
+            the transaction latencies by its value
+        - timeout:
+            The time, in seconds, after which open transactions are orphans
+        - max_open:
+            The maximum number of open transactions
+        - key:
+            Function returning the transaction of an event.
+            By default, transaction_key
+        - timestamp:
+            Optional function returning the time of an event, in seconds
+        - passthrough:
+            If False, the events are not passed on to on_event
+    """
+
+    def __init__(self, sink=None, group_field=None, timeout=60.0,
+                 max_open=10000, key=transaction_key, timestamp=None,
+                 passthrough=True):
+        """
+        Creates the tracer, without any transaction.
+        """
+        if timeout <= 0 or max_open < 1:
+            raise LogException('Timeout and max open must be positive!')
+
+        self.sink = sink
+        self.group_field = group_field
+        self.timeout = timeout
+        self.max_open = max_open
+        self.key = key
+        self.timestamp = timestamp or (lambda event: time.time())
+        self.passthrough = passthrough
+
+        # txn -> trace, oldest first
+        self.traces = OrderedDict()
+
+        self.operations = {}
+        self.groups = {}
+        self.hops = {}
+        self.transactions = 0
+        self.orphans = 0
+        self.unmatched = 0
+
+    def process(self, event):
+        """
+        Adds the event to the trace of its transaction.
+        """
+        now = self.timestamp(event)
+        self.expire(now)
+
+        txn = self.key(event)
+        if txn is None:
+            return event if self.passthrough else None
+
+        trace = self.traces.get(txn)
+        if trace is None:
+            trace = self.traces[txn] = Trace(txn, event, now)
+            if len(self.traces) > self.max_open:
+                self.close_trace(self.traces[next(iter(self.traces))], True)
+
+        trace.hops += 1
+        trace.ended = max(trace.ended, now)
+        tag = event['tag']
+
+        if tag in SPAN_TAGS:
+            trace.open.setdefault(tag, []).append((event, now))
+
+        elif tag in END_TAGS:
+            self.end_span(trace, END_TAGS[tag], event, now)
+
+        if not any(trace.open.values()) and trace.closed:
+            self.close_trace(trace, False)
+
+        return event if self.passthrough else None
+
+    def end_span(self, trace, start_tag, event, now):
+        """
+        Closes the span the end event answers.
+        """
+        open_spans = trace.open.get(start_tag)
+        if not open_spans:
+            self.unmatched += 1
+            return
+
+        position = 0
+        parent = parent_id(event)
+        if parent is not None:
+            for index, (start_event, _) in enumerate(open_spans):
+                if event_id(start_event) == parent:
+                    position = index
+                    break
+
+        start_event, started = open_spans.pop(position)
+        operation = start_event['attr'].get('name')
+        span = {
+            'type': 'span',
+            'txn': trace.txn,
+            'tag': start_event['tag'],
+            'operation': operation,
+            'outcome': event['attr'].get('name'),
+            'start': started,
+            'end': now,
+            'latency': now - started}
+
+        trace.closed.append(span)
+        self.record(self.operations, operation, span['latency'])
+        self.write(span)
+
+    def close_trace(self, trace, orphan):
+        """
+        Summarizes a transaction, and drops its trace.
+        """
+        del self.traces[trace.txn]
+
+        latency = trace.ended - trace.started
+        record = {
+            'type': 'transaction',
+            'txn': trace.txn,
+            'start': trace.started,
+            'end': trace.ended,
+            'latency': latency,
+            'hops': trace.hops,
+            'spans': len(trace.closed),
+            'orphan': orphan,
+            'open_spans': sum(len(spans) for spans in trace.open.values()),
+            'critical_path': critical_path(trace.closed)}
+
+        if orphan:
+            self.orphans += 1
+        else:
+            self.transactions += 1
+            self.hops[trace.hops] = self.hops.get(trace.hops, 0) + 1
+
+            if self.group_field:
+                group = self.group_value(trace.first_event)
+                record['group'] = group
+                self.record(self.groups, group, latency)
+
+        self.write(record)
+
+    def group_value(self, event):
+        """
+        Returns the value of group_field in the event, or None.
+        """
+        attr = field_attr(event, self.group_field)
+        return attr.get('value') if attr else None
+
+    @staticmethod
+    def record(histograms, name, latency):
+        """
+        Records a latency in the histogram of name.
+        """
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = FunctionStats(None, name)
+        histogram.record(latency, None, 0)
+
+    def write(self, record):
+        """
+        Writes a span or transaction to the sink, if any.
+        """
+        if self.sink:
+            self.sink.write(record)
+
+    def expire(self, now):
+        """
+        Closes the transactions open for longer than timeout as orphans.
+        """
+        while self.traces:
+            trace = self.traces[next(iter(self.traces))]
+            if now - trace.started < self.timeout:
+                break
+            self.close_trace(trace, True)
+
+    def summary(self):
+        """
+        Returns the latency histograms per operation and per group,
+        the hop counts, and the transaction counters.
+        """
+        def latencies(histograms):
+            """
+            Returns the count, mean, p50 and p99 of each histogram.
+            """
+            result = {}
+            for name, histogram in histograms.items():
+                stats = histogram.snapshot()
+                result[name] = {
+                    'count': stats['calls'],
+                    'mean': stats['seconds'] / stats['calls'],
+                    'p50': stats['p50'],
+                    'p99': stats['p99']}
+            return result
+
+        return {
+            'transactions': self.transactions,
+            'orphans': self.orphans,
+            'open': len(self.traces),
+            'unmatched': self.unmatched,
+            'hops': dict(self.hops),
+            'operations': latencies(self.operations),
+            'groups': latencies(self.groups)}
+
+    def close(self):
+        """
+        Closes the open transactions as orphans, and the sink.
+        """
+        while self.traces:
+            self.close_trace(self.traces[next(iter(self.traces))], True)
+
+        if self.sink:
+            self.sink.close()
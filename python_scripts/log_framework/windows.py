@@ -0,0 +1,251 @@
+"""
+Copyright (c) 2018 SPARKL Limited. All Rights Reserved.
+Author <miklos@sparkl.com> Miklos Duma
+
+Windowed aggregation stage for the log framework.
+
+A WindowAggregator counts the events per key, e.g. per operation name,
+over a time window, and computes the sum, min, max and mean of a numeric
+field. When a window closes, the aggregate of each key is passed to the
+on_window function, instead of passing each event on to on_event:
+
+    def print_window(aggregate):
+        print(aggregate)
+
+    per_minute = WindowAggregator(on_window=(print_window, (), {}),
+                                  field_name='n', window=60)
+    log_frame(events, my_filters, stages=[per_minute])
+
+Windows are either:
+    - Tumbling - Consecutive windows of window seconds. The default
+    - Sliding - Windows of window seconds, closing every slide seconds.
+      The window must be a multiple of the slide
+
+Each key keeps one bucket of counters per slide of the window, so the
+memory used is proportional to the number of keys times the number of
+buckets. The aggregates passed to on_window look like:
+
+    {'key': 'CheckPrime', 'start': 1530000000.0, 'end': 1530000060.0,
+     'count': 12, 'values': 12, 'sum': 96, 'min': 2, 'max': 13, 'mean': 8.0}
+
+where count is the number of events and values the number of events
+carrying a numeric value in the field.
+
+NOTE, windows are closed when an event from a later window arrives, or
+when the events stop. By default, the time of an event is the time it
+reaches the stage. Use timestamp to read it from the event instead.
+"""
+
+import time
+
+from field_index import field_attr
+from log_exception import LogException
+from log_framework import validate_fun, compile_function
+
+# Positions in a bucket of counters.
+COUNT, VALUES, SUM, MIN, MAX = range(5)
+
+
+def name_key(event):
+    """
+    Key function grouping events by their name.
+    """
+    return event['attr']['name']
+
+
+def new_bucket():
+    """
+    Returns an empty bucket of counters.
+    """
+    return [0, 0, 0, None, None]
+
+
+def merge_buckets(buckets):
+    """
+    Returns the counters of several buckets merged into one.
+    """
+    merged = new_bucket()
+
+    for bucket in buckets:
+        merged[COUNT] += bucket[COUNT]
+        merged[VALUES] += bucket[VALUES]
+        merged[SUM] += bucket[SUM]
+        for position, better in ((MIN, min), (MAX, max)):
+            if bucket[position] is not None:
+                merged[position] = bucket[position] \
+                    if merged[position] is None \
+                    else better(merged[position], bucket[position])
+
+    return merged
+
+
+def field_value(event, field_name):
+    """
+    Returns the numeric value of the named field, or None.
+    """
+    attr = field_attr(event, field_name)
+    value = attr.get('value') if attr else None
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class WindowAggregator(object):
+    """
+    Stage aggregating events per key over time windows.
+        - on_window:
+            Function called with each aggregate, as (fun, args, kwargs)
+        - field_name:
+            Optional name of the numeric field to aggregate
+        - window:
+            The length of a window, in seconds
+        - slide:
+            For sliding windows, the time between two windows closing
+        - key:
+            Function returning the key of an event. By default, name_key
+        - timestamp:
+            Optional function returning the time of an event, in seconds
+        - passthrough:
+            If True, events are also passed on to on_event
+    """
+
+    def __init__(self, on_window, field_name=None, window=60.0, slide=None,
+                 key=name_key, timestamp=None, passthrough=False):
+        """
+        Validates the windows and the on_window function.
+        """
+        validate_fun(on_window)
+        slide = slide or window
+
+        if window <= 0 or slide <= 0:
+            raise LogException('Window and slide must be positive!')
+
+        buckets = window / float(slide)
+        if abs(buckets - round(buckets)) > 1e-9:
+            raise LogException('Window must be a multiple of slide!')
+
+        self.on_window = on_window
+        self._on_window_plan = compile_function(on_window)
+        self.field_name = field_name
+        self.window = window
+        self.slide = slide
+        self.buckets_per_window = int(round(buckets))
+        self.key = key
+        self.timestamp = timestamp or (lambda event: time.time())
+        self.passthrough = passthrough
+
+        # key -> {bucket index: bucket}
+        self.buckets = {}
+        # Index of the latest bucket seen, None before the first event.
+        self.current = None
+
+    def process(self, event):
+        """
+        Adds the event to the bucket of its key and time, closing
+        the windows that ended before it.
+        """
+        index = int(self.timestamp(event) // self.slide)
+
+        if self.current is None:
+            self.current = index
+        elif index > self.current:
+            self.advance(index)
+
+        # Late events are added to the current bucket.
+        index = self.current
+
+        key_buckets = self.buckets.setdefault(self.key(event), {})
+        bucket = key_buckets.get(index)
+        if bucket is None:
+            bucket = key_buckets[index] = new_bucket()
+
+        bucket[COUNT] += 1
+        if self.field_name:
+            value = field_value(event, self.field_name)
+            if value is not None:
+                bucket[VALUES] += 1
+                bucket[SUM] += value
+                bucket[MIN] = value if bucket[MIN] is None \
+                    else min(bucket[MIN], value)
+                bucket[MAX] = value if bucket[MAX] is None \
+                    else max(bucket[MAX], value)
+
+        return event if self.passthrough else None
+
+    def advance(self, index):
+        """
+        Closes the windows ending after the current bucket, up to
+        the bucket at index, and drops the buckets no longer needed.
+        """
+        # Windows ending later than this hold no buckets.
+        last_end = min(index, self.current + self.buckets_per_window)
+
+        for end in range(self.current + 1, last_end + 1):
+            self.emit(end)
+
+        self.current = index
+        oldest = index - self.buckets_per_window + 1
+
+        for key in list(self.buckets):
+            key_buckets = self.buckets[key]
+            for bucket_index in list(key_buckets):
+                if bucket_index < oldest:
+                    del key_buckets[bucket_index]
+            if not key_buckets:
+                del self.buckets[key]
+
+    def emit(self, end):
+        """
+        Passes the aggregate of each key over the window ending
+        before the bucket at index end to on_window.
+        """
+        start = end - self.buckets_per_window
+
+        for key, key_buckets in list(self.buckets.items()):
+            merged = merge_buckets(
+                bucket for bucket_index, bucket in key_buckets.items()
+                if start <= bucket_index < end)
+
+            if merged[COUNT]:
+                self._on_window_plan(self.aggregate(key, start, end, merged))
+
+    def aggregate(self, key, start, end, bucket):
+        """
+        Returns the aggregate passed to on_window.
+        """
+        return {
+            'key': key,
+            'start': start * self.slide,
+            'end': end * self.slide,
+            'count': bucket[COUNT],
+            'values': bucket[VALUES],
+            'sum': bucket[SUM],
+            'min': bucket[MIN],
+            'max': bucket[MAX],
+            'mean': (float(bucket[SUM]) / bucket[VALUES]
+                     if bucket[VALUES] else None)}
+
+    def get_state(self):
+        """
+        Returns the buckets, for checkpointing. See checkpoint.py.
+        """
+        return {'buckets': self.buckets, 'current': self.current}
+
+    def set_state(self, state):
+        """
+        Restores the buckets returned by get_state.
+        """
+        self.buckets = state['buckets']
+        self.current = state['current']
+
+    def close(self):
+        """
+        Closes the window holding the latest bucket, and
+        drops all buckets.
+        """
+        if self.current is not None:
+            self.emit(self.current + 1)
+
+        self.buckets = {}
+        self.current = None
@@ -0,0 +1,1799 @@
+"""
+Author <miklos@sparkl.com> Miklos Duma
+Copyright 2018 SPARKL Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the sample logging framework in python_scripts/log_framework.
+
+These tests do not need a running SPARKL instance. The events are
+built locally in the shape sent by `sparkl listen`.
+"""
+
+import asyncio
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from urllib.request import urlopen
+import pytest
+
+# The log framework modules import each other as top-level modules.
+LOG_FRAMEWORK_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', '..', 'python_scripts', 'log_framework'))
+sys.path.insert(0, LOG_FRAMEWORK_DIR)
+
+# pylint: disable=wrong-import-position
+from log_exception import LogException  # noqa: E402
+from log_framework import log_frame, apply_filters, \
+    apply_filter_plans, compile_functions  # noqa: E402
+from filter_expr import compile_filter  # noqa: E402
+from field_index import get_field_index, field_attr  # noqa: E402
+from adaptive_order import AdaptiveOrder, side_effects  # noqa: E402
+from log_framework_async import log_frame_async  # noqa: E402
+from dispatch import WorkerPool, BLOCK, DROP_NEWEST, \
+    DROP_OLDEST  # noqa: E402
+from sharding import log_frame_sharded, service_key  # noqa: E402
+from frame_stats import FrameStats, serve_prometheus  # noqa: E402
+from synthetic_events import synthetic_events, choice  # noqa: E402
+from windows import WindowAggregator  # noqa: E402
+from dedup import Deduplicator  # noqa: E402
+from throttle import RateLimiter, Sampler, ReservoirSampler  # noqa: E402
+from router import TopicRouter  # noqa: E402
+from interval_index import RangeRules, filter_range_rules  # noqa: E402
+from sinks import BufferedSink, StdoutSink, JsonLinesSink  # noqa: E402
+from spill_queue import SpillQueue, Empty  # noqa: E402
+from checkpoint import Checkpointer  # noqa: E402
+from patterns import PatternMatcher, compile_pattern  # noqa: E402
+from tracer import TransactionTracer  # noqa: E402
+from heavy_hitters import HeavyHitters, field_key  # noqa: E402
+from event import Event, wrap_events  # noqa: E402
+from hot_reload import FilterReloader  # noqa: E402
+from listen_reader import ListenReader, BatchReader  # noqa: E402
+from capture import (CaptureWriter, record_events, read_capture,  # noqa: E402
+                     replay_events)
+from sample_filters import (generic_filter_fun, filter_tag,  # noqa: E402
+                            filter_name, filter_field, filter_field_values)
+
+# Filters used by the sample in log_framework/main.py.
+SAMPLE_FILTERS = [
+    (filter_tag, ('solicit',), {}),
+    (filter_name, ('CheckPrime',), {}),
+    (filter_field, ('n',), {}),
+    (filter_field_values, ('n',), {'min_val': 1, 'max_val': 14})]
+
+
+def make_event(value, tag='solicit', name='CheckPrime'):
+    """
+    Builds an event in the shape of a CheckPrime solicit.
+    """
+    return {
+        'tag': tag,
+        'attr': {'name': name, 'svc': 'Sequencer'},
+        'content': [
+            {'tag': 'field',
+             'attr': {'type': 'integer', 'name': 'n', 'value': value}}]}
+
+
+def make_events(count):
+    """
+    Yields CheckPrime solicits, with n cycling between 0 and 19.
+    """
+    for index in range(count):
+        yield make_event(index % 20)
+
+
+# SAMPLE_FILTERS as a filter expression.
+SAMPLE_EXPR = ('tag == "solicit" and name == "CheckPrime" and '
+               'has_field("n") and 1 < field("n") < 14')
+
+# Events for testing filters.
+MIXED_EVENTS = [
+    make_event(3),
+    make_event(20),
+    make_event(3, tag='response'),
+    make_event(3, name='Test'),
+    {'tag': 'solicit', 'attr': {'name': 'CheckPrime'}, 'content': []},
+    {'tag': 'notify', 'attr': {}, 'content': []}]
+
+
+class CountingContent(list):
+    """
+    Event content counting how many times it is scanned.
+    """
+    scans = 0
+
+    def __iter__(self):
+        """
+        Counts the scan and iterates the fields.
+        """
+        self.scans += 1
+        return list.__iter__(self)
+
+
+@generic_filter_fun
+def filter_n_is_odd(event):
+    """
+    User-written filter using the field index.
+    """
+    return get_field_index(event).value('n') % 2 == 1
+
+
+@side_effects
+def count_filtered(event, counter):
+    """
+    Filter with a side effect, counting the events it sees.
+    """
+    counter[0] += 1
+    return True
+
+
+def make_mixed_stream(count):
+    """
+    Yields CheckPrime events, 1 in 20 being a solicit.
+    """
+    for index in range(count):
+        tag = 'solicit' if index % 20 == 0 else 'response'
+        yield make_event(index % 13, tag=tag)
+
+
+def collect(event, collected, extra, label=None):
+    """
+    on_event function storing the arguments it receives.
+    """
+    collected.append((event['content'][0]['attr']['value'], extra, label))
+
+
+def count_call(event, counter):
+    """
+    on_event function counting the events received.
+    """
+    counter[0] += 1
+
+
+def test_on_event_arguments():
+    """
+    Each matched event is passed to on_event with the original
+    arguments only, no matter how many events matched before.
+    """
+    collected = []
+    on_event = (collect, (collected, 'extra'), {'label': 'x'})
+    log_frame(make_events(40), SAMPLE_FILTERS, on_event=on_event)
+
+    expected = [(value, 'extra', 'x') for value in range(2, 14)] * 2
+    assert collected == expected
+
+
+def test_long_run_memory():
+    """
+    The memory used by log_frame does not grow with
+    the number of matched events.
+    """
+    counter = [0]
+    on_event = (count_call, (counter,), {})
+
+    tracemalloc.start()
+    try:
+        log_frame(make_events(2000), SAMPLE_FILTERS, on_event=on_event)
+        short_run, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        log_frame(make_events(100000), SAMPLE_FILTERS, on_event=on_event)
+        _current, long_run_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert counter[0] == 12 * (100 + 5000)
+
+    # A growing argument tuple would hold ~60000 event references here.
+    assert long_run_peak - short_run < 64 * 1024
+
+
+def test_filter_expr_matches_sample_filters():
+    """
+    The compiled expression lets through the same
+    events as the equivalent filter functions.
+    """
+    sample_plans = compile_functions(SAMPLE_FILTERS)
+    expr_plans = compile_functions([compile_filter(SAMPLE_EXPR)])
+
+    for event in MIXED_EVENTS:
+        assert apply_filter_plans(event, sample_plans) == \
+            apply_filter_plans(event, expr_plans)
+
+
+def test_filter_expr_default():
+    """
+    The compiled expression returns its default value on errors.
+    """
+    event = make_event(3)
+    del event['attr']['name']
+
+    filter_fun, _args, _kwargs = compile_filter('name == "CheckPrime"')
+    assert filter_fun(event) is True
+
+    filter_fun, _args, _kwargs = compile_filter('name == "CheckPrime"',
+                                                default=False)
+    assert filter_fun(event) is False
+
+
+def test_filter_expr_default_per_operand():
+    """
+    The default applies to each operand of and/or, as to each
+    filter of the equivalent list of sample filters.
+    """
+    event = {'tag': 'notify', 'attr': {}, 'content': []}
+    filters = [(filter_name, ('CheckPrime',), {}),
+               (filter_tag, ('solicit',), {})]
+
+    for expression, expected in [
+            ('name == "CheckPrime" and tag == "solicit"', False),
+            ('name == "CheckPrime" and tag == "notify"', True),
+            ('tag == "solicit" or name == "CheckPrime"', True),
+            ('not (name == "CheckPrime") or tag == "notify"', True)]:
+        filter_fun, _args, _kwargs = compile_filter(expression)
+        assert filter_fun(event) is expected
+
+    assert apply_filters(event, filters) is False
+
+
+@pytest.mark.parametrize('expression', [
+    'tag ==',
+    'event["tag"] == "solicit"',
+    'tag.startswith("s")',
+    '__import__("os")',
+    'field(n)',
+    'lambda: True'])
+def test_filter_expr_invalid(expression):
+    """
+    Invalid expressions are rejected when compiled.
+    """
+    with pytest.raises(LogException):
+        compile_filter(expression)
+
+
+def test_field_index_built_once():
+    """
+    All filters applied to an event share one field index,
+    and the content of the event is only scanned once.
+    """
+    event = make_event(3)
+    event['content'] = CountingContent(event['content'])
+    filters = SAMPLE_FILTERS + [(filter_n_is_odd, (), {}),
+                                compile_filter('field("n") == 3')]
+
+    assert apply_filters(event, filters) is event
+    assert event['content'].scans == 1
+
+    # The next event gets a new index.
+    event['content'][0]['attr']['value'] = 4
+    assert apply_filters(event, filters) is False
+    assert event['content'].scans == 2
+
+
+def test_field_attr():
+    """
+    Stages look fields up through the shared index, getting
+    None for missing fields and malformed content.
+    """
+    event = make_event(3)
+    event['content'] = CountingContent(event['content'])
+
+    assert field_attr(event, 'n')['value'] == 3
+    assert field_attr(event, 'div') is None
+    assert event['content'].scans == 1
+
+    for content in (None, [{'tag': 'field'}]):
+        assert field_attr({'tag': 'solicit', 'content': content}, 'n') is None
+
+
+def test_adaptive_order():
+    """
+    The most selective filter is moved to the front, and the
+    filters let through the same events as in list order.
+    """
+    filters = [(filter_name, ('CheckPrime',), {}),
+               (filter_field, ('n',), {}),
+               (filter_tag, ('solicit',), {})]
+
+    expected = []
+    log_frame(make_mixed_stream(4000), filters,
+              on_event=(collect, (expected, None), {}))
+
+    collected = []
+    filter_order = AdaptiveOrder(reorder_every=500, time_every=1)
+    log_frame(make_mixed_stream(4000), filters,
+              on_event=(collect, (collected, None), {}),
+              filter_order=filter_order)
+
+    assert collected == expected
+    assert filter_order.order()[0] == (2, 'filter_tag')
+
+    # Before the first reordering, all filters see all events.
+    # After it, the other filters only see solicits.
+    stats = filter_order.statistics()
+    assert stats[0]['calls'] == 4000
+    assert stats[0]['pass_rate'] == 0.05
+    assert [x['calls'] for x in stats[1:]] == [500 + 175, 500 + 175]
+
+
+def test_adaptive_order_pinned():
+    """
+    Filters with side effects and pinned filters stay in place.
+    """
+    counter = [0]
+    filters = [(filter_name, ('CheckPrime',), {}),
+               (count_filtered, (counter,), {}),
+               (filter_field, ('n',), {}),
+               (filter_tag, ('solicit',), {})]
+
+    filter_order = AdaptiveOrder(reorder_every=100, pinned=[0])
+    log_frame(make_mixed_stream(1000), filters,
+              on_event=(count_call, ([0],), {}), filter_order=filter_order)
+
+    positions = [position for position, _name in filter_order.order()]
+    assert positions == [0, 1, 3, 2]
+    assert counter[0] == 1000
+
+
+def test_batch_mode():
+    """
+    Batch mode lets through the same events, in the same order,
+    as filtering event by event.
+    """
+    pytest.importorskip('numpy')
+    from batch_filters import BatchMode
+
+    events = (MIXED_EVENTS + list(make_mixed_stream(500))) * 3
+    events.insert(5, {'tag': 'solicit', 'attr': {'name': 'CheckPrime'},
+                      'content': [{'attr': {'name': 'n', 'value': 'x'}}]})
+    events.insert(9, {'tag': ['solicit'], 'attr': {'name': 'CheckPrime'},
+                      'content': [{'attr': {'name': 'n', 'value': 3}}]})
+    filters = SAMPLE_FILTERS + [(filter_n_is_odd, (), {})]
+
+    expected = []
+    log_frame(iter(events), filters, on_event=(collect, (expected, None), {}))
+
+    collected = []
+    log_frame(iter(events), filters, on_event=(collect, (collected, None), {}),
+              batch=BatchMode(size=64))
+
+    assert collected == expected
+    assert ('x', None, None) in collected
+
+
+def quiet_events(events, resumed):
+    """
+    Yields the events, then blocks until resumed,
+    as a listen stream without new events would.
+    """
+    for event in events:
+        yield event
+    resumed.wait(5.0)
+
+
+def resume_on_event(event, collected, resumed):
+    """
+    on_event function resuming the events.
+    """
+    collected.append(event)
+    resumed.set()
+
+
+def test_batch_reader():
+    """
+    A BatchReader hands the events over in full batches, and
+    the events left in a last, partial one.
+    """
+    batches = list(BatchReader(iter(range(10)), size=4, interval=10))
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    with pytest.raises(LogException):
+        BatchReader(iter([]), size=0)
+
+
+def test_batch_mode_flushes_on_quiet_stream():
+    """
+    A batch that is not full is passed on after the interval,
+    even if the events generator blocks.
+    """
+    pytest.importorskip('numpy')
+    from batch_filters import BatchMode
+
+    resumed = threading.Event()
+    collected = []
+    started = time.time()
+    log_frame(quiet_events([make_event(3)], resumed), SAMPLE_FILTERS,
+              on_event=(resume_on_event, (collected, resumed), {}),
+              batch=BatchMode(size=1000, interval=0.05))
+
+    assert len(collected) == 1
+    assert time.time() - started < 2.0
+
+
+def test_batch_mode_events_error():
+    """
+    Errors of the events generator are raised after
+    the events read before them are filtered.
+    """
+    pytest.importorskip('numpy')
+    from batch_filters import BatchMode
+
+    def failing():
+        """
+        Yields events, then fails.
+        """
+        for event in make_events(10):
+            yield event
+        raise ValueError('Connection lost')
+
+    collected = []
+    with pytest.raises(ValueError):
+        log_frame(failing(), SAMPLE_FILTERS,
+                  on_event=(collect, (collected, None), {}),
+                  batch=BatchMode(size=1000, interval=10))
+    assert [x[0] for x in collected] == list(range(2, 10))
+
+
+async def async_stream(events, delay=0):
+    """
+    Yields the events as an async iterator.
+    """
+    for event in events:
+        await asyncio.sleep(delay)
+        yield event
+
+
+async def async_filter_odd(event):
+    """
+    Coroutine filter letting through events with an odd n.
+    """
+    await asyncio.sleep(0)
+    return event['content'][0]['attr']['value'] % 2 == 1
+
+
+async def async_collect(event, collected, running, peak=None):
+    """
+    Coroutine on_event function tracking the number of calls
+    running at the same time.
+    """
+    running.append(len(running))
+    if peak is not None:
+        peak[0] = max(peak[0], len(running))
+    await asyncio.sleep(0.01)
+    collected.append(event['content'][0]['attr']['value'])
+    running.pop()
+
+
+async def async_exit(exited):
+    """
+    Coroutine on_exit function.
+    """
+    exited.append(True)
+
+
+def test_log_frame_async():
+    """
+    Coroutine filters and on_event functions are awaited, with at
+    most concurrency on_event calls running at the same time.
+    """
+    collected = []
+    running = []
+    peak = [0]
+    exited = []
+    filters = SAMPLE_FILTERS + [(async_filter_odd, (), {})]
+
+    asyncio.run(log_frame_async(
+        async_stream(make_events(100)), filters,
+        on_event=(async_collect, (collected, running), {'peak': peak}),
+        on_exit=(async_exit, (exited,), {}),
+        concurrency=3))
+
+    assert sorted(collected) == sorted([3, 5, 7, 9, 11, 13] * 5)
+    assert exited == [True]
+    assert not running
+    assert peak[0] == 3
+
+
+def test_log_frame_async_cancelled():
+    """
+    The on_exit function is called when log_frame_async is cancelled.
+    """
+    collected = []
+    exited = []
+
+    async def run():
+        """
+        Cancels log_frame_async while it waits for events.
+        """
+        task = asyncio.ensure_future(log_frame_async(
+            async_stream(make_events(1000), delay=0.01), SAMPLE_FILTERS,
+            on_event=(async_collect, (collected, []), {}),
+            on_exit=(async_exit, (exited,), {})))
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert exited == [True]
+    assert len(collected) < 100
+
+
+def slow_collect(event, collected, delay=0.0, gate=None):
+    """
+    on_event function collecting the svc and n of the event,
+    optionally waiting for a gate to open.
+    """
+    if gate:
+        gate.wait()
+    time.sleep(delay)
+    collected.append((event['attr']['svc'],
+                      event['content'][0]['attr']['value']))
+
+
+def check_collected(collected, exit_log):
+    """
+    on_exit function logging the number of events handled.
+    """
+    exit_log.append(len(collected))
+
+
+def make_service_events(count, services=4):
+    """
+    Yields events of several services, with increasing n values.
+    """
+    for index in range(count):
+        event = make_event(index)
+        event['attr']['svc'] = 'svc_{}'.format(index % services)
+        yield event
+
+
+def test_worker_pool_key_order():
+    """
+    Events with the same key are handled in order, and all queued
+    events are handled before on_exit is called.
+    """
+    collected = []
+    exit_log = []
+    pool = WorkerPool(workers=3, maxsize=5,
+                      key=lambda event: event['attr']['svc'])
+
+    log_frame(make_service_events(200), [],
+              on_event=(slow_collect, (collected,), {'delay': 0.001}),
+              on_exit=(check_collected, (collected, exit_log), {}),
+              dispatcher=pool)
+
+    assert exit_log == [200]
+    for service in ['svc_0', 'svc_1', 'svc_2', 'svc_3']:
+        values = [value for svc, value in collected if svc == service]
+        assert values == sorted(values)
+        assert len(values) == 50
+
+    stats = pool.stats()
+    assert stats['handled'] == stats['submitted'] == 200
+    assert stats['max_depth'] <= 5
+    assert stats['depth'] == 0
+
+
+@pytest.mark.parametrize('policy, handled, counter', [
+    (DROP_NEWEST, [0, 1, 2, 3, 4], 'dropped_newest'),
+    (DROP_OLDEST, [0, 16, 17, 18, 19], 'dropped_oldest')])
+def test_worker_pool_drop(policy, handled, counter):
+    """
+    When the queue is full, either the new or the oldest event
+    is dropped, and the drops are counted.
+    """
+    collected = []
+    gate = threading.Event()
+    pool = WorkerPool(workers=1, maxsize=4, policy=policy)
+    pool.start(lambda event: slow_collect(event, collected, gate=gate))
+
+    for event in make_events(20):
+        pool.submit(event)
+        # Let the worker pick up the first event and wait on the gate.
+        time.sleep(0.01)
+
+    gate.set()
+    pool.shutdown()
+
+    # The worker holds the first event, the queue four others.
+    assert [value for _svc, value in collected] == handled
+
+    stats = pool.stats()
+    assert stats['submitted'] == 20
+    assert stats['handled'] == 5
+    assert stats[counter] == 15
+
+
+def put_event(event, event_queue):
+    """
+    on_event function sending the svc, n and worker process
+    of the event back to the test.
+    """
+    event_queue.put((event['attr']['svc'],
+                     event['content'][0]['attr']['value'],
+                     multiprocessing.current_process().name))
+
+
+def put_exit(event_queue):
+    """
+    on_worker_exit function.
+    """
+    event_queue.put('exit')
+
+
+def test_log_frame_sharded():
+    """
+    The workers filter all events, events with the same key
+    are handled by the same worker, in order, and on_exit is
+    called once all workers stopped.
+    """
+    event_queue = multiprocessing.Queue()
+    exit_log = []
+
+    log_frame_sharded(
+        make_service_events(400), [(filter_field, ('n',), {})],
+        on_event=(put_event, (event_queue,), {}),
+        on_exit=(exit_log.append, (True,), {}),
+        on_worker_exit=(put_exit, (event_queue,), {}),
+        workers=3, key=service_key, chunk_size=16)
+
+    results = [event_queue.get(timeout=5) for _ in range(400 + 3)]
+    assert exit_log == [True]
+    assert results.count('exit') == 3
+
+    by_service = {}
+    for result in results:
+        if result != 'exit':
+            svc, value, worker = result
+            by_service.setdefault(svc, []).append((value, worker))
+
+    assert len(by_service) == 4
+    for handled in by_service.values():
+        values = [value for value, _worker in handled]
+        assert values == sorted(values)
+        assert len(set(worker for _value, worker in handled)) == 1
+
+
+def fail_on_odd(event, event_queue):
+    """
+    on_event function failing on the events with an odd n.
+    """
+    if event['content'][0]['attr']['value'] % 2:
+        raise ValueError('odd')
+    event_queue.put(event['content'][0]['attr']['value'])
+
+
+def exit_worker(event):
+    """
+    on_event function making the worker exit, as if killed.
+    """
+    os._exit(3)
+
+
+def test_log_frame_sharded_worker_errors():
+    """
+    on_event errors do not stop the workers, and an exited
+    worker raises a LogException instead of blocking.
+    """
+    event_queue = multiprocessing.Queue()
+    exit_log = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        log_frame_sharded(
+            make_service_events(2000), [],
+            on_event=(fail_on_odd, (event_queue,), {}),
+            workers=2, chunk_size=16, maxsize=2)
+    handled = [event_queue.get(timeout=5) for _ in range(1000)]
+    assert sorted(handled) == list(range(0, 2000, 2))
+
+    started = time.time()
+    with pytest.raises(LogException):
+        log_frame_sharded(
+            make_service_events(2000), [],
+            on_event=(exit_worker, (), {}),
+            on_exit=(exit_log.append, (True,), {}),
+            workers=2, key=service_key, chunk_size=16, maxsize=2)
+    assert exit_log == [True]
+    assert time.time() - started < 10
+
+
+def test_log_frame_sharded_quiet_stream():
+    """
+    Matched events reach the workers after chunk_interval,
+    even if the events generator blocks.
+    """
+    event_queue = multiprocessing.Queue()
+    resumed = threading.Event()
+    handled = []
+
+    def wait_for_event():
+        """
+        Resumes the events once a worker handled the first one.
+        """
+        handled.append(event_queue.get(timeout=5))
+        resumed.set()
+
+    waiter = threading.Thread(target=wait_for_event)
+    waiter.start()
+    started = time.time()
+
+    log_frame_sharded(quiet_events(list(make_service_events(1)), resumed), [],
+                      on_event=(put_event, (event_queue,), {}),
+                      workers=1, chunk_interval=0.05)
+    waiter.join()
+
+    assert len(handled) == 1
+    assert time.time() - started < 4.0
+
+
+def test_frame_stats():
+    """
+    The stats count the calls, results and errors of each
+    filter and of on_event, and export them for Prometheus.
+    """
+    events = list(make_events(40))
+    events[0]['content'] = []
+    stats = FrameStats()
+    log_frame(iter(events), SAMPLE_FILTERS,
+              on_event=(count_call, ([0],), {}), stats=stats)
+
+    snapshot = stats.snapshot()
+    assert snapshot['events'] == 40
+
+    functions = {x['name']: x for x in snapshot['functions']}
+    assert functions['filter_tag']['passes'] == 40
+    assert functions['filter_field']['rejects'] == 1
+    assert functions['filter_field_values']['calls'] == 39
+    assert functions['filter_field_values']['passes'] == 24
+    assert functions['on_event']['calls'] == 24
+    assert functions['on_event']['errors'] == 0
+    assert 0 < functions['on_event']['p50'] <= functions['on_event']['p99']
+
+    # The field value filter fails on a field without a value.
+    events[1]['content'][0]['attr'].pop('value')
+    log_frame(iter(events[:2]), SAMPLE_FILTERS, stats=stats)
+    functions = {x['name']: x for x in stats.snapshot()['functions']}
+    assert functions['filter_field_values']['errors'] == 1
+
+    server = serve_prometheus(stats, port=0)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        with contextlib.closing(urlopen(url)) as response:
+            text = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'log_frame_events_total 2' in text
+    assert ('log_frame_errors_total{function="filter_field_values",'
+            'position="3"} 1') in text
+    assert 'log_frame_seconds_count{function="filter_tag",position="0"} 2' \
+        in text
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_capture_replay(tmp_path, compress):
+    """
+    Recorded events are replayed in order, and appending
+    to a capture keeps the earlier events.
+    """
+    path = str(tmp_path / 'events.cap')
+    events = list(make_events(30))
+
+    recorded = list(record_events(iter(events[:20]), path, compress=compress,
+                                  flush_every=7))
+    assert recorded == events[:20]
+    list(record_events(iter(events[20:]), path, compress=compress))
+
+    assert list(replay_events(path, speed=None)) == events
+
+    timestamps = [timestamp for timestamp, _event in read_capture(path)]
+    assert timestamps == sorted(timestamps)
+
+
+def test_capture_speed(tmp_path):
+    """
+    Replay keeps the spacing of the events, scaled by speed, and
+    ignores a truncated last record.
+    """
+    path = str(tmp_path / 'events.cap')
+    writer = CaptureWriter(path)
+    for index, event in enumerate(make_events(5)):
+        writer.write(event, timestamp=1000.0 + index * 0.1)
+    writer.close()
+
+    with open(path, 'ab') as capture:
+        capture.write(b'\x00\x01')
+
+    start = time.time()
+    assert len(list(replay_events(path, speed=2.0))) == 5
+    assert 0.18 <= time.time() - start < 1.0
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_capture_append_after_crash(tmp_path, compress):
+    """
+    Appending to an uncompressed capture with a truncated last record
+    drops that record. Reading a compressed one stops at the truncated
+    gzip member.
+    """
+    path = str(tmp_path / 'events.cap')
+    events = list(make_events(6))
+
+    list(record_events(iter(events[:3]), path, compress=compress))
+    with open(path, 'r+b') as capture:
+        capture.truncate(os.path.getsize(path) - 5)
+    list(record_events(iter(events[3:]), path, compress=compress))
+
+    replayed = list(replay_events(path, speed=None))
+    if compress:
+        assert replayed == events[:len(replayed)]
+    else:
+        assert replayed == events[:2] + events[3:]
+
+
+def test_synthetic_events():
+    """
+    Synthetic events follow the requested tag mix, fields and
+    values, and are repeatable with a seed.
+    """
+    events = list(synthetic_events(
+        200, seed=3, tag_mix={'solicit': 1, 'notify': 0},
+        field_names=('n',), field_count=5, values=choice([7])))
+
+    assert events == list(synthetic_events(
+        200, seed=3, tag_mix={'solicit': 1, 'notify': 0},
+        field_names=('n',), field_count=5, values=choice([7])))
+    assert set(event['tag'] for event in events) == {'solicit'}
+    assert [x['attr']['name'] for x in events[0]['content']] == \
+        ['n', 'field_1', 'field_2', 'field_3', 'field_4']
+
+    collected = []
+    log_frame(iter(events), SAMPLE_FILTERS,
+              on_event=(collect, (collected, None), {}))
+    assert len(collected) == \
+        len([x for x in events if x['attr']['name'] == 'CheckPrime'])
+
+
+def timed_event(seconds, value, name='CheckPrime'):
+    """
+    Builds an event with its time in the t attribute.
+    """
+    event = make_event(value, name=name)
+    event['attr']['t'] = seconds
+    return event
+
+
+def event_time(event):
+    """
+    Returns the time of a timed_event.
+    """
+    return event['attr']['t']
+
+
+def test_tumbling_window():
+    """
+    Each key is aggregated per window, and the
+    last window is closed when the events stop.
+    """
+    windows = []
+    aggregator = WindowAggregator((windows.append, (), {}), field_name='n',
+                                  window=10, timestamp=event_time)
+    events = [timed_event(1, 2), timed_event(5, 6), timed_event(7, 4, 'Test'),
+              timed_event(12, 8), timed_event(45, 10)]
+    handled = []
+
+    log_frame(iter(events), [], on_event=(handled.append, (), {}),
+              stages=[aggregator])
+
+    assert handled == []
+    assert [(x['key'], x['start'], x['count'], x['sum'], x['min'], x['max'],
+             x['mean']) for x in windows] == [
+        ('CheckPrime', 0, 2, 8, 2, 6, 4.0),
+        ('Test', 0, 1, 4, 4, 4, 4.0),
+        ('CheckPrime', 10, 1, 8, 8, 8, 8.0),
+        ('CheckPrime', 40, 1, 10, 10, 10, 10.0)]
+    assert aggregator.buckets == {}
+
+
+def test_sliding_window():
+    """
+    Sliding windows overlap, and only the buckets
+    of the current window are kept.
+    """
+    windows = []
+    aggregator = WindowAggregator((windows.append, (), {}), field_name='n',
+                                  window=30, slide=10, timestamp=event_time,
+                                  passthrough=True)
+    handled = []
+    events = [timed_event(seconds, seconds) for seconds in range(0, 60, 5)]
+
+    log_frame(iter(events), [], on_event=(handled.append, (), {}),
+              stages=[aggregator])
+
+    assert handled == events
+    assert [(x['start'], x['end'], x['count'], x['sum']) for x in windows] \
+        == [(-20, 10, 2, 5), (-10, 20, 4, 30), (0, 30, 6, 75),
+            (10, 40, 6, 135), (20, 50, 6, 195), (30, 60, 6, 255)]
+
+    with pytest.raises(LogException):
+        WindowAggregator((windows.append, (), {}), window=30, slide=7)
+
+
+@pytest.mark.parametrize('bloom', [False, True])
+def test_dedup_before_filters(bloom):
+    """
+    Duplicates are dropped before the filters see them.
+    """
+    counter = [0]
+    dedup = Deduplicator(bloom=bloom, capacity=1000)
+    events = [make_event(value % 5) for value in range(20)]
+    handled = []
+
+    log_frame(iter(events), [(count_filtered, (counter,), {})],
+              on_event=(handled.append, (), {}), pre_stages=[dedup])
+
+    assert handled == events[:5]
+    assert counter == [5]
+    assert dedup.stats()['hits'] == 15
+    assert dedup.stats()['misses'] == 5
+
+
+def test_dedup_ttl_and_maxsize():
+    """
+    Fingerprints expire after ttl seconds, and
+    at most maxsize fingerprints are kept.
+    """
+    now = [0.0]
+    dedup = Deduplicator(fingerprint=lambda event: event['attr']['t'],
+                         maxsize=2, ttl=10, clock=lambda: now[0])
+
+    assert dedup.process(timed_event(1, 0))
+    assert dedup.process(timed_event(1, 0)) is None
+
+    now[0] = 10.0
+    assert dedup.process(timed_event(1, 0))
+
+    assert dedup.process(timed_event(2, 0))
+    assert dedup.process(timed_event(3, 0))
+    assert dedup.process(timed_event(1, 0))
+    assert dedup.stats() == {
+        'hits': 1, 'misses': 5, 'evictions': 3, 'size': 2}
+
+
+def test_dedup_lru_order():
+    """
+    A duplicate becomes the most recently seen fingerprint, so
+    eviction drops the least recently seen one, and its ttl
+    runs from when it was last seen.
+    """
+    now = [0.0]
+    dedup = Deduplicator(fingerprint=lambda event: event['attr']['t'],
+                         maxsize=2, ttl=10, clock=lambda: now[0])
+
+    assert [dedup.process(timed_event(t, 0)) is not None
+            for t in (1, 2, 1, 3, 1)] == [True, True, False, True, False]
+
+    now[0] = 8.0
+    assert dedup.process(timed_event(1, 0)) is None
+    now[0] = 15.0
+    assert dedup.process(timed_event(1, 0)) is None
+    assert dedup.process(timed_event(3, 0))
+
+
+def test_dedup_bloom_evictions():
+    """
+    Rotating the Bloom filters evicts the fingerprints of the
+    dropped filter, not of the one still consulted.
+    """
+    dedup = Deduplicator(fingerprint=lambda event: event['attr']['t'],
+                         bloom=True, capacity=2)
+
+    for fingerprint in (1, 2, 3):
+        assert dedup.process(timed_event(fingerprint, 0))
+    assert dedup.stats()['evictions'] == 0
+    assert dedup.process(timed_event(1, 0)) is None
+
+    for fingerprint in (4, 5):
+        assert dedup.process(timed_event(fingerprint, 0))
+    assert dedup.stats()['evictions'] == 2
+    assert dedup.process(timed_event(1, 0))
+
+
+def test_rate_limiter():
+    """
+    Each key gets a burst, then rate events per second,
+    and the events held back are counted.
+    """
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=3, clock=lambda: now[0])
+    events = [make_event(1)] * 5 + [make_event(1, name='Test')]
+
+    assert [limiter.process(x) is not None for x in events] == \
+        [True, True, True, False, False, True]
+
+    now[0] = 1.0
+    assert [limiter.process(x) is not None for x in events[:3]] == \
+        [True, True, False]
+    assert limiter.stats() == {
+        'passed': 6, 'suppressed': 3,
+        'passed_per_key': {'CheckPrime': 5, 'Test': 1},
+        'suppressed_per_key': {'CheckPrime': 3}}
+
+
+def test_sampling():
+    """
+    Sampled events reach on_event, the others are counted.
+    """
+    handled = []
+    sampler = Sampler(0.25, probabilities={'Test': 1}, seed=1)
+    events = [make_event(1, name=name) for name in ['CheckPrime', 'Test']
+              for _ in range(1000)]
+
+    log_frame(iter(events), [], on_event=(handled.append, (), {}),
+              stages=[sampler])
+
+    stats = sampler.stats()
+    assert len(handled) == stats['passed']
+    assert stats['passed_per_key']['Test'] == 1000
+    assert 200 < stats['passed_per_key']['CheckPrime'] < 300
+    assert stats['suppressed'] == 2000 - len(handled)
+
+    sampled = []
+    reservoir = ReservoirSampler((sampled.append, (), {}), size=5, seed=1)
+    log_frame(iter(events), [], stages=[reservoir])
+
+    assert len(sampled) == 10
+    assert reservoir.stats()['suppressed_per_key'] == {
+        'CheckPrime': 995, 'Test': 995}
+
+
+def path_event(tag, path, value=3):
+    """
+    Builds an event carrying the full path of its operation.
+    """
+    event = make_event(value, tag=tag, name=path.rsplit('/')[-1])
+    event['attr'][tag] = path
+    return event
+
+
+def fail_on_event(event):
+    """
+    on_event function always failing.
+    """
+    raise ValueError('Failed on {}'.format(event['tag']))
+
+
+def test_topic_router():
+    """
+    Each event reaches the subscriptions matching its tag, name, path
+    prefix and filters, and a failing subscription does not stop others.
+    """
+    router = TopicRouter()
+    received = {}
+
+    def subscribe(label, filter_funs=None, **kwargs):
+        received[label] = []
+        return router.subscribe(filter_funs or [],
+                                (received[label].append, (), {}), **kwargs)
+
+    subscribe('all')
+    subscribe('solicits', tag='solicit')
+    subscribe('primes', path='Scratch/Primes')
+    subscribe('check_prime', name='CheckPrime', path='Scratch/Primes/Seq')
+    subscribe('small', SAMPLE_FILTERS, tag='solicit')
+    unsubscribed = subscribe('unsubscribed', tag='solicit', name='Test')
+    router.subscribe([], (fail_on_event, (), {}), tag='response')
+    router.unsubscribe(unsubscribed)
+
+    events = [path_event('solicit', 'Scratch/Primes/Seq/CheckPrime'),
+              path_event('solicit', 'Scratch/Primes/Seq/CheckPrime', 20),
+              path_event('response', 'Scratch/Primes/Seq/Test'),
+              path_event('solicit', 'Scratch/Prime/Seq/Test'),
+              path_event('notify', 'Scratch/Other/Update')]
+
+    log_frame(iter(events), [], on_event=(router.route, (), {}))
+
+    assert received == {
+        'all': events,
+        'solicits': [events[0], events[1], events[3]],
+        'primes': events[:3],
+        'check_prime': events[:2],
+        'small': events[:1],
+        'unsubscribed': []}
+    assert router.stats()[-1] == {
+        'tag': 'response', 'name': None, 'path': None,
+        'matched': 1, 'errors': 1}
+    assert router.by_path.children.keys() == {'Scratch'}
+    assert set(router.by_tag) == {'solicit', 'response'}
+    assert set(router.by_name) == {'CheckPrime'}
+
+
+def routing_time(router, events):
+    """
+    Returns the shortest time, of several runs, routing the events.
+    """
+    timings = []
+    for _ in range(5):
+        started = time.perf_counter()
+        for event in events:
+            router.route(event)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def test_topic_router_scales():
+    """
+    Routing does not slow down as subscriptions for
+    other names, paths and tags are added.
+    """
+    router = TopicRouter()
+    received = []
+    on_event = (received.append, (), {})
+    router.subscribe([], on_event)
+    router.subscribe([], on_event, tag='solicit', name='CheckPrime')
+    router.subscribe([], on_event, path='Scratch/Primes')
+    events = [path_event('solicit', 'Scratch/Primes/Seq/CheckPrime')] * 200
+
+    few = routing_time(router, events)
+    assert len(received) == 3 * 200 * 5
+
+    for index in range(20000):
+        router.subscribe([], on_event, name='Op{}'.format(index))
+        router.subscribe([], on_event, tag='solicit',
+                         name='Op{}'.format(index))
+        router.subscribe([], on_event, path='Other/{}'.format(index))
+        router.subscribe([], on_event, tag='tag{}'.format(index))
+
+    many = routing_time(router, events)
+    assert many < few * 5
+
+
+def test_range_rules_match_brute_force():
+    """
+    The rules matching a value are those filter_field_values
+    would let through, after any inserts and deletes.
+    """
+    rng = random.Random(5)
+    rules = RangeRules()
+    live = {}
+
+    for number in range(2000):
+        low = rng.randint(0, 1000)
+        high = low + rng.randint(1, 100)
+        live[number] = (rules.add('n', low, high, rule=number), low, high)
+
+    for number in rng.sample(sorted(live), 1000):
+        rules.remove(live.pop(number)[0])
+
+    for value in [rng.uniform(-10, 1110) for _ in range(200)] + [0, 500]:
+        expected = sorted(
+            number for number, (_, low, high) in live.items()
+            if filter_field_values(make_event(value), 'n',
+                                   min_val=low, max_val=high))
+        assert sorted(rules.rules_for('n', value)) == expected
+
+    with pytest.raises(LogException):
+        rules.remove(('n', (-1, -1)))
+
+
+def collect_rules(match, matched):
+    """
+    on_match function storing the value of n and the matched rules.
+    """
+    matched.append((match['event']['content'][0]['attr']['value'],
+                    sorted(match['rules'])))
+
+
+def test_range_rules_in_log_frame():
+    """
+    The rules work as a single filter, and as a stage
+    passing the matched rules to on_match.
+    """
+    matched = []
+    rules = RangeRules(on_match=(collect_rules, (matched,), {}))
+    rules.add('n', 0, 5, rule='green')
+    rules.add('n', 3, 10, rule='amber')
+    rules.add('div', 0, 100, rule='other field')
+
+    handled = []
+    log_frame(make_events(20), [(filter_range_rules, (rules,), {})],
+              on_event=(handled.append, (), {}))
+    assert [x['content'][0]['attr']['value'] for x in handled] == \
+        list(range(1, 10))
+
+    log_frame(make_events(10), [], on_event=(handled.append, (), {}),
+              stages=[rules])
+    assert matched[2:5] == [(3, ['green']), (4, ['amber', 'green']),
+                            (5, ['amber'])]
+
+
+def test_stdout_sink():
+    """
+    Events are written in batches, and the last batch on exit.
+    """
+    stream = io.StringIO()
+    sink = StdoutSink(flush_every=5, flush_interval=60, stream=stream)
+
+    log_frame(make_events(40), SAMPLE_FILTERS, sink=sink)
+
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line)['content'][0]['attr']['value']
+            for line in lines] == list(range(2, 14)) * 2
+    assert sink.written == 24
+
+    with pytest.raises(LogException):
+        log_frame(make_events(1), [], on_event=(count_call, ([0],), {}),
+                  sink=sink)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_json_lines_sink_rotation(tmp_path, compress):
+    """
+    The file is rotated over max_bytes, and no event is lost.
+    """
+    path = str(tmp_path / 'events.jsonl')
+    sink = JsonLinesSink(path, max_bytes=1000, compress=compress,
+                         flush_every=3)
+
+    log_frame(make_events(50), [], sink=sink)
+
+    assert len(sink.rotated) > 3
+    opener = gzip.open if compress else open
+    lines = []
+    for rotated in sink.rotated:
+        with opener(rotated, 'rt') as rotated_file:
+            lines.extend(rotated_file.read().splitlines())
+    with open(path) as current_file:
+        lines.extend(current_file.read().splitlines())
+
+    assert [json.loads(line)['content'][0]['attr']['value']
+            for line in lines] == [x % 20 for x in range(50)]
+
+
+def test_json_lines_sink_backup_count(tmp_path):
+    """
+    Only the newest backup_count rotated files are kept,
+    including those of an earlier run.
+    """
+    path = str(tmp_path / 'events.jsonl')
+    sink = JsonLinesSink(path, max_bytes=1000, flush_every=3)
+    log_frame(make_events(50), [], sink=sink)
+    assert len(sink.rotated) > 3
+
+    sink = JsonLinesSink(path, max_bytes=1000, flush_every=3,
+                         compress=True, backup_count=2)
+    assert len(sink.rotated) == 2
+    log_frame(make_events(50), [], sink=sink)
+
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        ['events.jsonl'] + [os.path.basename(x) for x in sink.rotated])
+    assert len(sink.rotated) == 2
+    assert all(x.endswith('.gz') for x in sink.rotated)
+
+
+def test_buffered_sink_writer():
+    """
+    A BufferedSink writes its batches with the writer function.
+    """
+    batches = []
+    sink = BufferedSink(batches.append, flush_every=2)
+    log_frame(make_events(5), [], sink=sink)
+
+    assert [len(x.splitlines()) for x in batches] == [2, 2, 1]
+    with pytest.raises(LogException):
+        BufferedSink(None)
+
+
+def test_sink_flush_interval():
+    """
+    The timer thread writes the buffered events after flush_interval,
+    even if no further event arrives.
+    """
+    stream = io.StringIO()
+    sink = StdoutSink(flush_every=1000, flush_interval=0.05, stream=stream)
+    sink.write(make_event(3))
+
+    deadline = time.time() + 5.0
+    while not stream.getvalue() and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert len(stream.getvalue().splitlines()) == 1
+    sink.close()
+    assert not sink.timer.is_alive()
+    assert sink.written == 1
+
+
+def test_spill_queue(tmp_path):
+    """
+    Events over the memory size are spilled to segment files, and
+    read back in order, either one by one or in bulk.
+    """
+    directory = str(tmp_path / 'spill')
+    event_queue = SpillQueue(directory, memory_size=10, segment_size=7)
+
+    log_frame(make_events(50), [], on_event=(event_queue.put, (), {}))
+
+    assert len(event_queue.memory) == 10
+    assert event_queue.spilled == 40
+    assert len(os.listdir(directory)) == 6
+    assert event_queue.qsize() == 50
+
+    values = [event_queue.get()['content'][0]['attr']['value']
+              for _ in range(15)]
+    event_queue.put(make_event(99))
+    values += [event['content'][0]['attr']['value']
+               for event in event_queue.drain()]
+
+    assert values == [x % 20 for x in range(50)] + [99]
+    assert event_queue.empty()
+    with pytest.raises(Empty):
+        event_queue.get(timeout=0.01)
+
+    event_queue.put(make_event(1))
+    event_queue.close()
+    assert os.listdir(directory) == []
+
+
+def crash_after(events, count):
+    """
+    Yields count events, then fails like a killed listener.
+    """
+    for index, event in enumerate(events):
+        if index == count:
+            raise KeyboardInterrupt
+        yield event
+
+
+def test_checkpoint_resume(tmp_path):
+    """
+    A restarted pipeline restores the stage state of the last
+    snapshot, and carries on counting from there.
+    """
+    path = str(tmp_path / 'pipeline.ckpt')
+    events = [timed_event(seconds, seconds % 7) for seconds in range(30)]
+
+    def run(events):
+        dedup = Deduplicator(fingerprint=event_time)
+        limiter = RateLimiter(rate=1e-9, burst=100)
+        checkpoint = Checkpointer(path, {'dedup': dedup, 'limiter': limiter},
+                                  interval=1e-9, marker=event_time)
+        handled = []
+
+        with pytest.raises(KeyboardInterrupt):
+            log_frame(events, [], on_event=(handled.append, (), {}),
+                      pre_stages=[dedup], stages=[limiter],
+                      checkpoint=checkpoint)
+        return dedup, limiter, checkpoint, handled
+
+    _, _, first, handled = run(crash_after(iter(events[:20]), 15))
+    assert len(handled) == 15
+    assert first.processed == 15 and first.snapshots == 16
+
+    # The first 15 events are duplicates, after the restart.
+    dedup, limiter, second, handled = run(crash_after(iter(events), 25))
+    assert second.resume_marker == 24
+    assert second.processed == 40
+    assert handled == events[15:25]
+    assert dedup.stats()['hits'] == 15
+    assert limiter.stats()['passed'] == 25
+    assert os.listdir(str(tmp_path)) == ['pipeline.ckpt']
+
+    with pytest.raises(LogException):
+        Checkpointer(path, {'handled': handled})
+
+
+def test_checkpoint_open_windows(tmp_path):
+    """
+    The snapshot saved when the events stop holds the windows
+    still open, which the restarted pipeline carries on.
+    """
+    path = str(tmp_path / 'pipeline.ckpt')
+
+    def run(events):
+        windows = []
+        aggregator = WindowAggregator((windows.append, (), {}),
+                                      field_name='n', window=10,
+                                      timestamp=event_time)
+        checkpoint = Checkpointer(path, {'window': aggregator})
+        log_frame(iter(events), [], on_event=(collect, ([], None), {}),
+                  stages=[aggregator], checkpoint=checkpoint)
+        return windows, checkpoint
+
+    run([timed_event(1, 2), timed_event(3, 4)])
+    windows, checkpoint = run([timed_event(5, 6), timed_event(12, 8)])
+
+    assert checkpoint.processed == 4
+    assert [(x['start'], x['count'], x['sum']) for x in windows] == [
+        (0, 3, 12), (10, 1, 8)]
+
+    with pytest.raises(LogException):
+        log_frame(iter([]), [(filter_tag, ('solicit',), {})],
+                  checkpoint=checkpoint, batch=object())
+
+
+def txn_event(seconds, txn, tag, name):
+    """
+    Builds a timed event of a transaction.
+    """
+    event = timed_event(seconds, 3, name=name)
+    event['tag'] = tag
+    event['attr']['txn'] = txn
+    return event
+
+
+def test_pattern_matcher():
+    """
+    Sequences of the same transaction are matched within the time
+    limit, and the runs not completed in time are timed out.
+    """
+    matches = []
+    timeouts = []
+    no_prime = compile_pattern('tag == "solicit" and name == "CheckPrime" ->'
+                               ' tag == "response" and name == "No"',
+                               within=0.5, name='no_prime')
+    matcher = PatternMatcher([no_prime], on_match=(matches.append, (), {}),
+                             on_timeout=(timeouts.append, (), {}),
+                             timestamp=event_time)
+    events = [
+        txn_event(0.0, 'A', 'solicit', 'CheckPrime'),
+        txn_event(0.1, 'B', 'solicit', 'CheckPrime'),
+        txn_event(0.2, 'A', 'request', 'Test'),
+        txn_event(0.3, 'B', 'response', 'No'),
+        txn_event(0.4, 'C', 'solicit', 'CheckPrime'),
+        txn_event(0.45, 'A', 'response', 'Yes'),
+        txn_event(1.0, 'C', 'response', 'No'),
+        txn_event(1.1, 'D', 'solicit', 'CheckPrime')]
+
+    log_frame(iter(events), [], stages=[matcher])
+
+    assert [(x['pattern'], x['key'], x['events'], x['end'])
+            for x in matches] == [('no_prime', 'B', events[1:4:2], 0.3)]
+    assert [(x['key'], x['step'], x['end']) for x in timeouts] == [
+        ('A', 1, 0.5), ('C', 1, 0.9)]
+    assert matcher.stats() == {
+        'matches': 1, 'timeouts': 2, 'evicted': 0, 'runs': 0}
+
+
+def test_pattern_matcher_bounded():
+    """
+    At most max_runs runs are kept.
+    """
+    matcher = PatternMatcher(
+        [compile_pattern('tag == "solicit" -> tag == "response"', 10)],
+        on_match=(count_call, ([0],), {}), max_runs=100,
+        timestamp=event_time)
+    events = (txn_event(index * 0.001, index, 'solicit', 'CheckPrime')
+              for index in range(1000))
+
+    log_frame(events, [], stages=[matcher])
+
+    assert matcher.evicted == 900
+    assert len(matcher.runs) == 0
+
+
+def prime_transaction(txn, start, n):
+    """
+    Returns the events of a CheckPrime transaction, with a
+    Test/Iterate round trip per odd divisor below n, 1 second each.
+    """
+    events = [txn_event(start, txn, 'solicit', 'CheckPrime')]
+    events[0]['content'][0]['attr']['value'] = n
+    seconds = start
+
+    for _ in range(3, n, 2):
+        for name in ('Test', 'Iterate'):
+            events.append(txn_event(seconds + 0.25, txn, 'request', name))
+            events.append(txn_event(seconds + 0.5, txn, 'reply', 'Ok'))
+            seconds += 0.5
+
+    events.append(txn_event(seconds + 1, txn, 'response', 'Yes'))
+    return events
+
+
+def test_transaction_tracer(tmp_path):
+    """
+    Spans, hop counts and critical paths are computed per transaction,
+    and transactions without a response are closed as orphans.
+    """
+    path = str(tmp_path / 'spans.jsonl')
+    tracer = TransactionTracer(sink=JsonLinesSink(path), group_field='n',
+                               timeout=30, timestamp=event_time)
+    events = prime_transaction('A', 0, 5) + prime_transaction('B', 10, 7)
+    events += [txn_event(20, 'C', 'solicit', 'CheckPrime'),
+               txn_event(20, 'D', 'solicit', 'CheckPrime'),
+               txn_event(20.5, 'D', 'response', 'No')]
+
+    handled = []
+    log_frame(iter(events), [], on_event=(handled.append, (), {}),
+              stages=[tracer])
+    assert handled == events
+
+    with open(path) as spans_file:
+        records = [json.loads(line) for line in spans_file]
+    transactions = {x['txn']: x for x in records
+                    if x['type'] == 'transaction'}
+
+    assert transactions['A']['hops'] == 6
+    assert transactions['B']['hops'] == 10
+    assert transactions['B']['latency'] == 3.0
+    assert transactions['B']['critical_path'] == [
+        ['CheckPrime', 3.0, 2.75], ['Iterate', 0.25, 0.25]]
+    assert transactions['C']['orphan']
+    assert transactions['C']['open_spans'] == 1
+
+    summary = tracer.summary()
+    assert summary['transactions'] == 3
+    assert summary['orphans'] == 1
+    assert summary['hops'] == {6: 1, 10: 1, 2: 1}
+    assert summary['operations']['Test']['count'] == 3
+    assert summary['groups'][7]['mean'] == 3.0
+
+
+def test_heavy_hitters():
+    """
+    The top keys of a skewed stream with many distinct keys are
+    found in fixed memory, and old keys fade with half_life.
+    """
+    rng = random.Random(7)
+    paths = ['/files/{}'.format(rng.randint(0, 50000)) for _ in range(20000)]
+    paths += ['/files/hot_{}'.format(index) for index in range(5)
+              for _ in range(500 - index * 50)]
+    rng.shuffle(paths)
+
+    now = [0.0]
+    hitters = HeavyHitters(key=field_key('n'), top=5, width=1024,
+                           clock=lambda: now[0])
+    log_frame((make_event(path) for path in paths), [], stages=[hitters],
+              sink=StdoutSink(stream=io.StringIO()))
+
+    top = hitters.top_keys()
+    assert [key for key, _, _ in top] == \
+        ['/files/hot_{}'.format(index) for index in range(5)]
+    assert all(500 - index * 50 <= estimate <= 500 - index * 50 +
+               hitters.error_bound() for index, (_, estimate, _)
+               in enumerate(top))
+    assert len(hitters.heap) <= 20
+
+    fading = HeavyHitters(top=1, half_life=10, clock=lambda: now[0])
+    for seconds in range(100):
+        now[0] = seconds
+        fading.process(make_event(1, name='Old' if seconds < 40 else 'New'))
+        fading.process(make_event(1, name='Old' if seconds < 50 else 'New'))
+
+    assert fading.top_keys()[0][0] == 'New'
+    assert 0.9 < fading.top_keys()[0][2] <= 1.0
+
+
+def test_event_filters_unchanged():
+    """
+    Wrapped events go through the filters like the nested
+    dicts do, and are written as the same JSON.
+    """
+    events = list(synthetic_events(500, seed=4, field_names=('n', 'div')))
+
+    for filters in (SAMPLE_FILTERS, [compile_filter(SAMPLE_EXPR)]):
+        expected = [x for x in events if apply_filters(x, filters)]
+        handled = []
+        log_frame(wrap_events(iter(events)), filters,
+                  on_event=(handled.append, (), {}))
+        assert handled == expected
+        assert all(isinstance(x, Event) for x in handled)
+
+    # The fields of the wrapped events are not changed.
+    field = events[0]['content'][0]
+    wrapped = Event.from_dict(events[0])
+    assert wrapped['content'][0] is not field
+    assert wrapped['content'][0]['attr'] is not field['attr']
+    assert wrapped.field(field['attr']['name']) == field['attr']
+
+    stream = io.StringIO()
+    log_frame(wrap_events(iter(events[:10])), [],
+              sink=StdoutSink(stream=stream))
+    assert [json.loads(x) for x in stream.getvalue().splitlines()] == \
+        events[:10]
+
+
+def test_event_compact():
+    """
+    Events share their interned strings, and packed events
+    use less memory, decoding their content on first use.
+    """
+    events = list(synthetic_events(2000, seed=4, field_count=4))
+    lines = [json.dumps(event) for event in events]
+
+    def traced_size(load):
+        """
+        Returns the memory held by the events loaded from the lines.
+        """
+        tracemalloc.start()
+        loaded = [load(line) for line in lines]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return loaded, size
+
+    _, dicts_size = traced_size(json.loads)
+    wrapped, wrapped_size = traced_size(
+        lambda line: Event.from_dict(json.loads(line)).pack())
+
+    assert wrapped_size < dicts_size / 2
+    assert wrapped[0].packed
+    assert wrapped[0].field('field_1') == \
+        events[0]['content'][1]['attr']
+    assert not wrapped[0].packed
+    assert wrapped == events
+    assert wrapped[0]['attr']['name'] is \
+        [x for x in wrapped if x['attr']['name'] ==
+         wrapped[0]['attr']['name']][-1]['attr']['name']
+
+
+def rewrite_file(path, text, age):
+    """
+    Rewrites a file, moving its modification time by age seconds.
+    """
+    with open(path, 'w') as rewritten:
+        rewritten.write(text)
+    mtime = os.stat(path).st_mtime + age
+    os.utime(path, (mtime, mtime))
+
+
+def reloaded_events(path, reloader, handled):
+    """
+    Yields solicits and responses, changing the filters midway.
+    """
+    tags = ('solicit', 'response')
+    for index in range(10):
+        yield make_event(index, tag=tags[index % 2])
+
+    rewrite_file(path, '# Responses only\ntag == "response"\n', 10)
+    for index in range(10, 20):
+        yield make_event(index, tag=tags[index % 2])
+
+    rewrite_file(path, 'tag ==\n', 20)
+    for index in range(20, 30):
+        yield make_event(index, tag=tags[index % 2])
+
+    reloader.update([], (collect, (handled, 'late'), {}))
+    for index in range(30, 34):
+        yield make_event(index, tag=tags[index % 2])
+
+
+def test_hot_reload(tmp_path):
+    """
+    Filters swap between events when the file changes,
+    invalid files are skipped, and on_event is swapped.
+    """
+    path = str(tmp_path / 'filters.txt')
+    rewrite_file(path, 'tag == "solicit"\n', 0)
+    reloader = FilterReloader(path, check_every=0)
+    stats = FrameStats()
+    handled = []
+
+    log_frame(reloaded_events(path, reloader, handled), reloader.filter_funs,
+              on_event=(collect, (handled, None), {}), stats=stats,
+              reloader=reloader)
+
+    assert [x[0] for x in handled] == [
+        0, 2, 4, 6, 8, 11, 13, 15, 17, 19,
+        21, 23, 25, 27, 29, 30, 31, 32, 33]
+    assert [x[1] for x in handled[-5:]] == [None] + ['late'] * 4
+    assert reloader.reloads == 2
+    assert reloader.failures == 1
+    assert stats.snapshot()['events'] == 34
+
+    with pytest.raises(LogException):
+        log_frame(iter([]), [], reloader=reloader,
+                  filter_order=AdaptiveOrder())
+
+
+def gated_events(started):
+    """
+    Yields 100 events, waiting after the first
+    one until on_event got it.
+    """
+    yield make_event(0)
+    started.wait(1.0)
+    for index in range(1, 100):
+        yield make_event(index)
+
+
+def wait_for_reader(event, reader, started, handled):
+    """
+    on_event function waiting, on the first event,
+    until the reader read all events.
+    """
+    if not started.is_set():
+        started.set()
+        reader.thread.join(1.0)
+    handled.append(event['content'][0]['attr']['value'])
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (BLOCK, list(range(100))),
+    (DROP_OLDEST, [0] + list(range(90, 100))),
+    (DROP_NEWEST, list(range(11)))])
+def test_listen_reader(policy, expected):
+    """
+    The reader fills the buffer while on_event lags, dropping
+    events or stalling as the policy says.
+    """
+    started = threading.Event()
+    reader = ListenReader(gated_events(started), maxsize=10, policy=policy)
+    handled = []
+    log_frame(reader, [], on_event=(
+        wait_for_reader, (reader, started, handled), {}))
+    stats = reader.stats()
+
+    assert handled == expected
+    assert stats['read'] == 100
+    assert stats['max_depth'] == 10
+    assert stats['depth'] == 0
+    assert stats['dropped_oldest' if policy == DROP_OLDEST else
+                 'dropped_newest'] == 100 - len(expected)
+
+    if policy == BLOCK:
+        assert stats['stalls'] >= 1
+        assert stats['stall_seconds'] > 0.5
+    else:
+        assert stats['stalls'] == 0
+
+
+def failing_events():
+    """
+    Yields events, then fails as a lost connection would.
+    """
+    for event in make_events(5):
+        yield event
+    raise ValueError('Connection lost')
+
+
+def close_reader(event, reader, handled):
+    """
+    on_event function stopping the reader, as stop_services does.
+    """
+    handled.append(event)
+    reader.close()
+
+
+def test_listen_reader_error_and_close():
+    """
+    Errors reading the events are raised after the buffered
+    events, and closing the reader stops the events.
+    """
+    handled = []
+    with pytest.raises(ValueError):
+        log_frame(ListenReader(failing_events()), [],
+                  on_event=(handled.append, (), {}))
+    assert len(handled) == 5
+
+    def endless_events():
+        """
+        Yields events until closed.
+        """
+        while True:
+            yield make_event(1)
+
+    handled = []
+    reader = ListenReader(endless_events(), maxsize=10)
+    log_frame(reader, [], on_event=(close_reader, (reader, handled), {}))
+    reader.thread.join(1.0)
+    assert len(handled) == 1
+    assert not reader.thread.is_alive()